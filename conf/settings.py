@@ -72,6 +72,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'ikwen_shavida.shavida.middleware.RequestCacheMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -212,6 +213,7 @@ STAFF_ROUTER = (
 IKWEN_LOGIN_EVENTS = (
     'ikwen_shavida.shavida.views.create_member_profile',
     'ikwen_shavida.shavida.views.set_additional_session_info',
+    'ikwen_shavida.shavida.views.warm_recommendations',
 )
 
 IKWEN_CONFIG_MODEL = 'shavida.OperatorProfile'
@@ -228,6 +230,14 @@ IS_VOD_OPERATOR = True
 SALES_UNIT = "Volume"
 # SALES_UNIT = "Broadcasting"
 
+# Path of the catalog file shared by all the worker processes. If not set,
+# each process holds its own copy of the catalog in memory.
+# CATALOG_FILE = os.path.join(BASE_DIR, 'catalog.bin')
+
+# Folder where the command build_related_media saves the vectors of media,
+# loaded by the processes to refresh related media incrementally. Required.
+RELATED_MODEL_DIR = os.path.join(BASE_DIR, 'related')
+
 # Path of the function to execute when querying a file that is not in MP4. Your function will be called as such:
 # your_function(request, media, *args, **kwargs)
 # media is an instance of either Movie or SeriesEpisode.
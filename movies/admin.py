@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import re
 import random
 
 from django.conf import settings
@@ -13,7 +12,9 @@ from import_export.admin import ImportExportMixin
 from ikwen.accesscontrol.models import Member
 
 from ikwen_shavida.conf.utils import is_vod_operator
-from ikwen_shavida.movies.models import Movie, Category, Series, SeriesEpisode, Trailer
+from ikwen_shavida.movies.categories import get_category_registry
+from ikwen_shavida.movies.models import Movie, Category, Series, SeriesEpisode, Trailer, OriginHealth
+from ikwen_shavida.movies.utils import remove_special_words
 from ikwen_shavida.sales.models import ContentUpdate
 
 
@@ -66,52 +67,6 @@ remove_movies_from_top20.short_description = "Remove selected movies from Top 20
 add_media_to_delete_list.short_description = "Mark for deletion"
 
 
-def remove_special_words(s):
-    s = re.sub("^the ", '', s)
-    s = re.sub("^at ", '', s)
-    s = re.sub("^in ", '', s)
-    s = re.sub("^le ", '', s)
-    s = re.sub("^la ", '', s)
-    s = re.sub("^les ", '', s)
-    s = re.sub("^l'", '', s)
-    s = re.sub("^un ", '', s)
-    s = re.sub("^une ", '', s)
-    s = re.sub("^des ", '', s)
-    s = re.sub("^d'", '', s)
-    s = re.sub("^de ", '', s)
-    s = re.sub("^du ", '', s)
-    s = re.sub("^a ", '', s)
-    s = re.sub("^et ", '', s)
-    s = re.sub("^en ", '', s)
-    s = s.replace(" the ", " ")\
-        .replace(" at ", " ")\
-        .replace(" in ", " ")\
-        .replace(" of ", " ")\
-        .replace(" le ", " ")\
-        .replace(" la ", " ")\
-        .replace(" les ", " ")\
-        .replace(" l'", " ")\
-        .replace(" un ", " ")\
-        .replace(" une ", " ")\
-        .replace(" des ", " ")\
-        .replace(" d'", " ")\
-        .replace(" de ", " ")\
-        .replace(" du ", " ")\
-        .replace(" a ", " ")\
-        .replace(" et ", " ")\
-        .replace(" en ", " ")\
-        .replace(" 1", "")\
-        .replace(" 2", "")\
-        .replace(" 3", "")\
-        .replace(" 4", "")\
-        .replace(" 5", "")\
-        .replace(" 6", "")\
-        .replace(" 7", "")\
-        .replace(" 8", "")\
-        .replace(" 9", "")
-    return s
-
-
 def get_title_from_filename(filename):
     PREFIXES = ['cine_', 'da_', 'clip_', 'tuto_', 'Hd_', 'comedie_', 'oms_', 'gag_', 'xxl_', 'doc_', 'Xcamer_']
     # Strip extension
@@ -278,7 +233,7 @@ class CategoryListFilter(admin.SimpleListFilter):
         in the right sidebar.
         """
         choices = []
-        for category in Category.objects.all():
+        for category in get_category_registry().all():
             choice = (category.id, category.title)
             choices.append(choice)
         return choices
@@ -292,9 +247,9 @@ class MovieCategoryListFilter(CategoryListFilter):
         `self.value()`.
         """
         if self.value():
+            category = get_category_registry().get(self.value())
             result_ids = []
             for m in list(queryset):
-                category = Category.objects.get(pk=self.value())
                 if category in m.categories:
                     result_ids.append(m.id)
             return Movie.objects.filter(pk__in=result_ids)
@@ -342,7 +297,7 @@ class MovieAdmin(ImportExportMixin, admin.ModelAdmin):
             obj.provider = get_service_instance()
         obj.categories = []
         is_adult = False
-        for category in Category.objects.all():
+        for category in get_category_registry().all():
             if request.POST.get('cat_%s' % category.id):
                 obj.categories.append(category)
                 if category.is_adult:
@@ -373,9 +328,9 @@ class SeriesCategoryListFilter(CategoryListFilter):
         `self.value()`.
         """
         if self.value():
+            category = get_category_registry().get(self.value())
             result_ids = []
             for m in list(queryset):
-                category = Category.objects.get(pk=self.value())
                 if category in m.categories:
                     result_ids.append(m.id)
             return Series.objects.filter(pk__in=result_ids)
@@ -416,7 +371,7 @@ class SeriesAdmin(ImportExportMixin, admin.ModelAdmin):
             obj.provider = get_service_instance()
         is_adult = False
         obj.categories = []
-        for category in Category.objects.all():
+        for category in get_category_registry().all():
             if request.POST.get('cat_%s' % category.id):
                 obj.categories.append(category)
                 if category.is_adult:
@@ -427,6 +382,9 @@ class SeriesAdmin(ImportExportMixin, admin.ModelAdmin):
             episode.release = obj.release
             episode.save()
         super(SeriesAdmin, self).save_model(request, obj, form, change)
+        # Episodes saved above updated the aggregates in the database only,
+        # so the full save of obj must not leave them with stale values.
+        obj.refresh_episodes_aggregates()
 
     def get_search_results(self, request, queryset, search_term):
         search_term = search_term.split(' ')[0][:4]  # Search is narrowed to maximum 4 chars before space
@@ -477,12 +435,26 @@ class TrailerAdmin(ImportExportMixin, admin.ModelAdmin):
     prepopulated_fields = {"slug": ("title",)}
 
 
+class OriginHealthAdmin(admin.ModelAdmin):
+    list_display = ('url', 'is_up', 'error_rate', 'p50_latency', 'p95_latency', 'last_checked_on', 'down_since',
+                    'last_error')
+    readonly_fields = ('url', 'is_up', 'error_rate', 'p50_latency', 'p95_latency', 'consecutive_failures',
+                       'consecutive_successes', 'last_error', 'last_checked_on', 'down_since')
+    list_filter = ('is_up', )
+    ordering = ('url', )
+
+    def has_add_permission(self, request):
+        return False
+
+
 if not getattr(settings, 'IS_IKWEN', False):
     admin.site.register(Movie, MovieAdmin)
     admin.site.register(Category, CategoryAdmin)
     if not getattr(settings, 'IS_GAME_VENDOR', False):
         admin.site.register(Series, SeriesAdmin)
         admin.site.register(SeriesEpisode, SeriesEpisodeAdmin)
+    if is_vod_operator():
+        admin.site.register(OriginHealth, OriginHealthAdmin)
     # admin.site.register(Trailer, TrailerAdmin)
 
 
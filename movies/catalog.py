@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only snapshot of the visible catalog held in memory by each process.
+Listing and recommendation code read ids, counts and media cards from it
+instead of querying MongoDB on every request.
+
+The snapshot is loaded lazily at first use. It is stamped with a version
+made of a process-local counter and a counter shared through the cache.
+Both are bumped by invalidate_catalog() which is called upon save and
+delete of Movie, Series, SeriesEpisode and Category; the next call to
+get_catalog() then reloads the snapshot.
+
+When CATALOG_FILE is set, the snapshot is rather read from a file shared
+by all the processes. See movies.catalog_file.
+"""
+from datetime import date
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ikwen_shavida.movies.models import Movie, Series
+
+__author__ = "Kom Sihon"
+
+CATALOG_VERSION_KEY = 'catalog_version'
+
+_catalog = None
+_local_version = 0
+_lock = Lock()
+
+
+class MediaRecord(object):
+    """
+    Compact in-memory representation of a visible Movie or Series.
+    card is the dict output by movies.utils.serialize_media() for the media.
+    """
+    __slots__ = ('id', 'type', 'slug', 'title', 'season', 'categories', 'release', 'orders', 'fake_orders',
+                 'fake_clicks', 'size', 'duration', 'is_adult', 'card')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    @classmethod
+    def from_media(cls, media, card):
+        return cls(id=media.id, type=media.type, slug=media.slug, title=media.title,
+                   season=getattr(media, 'season', None),
+                   categories=tuple([category.id for category in media.categories]),
+                   release=media.release, orders=media.orders,
+                   fake_orders=getattr(media, 'fake_orders', None), fake_clicks=getattr(media, 'fake_clicks', None),
+                   size=media.size, duration=media.duration, is_adult=media.is_adult, card=card)
+
+
+def _recent_key(record):
+    return record.id
+
+
+def _release_sort_value(record):
+    # Dates cannot be compared to None. Media without release
+    # come last in descending order, as they do in MongoDB.
+    return record.release is not None, record.release or date.min
+
+
+def _movie_recommendation_key(record):
+    return _release_sort_value(record), record.fake_clicks, record.fake_orders, record.id
+
+
+def _series_recommendation_key(record):
+    return _release_sort_value(record), record.season, record.id
+
+
+def _release_key(record):
+    return _release_sort_value(record), record.id
+
+
+# Orders in which ids of media are kept
+RECENT = 'recent'  # -id, as in Category.get_movies_queryset()
+RECOMMENDED = 'recommended'  # As in get_recommended_for_category()
+RELEASE = 'release'  # -release, -id, as in the Home recent releases
+
+
+class BaseCatalog(object):
+    """
+    Operations common to all kinds of catalog snapshots. Subclasses
+    implement get(), get_movie_ids(), get_series_ids() and get_cards().
+    """
+    RECENT = RECENT
+    RECOMMENDED = RECOMMENDED
+    RELEASE = RELEASE
+
+    def count_movies(self, category_id=None):
+        return len(self.get_movie_ids(category_id))
+
+    def count_series(self, category_id=None):
+        return len(self.get_series_ids(category_id))
+
+    def fetch(self, ids):
+        """
+        Gets the actual Movie and Series objects of the given ids in that same order,
+        with one query per type of media.
+        """
+        records = [self.get(pk) for pk in ids]
+        movie_ids = [record.id for record in records if record and record.type == 'movie']
+        series_ids = [record.id for record in records if record and record.type == 'series']
+        media_by_id = {}
+        if movie_ids:
+            media_by_id.update(dict([(movie.id, movie) for movie in Movie.objects.filter(pk__in=movie_ids)]))
+        if series_ids:
+            media_by_id.update(dict([(series.id, series) for series in Series.objects.filter(pk__in=series_ids)]))
+        return [media_by_id[pk] for pk in ids if pk in media_by_id]
+
+
+class CatalogIndex(BaseCatalog):
+    """
+    Visible movies and series held in memory with their ids
+    pre-sorted in each ordering, overall and per category id.
+    """
+
+    def __init__(self, movies, series, version=None):
+        from ikwen_shavida.movies.utils import serialize_media
+        self.version = version
+        self.records = {}
+        media = list(movies)
+        media.extend(series)
+        for item, card in zip(media, serialize_media(media)):
+            self.records[item.id] = MediaRecord.from_media(item, card)
+        movie_records = [record for record in self.records.values() if record.type == 'movie']
+        series_records = [record for record in self.records.values() if record.type == 'series']
+        self._movie_ids = self._build_orderings(movie_records, _movie_recommendation_key)
+        self._series_ids = self._build_orderings(series_records, _series_recommendation_key)
+
+    def _build_orderings(self, records, recommendation_key):
+        """
+        :return: dict {ordering: {category_id: [ids]}}. Key None of the inner dict holds all ids.
+        """
+        orderings = {}
+        for ordering, key in ((RECENT, _recent_key), (RECOMMENDED, recommendation_key), (RELEASE, _release_key)):
+            by_category = {None: []}
+            for record in sorted(records, key=key, reverse=True):
+                by_category[None].append(record.id)
+                for category_id in record.categories:
+                    by_category.setdefault(category_id, []).append(record.id)
+            orderings[ordering] = by_category
+        return orderings
+
+    @classmethod
+    def load(cls, version=None):
+        movies = Movie.objects.filter(visible=True)
+        series = Series.objects.filter(visible=True)
+        return cls(movies, series, version)
+
+    def get(self, media_id):
+        return self.records.get(media_id)
+
+    def get_movie_ids(self, category_id=None, ordering=RECENT):
+        return self._movie_ids[ordering].get(category_id, [])
+
+    def get_series_ids(self, category_id=None, ordering=RECENT):
+        return self._series_ids[ordering].get(category_id, [])
+
+    def get_cards(self, ids):
+        """
+        Gives the serialized media of the given ids. Unknown ids are skipped.
+        """
+        return [self.records[pk].card for pk in ids if pk in self.records]
+
+
+def get_catalog():
+    """
+    Gets the catalog snapshot of the current process, loading it again if it is outdated.
+    """
+    global _catalog
+    catalog_file = getattr(settings, 'CATALOG_FILE', None)
+    if catalog_file:
+        from ikwen_shavida.movies.catalog_file import get_mapped_catalog
+        return get_mapped_catalog(catalog_file)
+    version = (_local_version, cache.get(CATALOG_VERSION_KEY))
+    catalog = _catalog
+    if catalog is None or catalog.version != version:
+        with _lock:
+            if _catalog is None or _catalog.version != version:
+                _catalog = CatalogIndex.load(version)
+            catalog = _catalog
+    return catalog
+
+
+def invalidate_catalog():
+    """
+    Marks the catalog snapshots of all processes as outdated.
+    """
+    global _local_version
+    _local_version += 1
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.set(CATALOG_VERSION_KEY, 1, None)
+    catalog_file = getattr(settings, 'CATALOG_FILE', None)
+    if catalog_file:
+        from ikwen_shavida.movies.catalog_file import rebuild_catalog_file_async
+        rebuild_catalog_file_async(catalog_file)
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog snapshot stored in a binary file that all the worker processes
+of a deployment map in memory, instead of each holding its own copy of
+the catalog. Enabled by setting CATALOG_FILE to the path of the file.
+
+The file is rebuilt from the database in a background thread of the
+process where a media changed. It is written aside then renamed over the
+previous one, so readers always see a complete file. Each process maps
+the current file and switches to the new one when its inode changes.
+
+Layout (little-endian):
+    header      HEADER: magic, format version, records count, categories count,
+                bitset width in bytes and time of build
+    directory   Offset (uint32) of each section in SECTIONS order
+    sections    category_ids: 12 bytes ObjectId of each category
+                ids: 12 bytes ObjectId of each record
+                sorted_rows: rows (uint32) sorted by id, used for lookups
+                types: 'm' or 's' for each record
+                bitsets: categories of each record, bit i for category i
+                release (date ordinal), season, orders, fake_orders, fake_clicks,
+                size, duration: one int32 per record, NULL_INT for None
+                is_adult: one byte per record
+                orderings: (offset, count) of the rows of each of ORDERINGS over all the
+                    records, then within each category in category_ids order,
+                    followed by those rows
+                card_offsets: start of each card in cards, plus the end of the last
+                cards: JSON of the serialized media, one after the other
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from binascii import hexlify, unhexlify
+from datetime import date
+from threading import Lock, Thread
+
+from ikwen_shavida.movies.catalog import BaseCatalog, CatalogIndex, MediaRecord, RECENT, RECOMMENDED, RELEASE
+
+__author__ = "Kom Sihon"
+
+logger = logging.getLogger('ikwen')
+
+MAGIC = 'SHVC'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<4sHHIIId')
+ID_SIZE = 12
+NULL_INT = -2 ** 31
+INT_COLUMNS = ('release', 'season', 'orders', 'fake_orders', 'fake_clicks', 'size', 'duration')
+SECTIONS = ('category_ids', 'ids', 'sorted_rows', 'types', 'bitsets') + INT_COLUMNS + \
+           ('is_adult', 'orderings', 'card_offsets', 'cards')
+ORDERINGS = [(media_type, ordering) for media_type in ('movie', 'series')
+             for ordering in (RECENT, RECOMMENDED, RELEASE)]
+TYPE_CODES = {'movie': 'm', 'series': 's'}
+TYPES = {'m': 'movie', 's': 'series'}
+
+_mapped_catalog = None
+_lock = Lock()
+_rebuild_lock = Lock()
+_rebuild_state = {'running': False, 'pending': False}
+
+
+def _pack_ints(fmt, values):
+    return struct.pack('<%d%s' % (len(values), fmt), *values)
+
+
+def _to_int(value):
+    if value is None:
+        return NULL_INT
+    if isinstance(value, date):
+        return value.toordinal()
+    return int(value)
+
+
+def write_catalog_file(path, catalog):
+    """
+    Writes the content of a CatalogIndex to the file at path, replacing it atomically.
+    """
+    ids = list(catalog.get_movie_ids())
+    ids.extend(catalog.get_series_ids())
+    records = [catalog.get(pk) for pk in ids]
+    row_by_id = dict([(pk, row) for row, pk in enumerate(ids)])
+    category_ids = sorted(set([category_id for record in records for category_id in record.categories]))
+    category_index = dict([(category_id, i) for i, category_id in enumerate(category_ids)])
+    bitset_width = (len(category_ids) + 7) / 8
+
+    sections = {
+        'category_ids': ''.join([unhexlify(category_id) for category_id in category_ids]),
+        'ids': ''.join([unhexlify(pk) for pk in ids]),
+        'sorted_rows': _pack_ints('I', [row_by_id[pk] for pk in sorted(ids)]),
+        'types': ''.join([TYPE_CODES[record.type] for record in records]),
+        'is_adult': ''.join([chr(1) if record.is_adult else chr(0) for record in records]),
+    }
+    bitsets = []
+    for record in records:
+        bitset = bytearray(bitset_width)
+        for category_id in record.categories:
+            i = category_index[category_id]
+            bitset[i / 8] |= 1 << (i % 8)
+        bitsets.append(str(bitset))
+    sections['bitsets'] = ''.join(bitsets)
+    for column in INT_COLUMNS:
+        sections[column] = _pack_ints('i', [_to_int(getattr(record, column)) for record in records])
+
+    directory, rows = [], []
+    start = (len(category_ids) + 1) * len(ORDERINGS) * 8
+    for category_id in [None] + category_ids:
+        for media_type, ordering in ORDERINGS:
+            if media_type == 'movie':
+                ordered_ids = catalog.get_movie_ids(category_id, ordering)
+            else:
+                ordered_ids = catalog.get_series_ids(category_id, ordering)
+            directory.extend([start + len(rows) * 4, len(ordered_ids)])
+            rows.extend([row_by_id[pk] for pk in ordered_ids])
+    sections['orderings'] = _pack_ints('I', directory) + _pack_ints('I', rows)
+
+    cards, card_offsets, position = [], [], 0
+    for record in records:
+        card = json.dumps(record.card)
+        card_offsets.append(position)
+        cards.append(card)
+        position += len(card)
+    card_offsets.append(position)
+    sections['card_offsets'] = _pack_ints('I', card_offsets)
+    sections['cards'] = ''.join(cards)
+
+    offsets = []
+    position = HEADER.size + len(SECTIONS) * 4
+    for name in SECTIONS:
+        offsets.append(position)
+        position += len(sections[name])
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    fh = open(tmp_path, 'wb')
+    try:
+        fh.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(records), len(category_ids), bitset_width, time.time()))
+        fh.write(_pack_ints('I', offsets))
+        for name in SECTIONS:
+            fh.write(sections[name])
+        fh.flush()
+        os.fsync(fh.fileno())
+    finally:
+        fh.close()
+    os.rename(tmp_path, path)
+
+
+def build_catalog_file(path):
+    """
+    Loads the visible catalog from the database and writes it to the file at path.
+    """
+    write_catalog_file(path, CatalogIndex.load())
+
+
+def _get_stamp(stat):
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
+class _IdSequence(object):
+    """
+    Ids of a run of rows of an ordering of a MappedCatalog. Rows are unpacked
+    from the file as they are accessed rather than all at once, so that pages
+    and samples of a large category do not cost the whole category.
+    Slicing gives a list.
+    """
+    CHUNK_SIZE = 256
+
+    def __init__(self, catalog, offset, count):
+        self._catalog = catalog
+        self._offset = offset
+        self._count = count
+
+    def _get_rows(self, start, stop):
+        return struct.unpack_from('<%dI' % (stop - start), self._catalog._mm, self._offset + start * 4)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indexes = range(*index.indices(self._count))
+            if not indexes:
+                return []
+            start = min(indexes)
+            rows = self._get_rows(start, max(indexes) + 1)
+            return [self._catalog._get_id(rows[i - start]) for i in indexes]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("Id index out of range")
+        return self._catalog._get_id(self._get_rows(index, index + 1)[0])
+
+    def __iter__(self):
+        for start in range(0, self._count, self.CHUNK_SIZE):
+            for row in self._get_rows(start, min(start + self.CHUNK_SIZE, self._count)):
+                yield self._catalog._get_id(row)
+
+    def __eq__(self, other):
+        if isinstance(other, _IdSequence):
+            other = list(other)
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class MappedCatalog(BaseCatalog):
+    """
+    Read-only catalog backed by a memory mapped catalog file. Offers
+    the same reading interface as movies.catalog.CatalogIndex.
+    """
+
+    def __init__(self, path):
+        fh = open(path, 'rb')
+        try:
+            self.stamp = _get_stamp(os.fstat(fh.fileno()))
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+        magic, version, flags, self.count, self.category_count, self.bitset_width, self.built_on = \
+            HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("%s is not a catalog file of version %d" % (path, FORMAT_VERSION))
+        offsets = struct.unpack_from('<%dI' % len(SECTIONS), self._mm, HEADER.size)
+        self._offsets = dict(zip(SECTIONS, offsets))
+
+    def _get_id(self, row):
+        start = self._offsets['ids'] + row * ID_SIZE
+        return hexlify(self._mm[start:start + ID_SIZE])
+
+    def _get_int(self, column, row):
+        value = struct.unpack_from('<i', self._mm, self._offsets[column] + row * 4)[0]
+        return None if value == NULL_INT else value
+
+    def _find_row(self, media_id):
+        """
+        Binary search of the row of media_id in the sorted_rows section.
+        """
+        try:
+            key = unhexlify(media_id)
+        except (TypeError, ValueError):
+            return None
+        lo, hi = 0, self.count
+        sorted_rows = self._offsets['sorted_rows']
+        while lo < hi:
+            mid = (lo + hi) / 2
+            row = struct.unpack_from('<I', self._mm, sorted_rows + mid * 4)[0]
+            start = self._offsets['ids'] + row * ID_SIZE
+            current = self._mm[start:start + ID_SIZE]
+            if current == key:
+                return row
+            if current < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def _has_category(self, row, category_index):
+        byte = self._mm[self._offsets['bitsets'] + row * self.bitset_width + category_index / 8]
+        return ord(byte) & (1 << (category_index % 8))
+
+    def _get_category_index(self, category_id):
+        """
+        Binary search of the index of category_id in the category_ids section, sorted at build.
+        """
+        try:
+            key = unhexlify(category_id)
+        except (TypeError, ValueError):
+            return None
+        lo, hi = 0, self.category_count
+        start = self._offsets['category_ids']
+        while lo < hi:
+            mid = (lo + hi) / 2
+            current = self._mm[start + mid * ID_SIZE:start + (mid + 1) * ID_SIZE]
+            if current == key:
+                return mid
+            if current < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def _get_card(self, row):
+        start, end = struct.unpack_from('<2I', self._mm, self._offsets['card_offsets'] + row * 4)
+        cards = self._offsets['cards']
+        return json.loads(self._mm[cards + start:cards + end])
+
+    def _get_rows_entry(self, media_type, category_id, ordering):
+        """
+        :return: tuple (offset, count) of the rows of media_type in ordering
+            within category_id, or None if the category has no media.
+        """
+        if category_id is None:
+            position = 0
+        else:
+            category_index = self._get_category_index(category_id)
+            if category_index is None:
+                return None
+            position = category_index + 1
+        position = position * len(ORDERINGS) + ORDERINGS.index((media_type, ordering))
+        return struct.unpack_from('<2I', self._mm, self._offsets['orderings'] + position * 8)
+
+    def _get_ids(self, media_type, category_id, ordering):
+        entry = self._get_rows_entry(media_type, category_id, ordering)
+        if entry is None:
+            return []
+        start, count = entry
+        return _IdSequence(self, self._offsets['orderings'] + start, count)
+
+    def _count(self, media_type, category_id):
+        entry = self._get_rows_entry(media_type, category_id, RECENT)
+        return entry[1] if entry else 0
+
+    def get(self, media_id):
+        row = self._find_row(media_id)
+        if row is None:
+            return None
+        categories = []
+        for i in range(self.category_count):
+            if self._has_category(row, i):
+                start = self._offsets['category_ids'] + i * ID_SIZE
+                categories.append(hexlify(self._mm[start:start + ID_SIZE]))
+        release = self._get_int('release', row)
+        card = self._get_card(row)
+        return MediaRecord(id=media_id, type=TYPES[self._mm[self._offsets['types'] + row]], slug=card.get('slug'),
+                           title=card.get('title'), categories=tuple(categories),
+                           release=date.fromordinal(release) if release else None,
+                           season=self._get_int('season', row), orders=self._get_int('orders', row),
+                           fake_orders=self._get_int('fake_orders', row),
+                           fake_clicks=self._get_int('fake_clicks', row), size=self._get_int('size', row),
+                           duration=self._get_int('duration', row),
+                           is_adult=self._mm[self._offsets['is_adult'] + row] == chr(1), card=card)
+
+    def get_movie_ids(self, category_id=None, ordering=RECENT):
+        return self._get_ids('movie', category_id, ordering)
+
+    def get_series_ids(self, category_id=None, ordering=RECENT):
+        return self._get_ids('series', category_id, ordering)
+
+    def count_movies(self, category_id=None):
+        return self._count('movie', category_id)
+
+    def count_series(self, category_id=None):
+        return self._count('series', category_id)
+
+    def get_cards(self, ids):
+        """
+        Gives the serialized media of the given ids. Unknown ids are skipped.
+        """
+        rows = [self._find_row(pk) for pk in ids]
+        return [self._get_card(row) for row in rows if row is not None]
+
+
+def get_mapped_catalog(path):
+    """
+    Gets the catalog mapped from the file at path, building the file if it does
+    not exist yet and mapping the file again if it was rebuilt in the meantime.
+    """
+    global _mapped_catalog
+    if not os.path.exists(path):
+        with _lock:
+            if not os.path.exists(path):
+                build_catalog_file(path)
+    stamp = _get_stamp(os.stat(path))
+    catalog = _mapped_catalog
+    if catalog is None or catalog.stamp != stamp:
+        with _lock:
+            if _mapped_catalog is None or _mapped_catalog.stamp != stamp:
+                _mapped_catalog = MappedCatalog(path)
+            catalog = _mapped_catalog
+    return catalog
+
+
+def _rebuild(path):
+    while True:
+        with _rebuild_lock:
+            _rebuild_state['pending'] = False
+        try:
+            build_catalog_file(path)
+        except:
+            logger.error("Failed to rebuild catalog file %s" % path, exc_info=True)
+        with _rebuild_lock:
+            if not _rebuild_state['pending']:
+                _rebuild_state['running'] = False
+                return
+
+
+def rebuild_catalog_file_async(path):
+    """
+    Rebuilds the catalog file in a background thread. Requests made while
+    a rebuild is running are merged into a single subsequent rebuild.
+    """
+    with _rebuild_lock:
+        if _rebuild_state['running']:
+            _rebuild_state['pending'] = True
+            return
+        _rebuild_state['running'] = True
+    thread = Thread(target=_rebuild, args=(path, ))
+    thread.daemon = True
+    thread.start()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide registry of all the categories, keyed by id. Media embed
+copies of their categories which may be outdated, so code needing the
+actual smart, adult, visible or order status of a category reads it from
+here rather than getting the Category again from the database.
+
+The registry is versioned like the catalog snapshot in movies.catalog and
+reloaded at next use after invalidate_category_registry() is called upon
+save and delete of a Category.
+"""
+from threading import Lock
+
+from django.core.cache import cache
+
+from ikwen_shavida.movies.models import Category
+
+__author__ = "Kom Sihon"
+
+CATEGORY_REGISTRY_VERSION_KEY = 'category_registry_version'
+
+_registry = None
+_local_version = 0
+_lock = Lock()
+
+
+class CategoryRegistry(object):
+    """
+    Categories held in memory. Category objects returned are
+    shared by all threads of the process and must not be modified.
+    """
+
+    def __init__(self, categories, version=None):
+        self.version = version
+        self._categories = sorted(categories, key=lambda category: category.order_of_appearance)
+        self._by_id = dict([(category.id, category) for category in self._categories])
+        self._by_slug = dict([(category.slug, category) for category in self._categories])
+
+    @classmethod
+    def load(cls, version=None):
+        return cls(Category.objects.all(), version)
+
+    def get(self, category_id):
+        return self._by_id.get(category_id)
+
+    def get_by_slug(self, slug):
+        return self._by_slug.get(slug)
+
+    def all(self):
+        """
+        All categories sorted by order_of_appearance
+        """
+        return list(self._categories)
+
+    def is_smart(self, category_id):
+        category = self.get(category_id)
+        return category is not None and category.smart
+
+    def is_adult(self, category_id):
+        category = self.get(category_id)
+        return category is not None and category.is_adult
+
+    def is_visible(self, category_id):
+        category = self.get(category_id)
+        return category is not None and category.visible
+
+    def get_order(self, category_id):
+        category = self.get(category_id)
+        return category.order_of_appearance if category else None
+
+
+def get_category_registry():
+    """
+    Gets the category registry of the current process, loading it again if it is outdated.
+    """
+    global _registry
+    version = (_local_version, cache.get(CATEGORY_REGISTRY_VERSION_KEY))
+    registry = _registry
+    if registry is None or registry.version != version:
+        with _lock:
+            if _registry is None or _registry.version != version:
+                _registry = CategoryRegistry.load(version)
+            registry = _registry
+    return registry
+
+
+def invalidate_category_registry():
+    """
+    Marks the category registries of all processes as outdated.
+    """
+    global _local_version
+    _local_version += 1
+    try:
+        cache.incr(CATEGORY_REGISTRY_VERSION_KEY)
+    except ValueError:
+        cache.set(CATEGORY_REGISTRY_VERSION_KEY, 1, None)
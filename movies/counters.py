@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Counts of visible movies and series per category and overall, kept in the
+MediaCounter collection and mirrored in the cache, so that sharing a number
+of media between movies and series does not need any count() query.
+
+Counters are built at first use by build_media_counters(), which also backs
+the command build_media_counters. Then each save or delete of a Movie or
+Series increments or decrements with $inc the counters of the categories
+it enters or leaves. The cached copy is dropped on each change and loaded
+again from the collection at next use.
+"""
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.db.models import F
+
+from ikwen_shavida.movies.models import MediaCounter, Movie, Series
+
+__author__ = "Kom Sihon"
+
+MEDIA_COUNTERS_KEY = 'media_counters'
+ALL = 'all'  # Key of the counter of the whole catalog
+
+# Fields of media which change can move it from a counter to another
+COUNTED_FIELDS = ('visible', 'categories')
+
+
+def get_counter_keys(media):
+    """
+    Keys of the MediaCounter media counts in: none if it is not visible,
+    else ALL and the ids of its categories.
+    """
+    if media is None or not media.visible:
+        return set()
+    keys = set([category.id for category in media.categories])
+    keys.add(ALL)
+    return keys
+
+
+def build_media_counters(using='default'):
+    """
+    Counts all the visible media again and replaces the MediaCounter with the result.
+    :return: dict {key: (movies_count, series_count)}
+    """
+    counters = {ALL: [0, 0]}
+    for model, i in ((Movie, 0), (Series, 1)):
+        for media in model.objects.using(using).filter(visible=True):
+            for key in get_counter_keys(media):
+                counters.setdefault(key, [0, 0])[i] += 1
+    for counter in MediaCounter.objects.using(using).all():
+        if counter.key not in counters:
+            counter.delete(using=using)
+    for key, (movies_count, series_count) in counters.items():
+        if not MediaCounter.objects.using(using).filter(key=key).update(movies_count=movies_count,
+                                                                        series_count=series_count):
+            MediaCounter.objects.using(using).create(key=key, movies_count=movies_count, series_count=series_count)
+    counters = dict([(key, tuple(counts)) for key, counts in counters.items()])
+    if using == 'default':
+        cache.set(MEDIA_COUNTERS_KEY, counters, None)
+    return counters
+
+
+def get_media_counters():
+    """
+    :return: dict {key: (movies_count, series_count)} of all the counters
+    """
+    counters = cache.get(MEDIA_COUNTERS_KEY)
+    if counters is None:
+        counters = dict([(counter.key, (counter.movies_count, counter.series_count))
+                         for counter in MediaCounter.objects.all()])
+        if ALL not in counters:
+            return build_media_counters()
+        cache.set(MEDIA_COUNTERS_KEY, counters, None)
+    return counters
+
+
+def get_media_counts(category_id=None):
+    """
+    :return: tuple (movies_count, series_count) of visible media in the category, or overall if None
+    """
+    return get_media_counters().get(category_id or ALL, (0, 0))
+
+
+def _increment(key, field, delta):
+    if MediaCounter.objects.filter(key=key).update(**{field: F(field) + delta}):
+        return
+    try:
+        MediaCounter.objects.create(key=key, **{field: max(delta, 0)})
+    except IntegrityError:  # Created meanwhile by another process
+        MediaCounter.objects.filter(key=key).update(**{field: F(field) + delta})
+
+
+def apply_media_change(media_type, previous_keys, keys):
+    """
+    Moves a media of media_type from the counters of previous_keys to those of keys.
+    Nothing is done while the counters are not built; they will be counted from scratch.
+    """
+    if previous_keys == keys or not MediaCounter.objects.filter(key=ALL).count():
+        return
+    field = 'movies_count' if media_type == 'movie' else 'series_count'
+    for key in keys - previous_keys:
+        _increment(key, field, 1)
+    for key in previous_keys - keys:
+        _increment(key, field, -1)
+    cache.delete(MEDIA_COUNTERS_KEY)
+
+
+def delete_counter(category_id):
+    MediaCounter.objects.filter(key=category_id).delete()
+    cache.delete(MEDIA_COUNTERS_KEY)
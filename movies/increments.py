@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Buffered increments of the counters of media (clicks, orders, earnings).
+Incrementing a counter by saving the media rewrites its whole document,
+including its growing history lists, and loses the increments of
+concurrent requests. Increments are rather summed in memory per media, then
+written by flush_increments() every MEDIA_INCREMENTS_FLUSH_INTERVAL seconds
+from a background thread: one atomic $inc of all its counters per media,
+whatever the number of hits it got meanwhile.
+
+Increments still pending when the process exits normally are flushed by an
+atexit handler. They are lost if it is killed. Those which write fails are
+kept pending for the next flush.
+
+Code saving a media while its counters may be incremented meanwhile saves
+it as loaded by reload_without_counters(): saving a deferred instance only
+writes the fields it loaded, so the increments are not overwritten.
+"""
+import atexit
+import logging
+import time
+from threading import Lock, Thread
+
+from django.conf import settings
+from django.db.models import F
+
+from ikwen_shavida.movies.catalog import invalidate_catalog
+from ikwen_shavida.movies.models import LISTING_INDEPENDENT_FIELDS, Series, SeriesEpisode
+
+__author__ = "Kom Sihon"
+
+logger = logging.getLogger('ikwen')
+
+# Counters of media incremented through the buffer
+BUFFERED_FIELDS = ('clicks', 'orders', 'fake_orders', 'current_earnings')
+
+_lock = Lock()
+_state = {'flusher': None, 'pending': {}}  # pending: {(model, using, pk): {field: delta}}
+
+
+def buffer_increment(media, using='default', **deltas):
+    """
+    Adds deltas to the counters of media, written at next flush. The media object itself is left untouched.
+    Eg: buffer_increment(movie, orders=1, fake_orders=1)
+    """
+    key = (type(media), using, media.pk)
+    with _lock:
+        fields = _state['pending'].setdefault(key, {})
+        for field, delta in deltas.items():
+            fields[field] = fields.get(field, 0) + delta
+        flusher = _state['flusher']
+        if flusher is None or not flusher.is_alive():
+            flusher = Thread(target=_work)
+            flusher.daemon = True
+            flusher.start()
+            _state['flusher'] = flusher
+
+
+def _restore(key, deltas):
+    """
+    Puts back deltas which write failed among the pending increments.
+    """
+    with _lock:
+        fields = _state['pending'].setdefault(key, {})
+        for field, delta in deltas.items():
+            fields[field] = fields.get(field, 0) + delta
+
+
+def flush_increments(media=None):
+    """
+    Writes the pending increments, or only those of media if given. Aggregates of
+    the series which episodes were incremented are refreshed once per series.
+    :return: number of media updated
+    """
+    with _lock:
+        if media is None:
+            pending = _state['pending']
+            _state['pending'] = {}
+        else:
+            pending = dict([(key, _state['pending'].pop(key)) for key in _state['pending'].keys()
+                            if key[0] == type(media) and key[2] == media.pk])
+    episode_ids = {}
+    invalidate = False
+    count = 0
+    for (model, using, pk), deltas in pending.items():
+        deltas = dict([(field, delta) for field, delta in deltas.items() if delta])
+        if not deltas:
+            continue
+        try:
+            model.objects.using(using).filter(pk=pk).update(**dict([(field, F(field) + delta)
+                                                                    for field, delta in deltas.items()]))
+        except:
+            logger.error("Failed to write increments %s of %s %s" % (deltas, model.__name__, pk), exc_info=True)
+            _restore((model, using, pk), deltas)
+            continue
+        count += 1
+        if model == SeriesEpisode:
+            episode_ids.setdefault(using, []).append(pk)
+        if set(deltas) - set(LISTING_INDEPENDENT_FIELDS):
+            invalidate = True
+    for using, ids in episode_ids.items():
+        series_ids = set([episode.series_id for episode in SeriesEpisode.objects.using(using).filter(pk__in=ids)])
+        for series in Series.objects.using(using).filter(pk__in=list(series_ids)):
+            series.refresh_episodes_aggregates(using=using)
+    if invalidate:
+        invalidate_catalog()
+    return count
+
+
+def reload_without_counters(media, using='default'):
+    """
+    Gets media again from the database, leaving its BUFFERED_FIELDS out. Saving the
+    object returned writes only its other fields. Signals of the model are not sent
+    for such saves, since Django sends them with the deferred class as sender.
+    """
+    model = type(media)
+    field_names = model._meta.get_all_field_names()
+    deferred = [field for field in BUFFERED_FIELDS if field in field_names]
+    return model.objects.using(using).defer(*deferred).get(pk=media.pk)
+
+
+def _work():
+    while True:
+        time.sleep(getattr(settings, 'MEDIA_INCREMENTS_FLUSH_INTERVAL', 10))
+        try:
+            flush_increments()
+        except:
+            logger.error("Failed to flush media increments", exc_info=True)
+
+
+atexit.register(flush_increments)
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ikwen_shavida.movies.catalog_file import build_catalog_file
+
+__author__ = "Kom Sihon"
+
+
+class Command(BaseCommand):
+    help = "Writes the visible catalog to the shared catalog file read by the worker processes."
+    option_list = BaseCommand.option_list + (
+        make_option('--path', action='store', dest='path', default=None,
+                    help="Path of the file to write. Defaults to settings.CATALOG_FILE."),
+    )
+
+    def handle(self, *args, **options):
+        path = options.get('path') or getattr(settings, 'CATALOG_FILE', None)
+        if not path:
+            raise CommandError("No path given and CATALOG_FILE is not set.")
+        build_catalog_file(path)
+        self.stdout.write("Catalog file written to %s." % path)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ikwen_shavida.movies.counters import build_media_counters, ALL
+
+__author__ = "Kom Sihon"
+
+
+class Command(BaseCommand):
+    help = "Counts visible Movies and Series again, overall and per category, used to share lists between them."
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database', default='default',
+                    help="Database on which to count media. Defaults to 'default'."),
+    )
+
+    def handle(self, *args, **options):
+        using = options.get('database')
+        counters = build_media_counters(using)
+        movies_count, series_count = counters[ALL]
+        self.stdout.write("%d movies and %d series counted in %d categories." % (movies_count, series_count,
+                                                                                len(counters) - 1))
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ikwen_shavida.movies.models import Movie, Series
+from ikwen_shavida.movies.related import build_related_media
+
+__author__ = "Kom Sihon"
+
+
+class Command(BaseCommand):
+    help = "Computes the related media of all visible Movies and Series, used for suggestions on detail pages."
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database', default='default',
+                    help="Database on which to compute related media. Defaults to 'default'."),
+    )
+
+    def handle(self, *args, **options):
+        using = options.get('database')
+        movies_count = build_related_media(Movie, using)
+        series_count = build_related_media(Series, using)
+        self.stdout.write("Related media computed for %d movies and %d series." % (movies_count, series_count))
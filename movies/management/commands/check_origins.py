@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from ikwen_shavida.movies.origins import check_origins_health
+from ikwen_shavida.shavida.middleware import get_config
+
+__author__ = "Kom Sihon"
+
+
+class Command(BaseCommand):
+    help = "Checks the data sources of the platform and records their health, used to route streams. " \
+           "Run it from a cron on deployments where the monitor thread of the web processes is not enough."
+
+    def handle(self, *args, **options):
+        urls = [folder.strip() for folder in get_config().data_sources.split(',') if folder.strip()]
+        health = check_origins_health(urls)
+        for url in urls:
+            is_up, error_rate, p50_latency = health[url]
+            self.stdout.write("%s: %s, %d%% errors, p50 %s ms" % (url, 'up' if is_up else 'DOWN',
+                                                                 error_rate * 100, p50_latency))
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ikwen_shavida.movies.models import Series, SeriesEpisode
+
+__author__ = "Kom Sihon"
+
+
+class Command(BaseCommand):
+    help = "Recomputes the episodes aggregates (size, duration, orders, clicks, ...) of all Series."
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database', default='default',
+                    help="Database on which to rebuild the aggregates. Defaults to 'default'."),
+    )
+
+    def handle(self, *args, **options):
+        using = options.get('database')
+        episodes_by_series = {}
+        for episode in SeriesEpisode.objects.using(using).all().order_by('id'):
+            episodes_by_series.setdefault(episode.series_id, []).append(episode)
+        count = 0
+        for series in Series.objects.using(using).all():
+            series.refresh_episodes_aggregates(episodes_by_series.get(series.id, []), using=using)
+            count += 1
+        self.stdout.write("Episodes aggregates rebuilt for %d series." % count)
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ikwen_shavida.movies.models import Movie, Series
+from ikwen_shavida.movies.utils import reseed_rand
+
+__author__ = "Kom Sihon"
+
+
+class Command(BaseCommand):
+    help = "Draws new random values of the field rand of all Movies and Series used by movies.utils.sample_media(). " \
+           "Meant to run periodically in a cron so that random picks do not always come in the same groups."
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database', default='default',
+                    help="Database on which to reseed. Defaults to 'default'."),
+    )
+
+    def handle(self, *args, **options):
+        using = options.get('database')
+        movies_count = reseed_rand(Movie, using)
+        series_count = reseed_rand(Series, using)
+        self.stdout.write("rand reseeded for %d movies and %d series." % (movies_count, series_count))
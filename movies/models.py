@@ -5,7 +5,7 @@ from bson.objectid import ObjectId
 from django.conf import settings
 
 from django.db import models
-from django.db.models.signals import post_syncdb
+from django.db.models.signals import post_syncdb, pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 from django_mongodb_engine.contrib import MongoDBManager
@@ -15,9 +15,15 @@ from ikwen.accesscontrol.models import Member
 from ikwen.accesscontrol.templatetags.shared_media import from_provider
 from ikwen.core.fields import MultiImageField
 from ikwen.core.models import Model, AbstractWatchModel, Service
-from ikwen.core.utils import to_dict, get_service_instance
+from ikwen.core.utils import to_dict
 from ikwen_shavida.conf.utils import is_content_vendor, is_vod_operator
 from ikwen_shavida.sales.models import SalesConfig
+from ikwen_shavida.shavida.middleware import get_config
+
+
+# Fields of media that do not appear in listings. Saving only those
+# with update_fields does not outdate the in-memory catalog snapshot.
+LISTING_INDEPENDENT_FIELDS = ('clicks', )
 
 
 def series_cmp_orders(s1, s2):
@@ -99,16 +105,22 @@ class MediaInterface():
         return self.duration if unit == SalesConfig.BROADCASTING_TIME else self.size
     load = property(_get_load)
 
-    def _get_display_load(self):
+    def get_display_load(self, config=None):
         """
         Load in a format suitable for display depending on the unit of sales in sales.models.SalesConfig
         duration if unit == 'Broadcasting', size otherwise
+        :param config: OperatorProfile used for the currency symbol when running as game vendor.
+                       Pass it when displaying many media to avoid resolving it for each of them.
         """
         if getattr(settings, 'IS_GAME_VENDOR', False):
-            config = get_service_instance().config
+            if config is None:
+                config = get_config()
             return "%s %d" % (config.currency_symbol, self.price)
         unit = getattr(settings, 'SALES_UNIT', SalesConfig.BROADCASTING_TIME)
         return self.display_duration if unit == SalesConfig.BROADCASTING_TIME else self.display_size
+
+    def _get_display_load(self):
+        return self.get_display_load()
     display_load = property(_get_display_load)
 
 
@@ -199,6 +211,8 @@ class Movie(Media):
                                         "lowercase and main actors, all separated by space. Eg: <strong>matrix keanu reaves</strong>"))
     # Random field used for random selections in MongoDB
     rand = models.FloatField(default=random.random, db_index=True, editable=False)
+    # Ids of the most similar media, computed by movies.related
+    related_ids = ListField(editable=False)
 
     owner_fk_list = ListField()
 
@@ -257,14 +271,20 @@ class Movie(Media):
     trailer = property(_get_trailer)
 
     def _get_owner_list(self):
-        owner_list = []
-        for pk in self.owner_fk_list:
-            try:
-                owner_list.append(Member.objects.get(pk=pk))
-            except:
-                pass
+        """
+        Display data (id, full_name, email) of the owners of this media. Use
+        movies.utils.resolve_owners() to resolve those of many media at once.
+        """
+        owner_list = getattr(self, '_owner_list', None)
+        if owner_list is None:
+            from ikwen_shavida.movies.utils import resolve_owners
+            resolve_owners([self])
+            owner_list = self._owner_list
         return owner_list
-    owner_list = property(_get_owner_list)
+
+    def _set_owner_list(self, owner_list):
+        self._owner_list = owner_list
+    owner_list = property(_get_owner_list, _set_owner_list)
 
     def to_dict(self):
         var = to_dict(self)
@@ -289,6 +309,7 @@ class Movie(Media):
         del(var['categories'])
         del(var['groups'])
         del(var['rand'])
+        del(var['related_ids'])
         return var
 
     def __unicode__(self):
@@ -334,6 +355,8 @@ class Series(AbstractWatchModel, MediaInterface):
                                         "lowercase and main actors, all separated by space. Eg: <strong>scandal keanu reaves</strong>"))
     # Random field used for random selections in MongoDB
     rand = models.FloatField(default=random.random, db_index=True, editable=False)
+    # Ids of the most similar media, computed by movies.related
+    related_ids = ListField(editable=False)
 
     owner_fk_list = ListField()
 
@@ -345,6 +368,17 @@ class Series(AbstractWatchModel, MediaInterface):
     total_download = models.IntegerField(default=0)
     total_earnings = models.IntegerField(default=0)
 
+    # Aggregates of the episodes of this series. They are maintained upon
+    # SeriesEpisode save and delete so that reading them costs no query.
+    # Run "manage.py rebuild_series_aggregates" to recompute them all.
+    total_size = models.PositiveIntegerField(default=0, editable=False)
+    total_duration = models.PositiveIntegerField(default=0, editable=False)
+    average_orders = models.IntegerField(default=0, editable=False)
+    average_clicks = models.IntegerField(default=0, editable=False)
+    first_episode_fake_orders = models.IntegerField(blank=True, null=True, editable=False)
+    first_episode_fake_clicks = models.IntegerField(blank=True, null=True, editable=False)
+    uploaded_episodes_count = models.PositiveIntegerField(default=0, editable=False)
+
     class Meta:
         verbose_name_plural = 'Series'
         unique_together = ('title', 'season', )
@@ -362,16 +396,13 @@ class Series(AbstractWatchModel, MediaInterface):
         Is arbitrarily considered as the number of fake_orders of the first episode of the series.
         It is returned in a format suitable for display
         """
-        query_set = SeriesEpisode.objects.filter(series=self.id)
-        first_episode = query_set[0] if len(query_set) > 0 else None
-        if first_episode:
-            if first_episode.fake_orders < 1000:
-                return first_episode.fake_orders
-            else:
-                num500 = first_episode.fake_orders / 500
-                return "%d+" % (num500 * 500)
-        else:
+        fake_orders = self.first_episode_fake_orders
+        if fake_orders is None:
             return 20  # This is an arbitrary value
+        if fake_orders < 1000:
+            return fake_orders
+        num500 = fake_orders / 500
+        return "%d+" % (num500 * 500)
     display_orders = property(_get_display_orders)
 
     def _get_display_clicks(self):
@@ -380,60 +411,43 @@ class Series(AbstractWatchModel, MediaInterface):
         Is arbitrarily considered as the number of fake_clicks of the first episode of the series.
         It is returned in a format suitable for display
         """
-        query_set = SeriesEpisode.objects.filter(series=self.id)
-        first_episode = query_set[0] if len(query_set) > 0 else None
-        if first_episode:
-            if first_episode.fake_clicks < 1000:
-                return first_episode.fake_clicks
-            else:
-                num500 = first_episode.fake_clicks / 500
-                return "%d+" % (num500 * 500)
-        else:
+        fake_clicks = self.first_episode_fake_clicks
+        if fake_clicks is None:
             return 150  # This is an arbitrary value
+        if fake_clicks < 1000:
+            return fake_clicks
+        num500 = fake_clicks / 500
+        return "%d+" % (num500 * 500)
     display_clicks = property(_get_display_clicks)
 
     def _get_orders(self):
         """
-        Calculate the number of orders of the series as the average number of orders of the episodes.
+        Number of orders of the series as the average number of orders of the episodes.
         """
-        episodes = SeriesEpisode.objects.filter(series=self.id)
-        if len(episodes) == 0:
-            return 0
-        total_orders = 0
-        for episode in episodes:
-            total_orders += episode.orders
-        return total_orders / len(episodes)
+        return self.average_orders
     orders = property(_get_orders)
     _get_orders.short_description = 'Orders'
 
     def _get_clicks(self):
         """
-        Calculate the number of clicks of the series as the average number of clicks of the episodes.
+        Number of clicks of the series as the average number of clicks of the episodes.
         """
-        episodes = SeriesEpisode.objects.filter(series=self.id)
-        if len(episodes) == 0:
-            return 0
-        total_clicks = 0
-        for episode in episodes:
-            total_clicks += episode.orders
-        return total_clicks / len(episodes)
+        return self.average_clicks
     clicks = property(_get_clicks)
     _get_clicks.short_description = 'Clicks'
 
     def _get_size(self):
         """
-        Calculate the size of the series by summing up the size of episodes individual files.
+        Size of the series as the sum of the size of episodes individual files.
         """
-        sizes = [series_episode.size for series_episode in SeriesEpisode.objects.filter(series=self)]
-        return reduce(lambda x, y: x + y, sizes) if len(sizes) > 0 else 0
+        return self.total_size
     size = property(_get_size)
 
     def _get_duration(self):
         """
-        Calculate the duration of the series by summing up the duration of episodes individual files.
+        Duration of the series as the sum of the duration of episodes individual files.
         """
-        durations = [series_episode.duration for series_episode in SeriesEpisode.objects.filter(series=self)]
-        return reduce(lambda x, y: x + y, durations) if len(durations) > 0 else 0
+        return self.total_duration
     duration = property(_get_duration)
 
     def _get_categories_to_string(self):
@@ -445,9 +459,39 @@ class Series(AbstractWatchModel, MediaInterface):
         """
         Gets the list of episodes of this series
         """
-        return [series_episode for series_episode in SeriesEpisode.objects.filter(series=self)]
+        return [series_episode for series_episode in SeriesEpisode.objects.filter(series=self).order_by('id')]
     episodes = property(_get_episodes)
 
+    def compute_episodes_aggregates(self, episodes):
+        """
+        Computes the values of the aggregate fields of this series from the list of its episodes.
+        :param episodes: list of SeriesEpisode ordered by id
+        :return: dict mapping the aggregate field names to their values
+        """
+        count = len(episodes)
+        first_episode = episodes[0] if count > 0 else None
+        return {
+            'total_size': sum([episode.size for episode in episodes]),
+            'total_duration': sum([episode.duration for episode in episodes]),
+            'average_orders': sum([episode.orders for episode in episodes]) / count if count else 0,
+            'average_clicks': sum([episode.clicks for episode in episodes]) / count if count else 0,
+            'first_episode_fake_orders': first_episode.fake_orders if first_episode else None,
+            'first_episode_fake_clicks': first_episode.fake_clicks if first_episode else None,
+            'uploaded_episodes_count': count
+        }
+
+    def refresh_episodes_aggregates(self, episodes=None, using='default'):
+        """
+        Recomputes the aggregate fields of this series and writes only those fields
+        to the database, leaving the rest of the document untouched.
+        """
+        if episodes is None:
+            episodes = list(SeriesEpisode.objects.using(using).filter(series=self).order_by('id'))
+        aggregates = self.compute_episodes_aggregates(episodes)
+        for field, value in aggregates.items():
+            setattr(self, field, value)
+        Series.objects.using(using).filter(pk=self.id).update(**aggregates)
+
     def _get_seriesepisode_set(self):
         """
         Gets the query_set containing all episodes of this series. This naturally exists
@@ -475,14 +519,20 @@ class Series(AbstractWatchModel, MediaInterface):
     type = property(_get_type)
 
     def _get_owner_list(self):
-        owner_list = []
-        for pk in self.owner_fk_list:
-            try:
-                owner_list.append(Member.objects.get(pk=pk))
-            except:
-                pass
+        """
+        Display data (id, full_name, email) of the owners of this media. Use
+        movies.utils.resolve_owners() to resolve those of many media at once.
+        """
+        owner_list = getattr(self, '_owner_list', None)
+        if owner_list is None:
+            from ikwen_shavida.movies.utils import resolve_owners
+            resolve_owners([self])
+            owner_list = self._owner_list
         return owner_list
-    owner_list = property(_get_owner_list)
+
+    def _set_owner_list(self, owner_list):
+        self._owner_list = owner_list
+    owner_list = property(_get_owner_list, _set_owner_list)
 
     def to_dict(self):
         var = to_dict(self)
@@ -496,7 +546,11 @@ class Series(AbstractWatchModel, MediaInterface):
         var['display_clicks'] = self.display_clicks
         var['display_load'] = self.display_load
         var['full_title'] = self.full_title
+        for field in ('total_size', 'total_duration', 'average_orders', 'average_clicks',
+                      'first_episode_fake_orders', 'first_episode_fake_clicks'):
+            del(var[field])
         del(var['rand'])
+        del(var['related_ids'])
         del(var['synopsis'])
         del(var['provider_id'])
         del(var['visible'])
@@ -560,6 +614,46 @@ class SeriesEpisode(Media):
         return self.title
 
 
+class MediaCounter(models.Model):
+    """
+    Number of visible movies and series of a category, or of the whole catalog
+    under the key movies.counters.ALL. Maintained by movies.counters upon save
+    and delete of media and categories.
+    """
+    key = models.CharField(max_length=24, unique=True)
+    movies_count = models.IntegerField(default=0)
+    series_count = models.IntegerField(default=0)
+
+
+class OriginHealth(models.Model):
+    """
+    Health of a data source (origin server) of the OperatorProfile, as recorded
+    by the background checks of movies.origins. Sources down are not used to
+    stream media until they recover.
+    """
+    url = models.CharField(max_length=250, unique=True)
+    is_up = models.BooleanField(default=True)
+    error_rate = models.FloatField(default=0,
+                                   help_text="Share of the recent checks that failed.")
+    p50_latency = models.IntegerField(blank=True, null=True,
+                                      help_text="Median response time of the recent checks in milliseconds.")
+    p95_latency = models.IntegerField(blank=True, null=True,
+                                      help_text="95th percentile of the response time of the recent checks "
+                                                "in milliseconds.")
+    samples = ListField(editable=False)  # Response times of the recent checks, None for the failed ones
+    consecutive_failures = models.IntegerField(default=0)
+    consecutive_successes = models.IntegerField(default=0)
+    last_error = models.CharField(max_length=250, blank=True)
+    last_checked_on = models.DateTimeField(blank=True, null=True)
+    down_since = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name_plural = 'Origins health'
+
+    def __unicode__(self):
+        return self.url
+
+
 @receiver(post_syncdb)
 def create_text_index_on_tags_and_groups(sender, **kwargs):
     from pymongo import MongoClient
@@ -568,3 +662,157 @@ def create_text_index_on_tags_and_groups(sender, **kwargs):
     db = client[db_name]
     db.movies_movie.create_index([('tags', 'text'), ('groups', 'text')])
     db.movies_series.create_index([('tags', 'text'), ('groups', 'text')])
+
+
+@receiver(post_save, sender=SeriesEpisode)
+@receiver(post_delete, sender=SeriesEpisode)
+def update_series_episodes_aggregates(sender, instance, **kwargs):
+    """
+    Keeps the aggregate fields of the Series in sync with its episodes.
+    """
+    using = kwargs.get('using', 'default')
+    try:
+        series = Series.objects.using(using).get(pk=instance.series_id)
+    except Series.DoesNotExist:
+        return
+    series.refresh_episodes_aggregates(using=using)
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+@receiver(post_save, sender=Series)
+@receiver(post_delete, sender=Series)
+@receiver(post_save, sender=SeriesEpisode)
+@receiver(post_delete, sender=SeriesEpisode)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_catalog_snapshot(sender, **kwargs):
+    """
+    Outdates the in-memory catalog snapshots, unless only counters
+    that do not appear in listings were saved.
+    """
+    if kwargs.get('using', 'default') != 'default':
+        return
+    update_fields = kwargs.get('update_fields')
+    if update_fields and set(update_fields) <= set(LISTING_INDEPENDENT_FIELDS):
+        return
+    from ikwen_shavida.movies.catalog import invalidate_catalog
+    invalidate_catalog()
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+@receiver(post_save, sender=Series)
+@receiver(post_delete, sender=Series)
+def update_search_index_entry(sender, instance, **kwargs):
+    """
+    Applies the change of the media to the search index.
+    """
+    if kwargs.get('using', 'default') != 'default':
+        return
+    update_fields = kwargs.get('update_fields')
+    if update_fields and set(update_fields) <= set(LISTING_INDEPENDENT_FIELDS):
+        return
+    from ikwen_shavida.movies.search import update_search_index
+    update_search_index(instance, deleted=kwargs.get('signal') == post_delete)
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+@receiver(post_save, sender=Series)
+@receiver(post_delete, sender=Series)
+def refresh_related_media_around(sender, instance, **kwargs):
+    """
+    Refreshes the related media of the media and of its neighbors.
+    """
+    if kwargs.get('using', 'default') != 'default':
+        return
+    if kwargs.get('signal') != post_delete:
+        if not getattr(instance, '_related_sources_changed', False):
+            return
+        del instance._related_sources_changed
+    from ikwen_shavida.movies.related import refresh_related_media_async
+    refresh_related_media_async(instance)
+
+
+@receiver(pre_save, sender=Movie)
+@receiver(pre_save, sender=Series)
+def remember_stored_state(sender, instance, **kwargs):
+    """
+    Reads once the fields of the stored media that post_save receivers compare with the new ones. It keeps
+    the keys of the MediaCounter the stored media counts in and whether the fields related media are
+    computed from change with this save.
+    """
+    if kwargs.get('using', 'default') != 'default':
+        return
+    from ikwen_shavida.movies.counters import COUNTED_FIELDS, get_counter_keys
+    from ikwen_shavida.movies.related import RELATED_SOURCE_FIELDS, get_related_sources
+    update_fields = kwargs.get('update_fields')
+    counted = not update_fields or set(update_fields) & set(COUNTED_FIELDS)
+    related = not update_fields or set(update_fields) & set(RELATED_SOURCE_FIELDS)
+    if not (counted or related):
+        return
+    fields = set()
+    if counted:
+        fields.update(COUNTED_FIELDS)
+    if related:
+        fields.update(RELATED_SOURCE_FIELDS)
+    previous = None
+    if instance.pk:
+        try:
+            previous = sender.objects.only(*fields).get(pk=instance.pk)
+        except sender.DoesNotExist:
+            pass
+    if counted:
+        instance._previous_counter_keys = get_counter_keys(previous)
+    if related:
+        instance._related_sources_changed = previous is None or \
+            get_related_sources(previous) != get_related_sources(instance)
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+@receiver(post_save, sender=Series)
+@receiver(post_delete, sender=Series)
+def update_media_counters(sender, instance, **kwargs):
+    """
+    Applies the change of the media to the MediaCounter of the categories it enters or leaves.
+    """
+    if kwargs.get('using', 'default') != 'default':
+        return
+    from ikwen_shavida.movies.counters import get_counter_keys, apply_media_change
+    if kwargs.get('signal') == post_delete:
+        apply_media_change(instance.type, get_counter_keys(instance), set())
+    elif hasattr(instance, '_previous_counter_keys'):
+        apply_media_change(instance.type, instance._previous_counter_keys, get_counter_keys(instance))
+        del instance._previous_counter_keys
+
+
+@receiver(post_delete, sender=Category)
+def delete_category_counter(sender, instance, **kwargs):
+    if kwargs.get('using', 'default') != 'default':
+        return
+    from ikwen_shavida.movies.counters import delete_counter
+    delete_counter(instance.id)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_categories(sender, **kwargs):
+    """
+    Outdates the in-memory category registries.
+    """
+    if kwargs.get('using', 'default') != 'default':
+        return
+    from ikwen_shavida.movies.categories import invalidate_category_registry
+    invalidate_category_registry()
+
+
+@receiver(post_save, sender=Member)
+def clear_member_display_data(sender, instance, **kwargs):
+    """
+    Drops the cached display data of the Member used to show media owners.
+    """
+    from django.core.cache import cache
+    from ikwen_shavida.movies.utils import MEMBER_DISPLAY_CACHE_KEY_PREFIX
+    cache.delete(MEMBER_DISPLAY_CACHE_KEY_PREFIX + instance.id)
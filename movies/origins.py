@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Lookup of the origin server (data source) to stream a media from.
+
+Each process playing media runs a monitor thread which checks the sources
+of OperatorProfile.data_sources every ORIGIN_HEALTH_CHECK_INTERVAL seconds
+and records their liveness, error rate and latency percentiles in
+OriginHealth. A source is marked down after FAILURES_TO_DOWN failed checks
+in a row and up again after SUCCESSES_TO_UP successful ones. The command
+check_origins runs the same checks from a cron.
+
+The play path then takes, among the sources up where the media is not
+known to be missing, the one with the fewest active stream sessions per
+unit of weight (see movies.stream_sessions), the healthiest and fastest
+first on ties. Probe results are cached per media, source and device class:
+a source known to have the media is used without waiting for any request,
+one known to lack it is skipped. Otherwise the media is probed there before
+the source is used, and the next one is tried if it is not found before
+ORIGIN_PROBE_TIMEOUT. As long as no source was checked yet, or when they
+are all down, the sources are probed concurrently on a thread pool shared
+by the process, over a pooled HTTP session: the first one in order where
+the media is found before ORIGIN_PROBE_TIMEOUT is used.
+"""
+import hashlib
+import logging
+import time
+from datetime import timedelta
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from threading import Lock, Thread
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.module_loading import import_by_path
+
+from ikwen_shavida.movies.models import OriginHealth
+from ikwen_shavida.movies.stream_sessions import get_active_sessions, get_origin_weight
+from ikwen_shavida.movies.utils import get_device
+
+__author__ = "Kom Sihon"
+
+logger = logging.getLogger('ikwen')
+
+PROBE_CACHE_KEY_PREFIX = 'origin_probe:'
+PROBE_FOUND_TIMEOUT = 5 * 60
+PROBE_NOT_FOUND_TIMEOUT = 30
+FOUND_STATUS_CODES = (200, 301, 302)
+
+ORIGIN_HEALTH_KEY = 'origin_health'
+HEALTH_WINDOW = 20  # Number of recent checks error rate and latencies are computed on
+FAILURES_TO_DOWN = 3
+SUCCESSES_TO_UP = 2
+ERROR_RATE_STEP = 0.1  # Sources which error rates round to the same step are ranked by latency
+
+_lock = Lock()
+_state = {'pool': None, 'session': None, 'url_maker': None, 'monitor': None, 'watched': set()}
+
+
+def get_url_maker():
+    """
+    Function building the URL of a media on a source, resolved from MAKE_MEDIA_URL once per process.
+    """
+    path = getattr(settings, 'MAKE_MEDIA_URL', 'ikwen_shavida.movies.views.make_media_url')
+    url_maker = _state['url_maker']
+    if url_maker is None or url_maker[0] != path:
+        url_maker = (path, import_by_path(path))
+        _state['url_maker'] = url_maker
+    return url_maker[1]
+
+
+def _get_pool():
+    with _lock:
+        if _state['pool'] is None:
+            pool_size = getattr(settings, 'ORIGIN_PROBE_POOL_SIZE', 10)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _state['session'] = session
+            _state['pool'] = ThreadPool(pool_size)
+        return _state['pool']
+
+
+def _get_probe_key(media, folder, device):
+    source_hash = hashlib.md5(folder.encode('utf8')).hexdigest()
+    return PROBE_CACHE_KEY_PREFIX + '%s:%s:%s:%s' % (type(media).__name__, media.id, source_hash, device)
+
+
+def _probe(item_url, key):
+    """
+    Checks whether item_url can be read and caches the result under key.
+    """
+    timeout = getattr(settings, 'ORIGIN_PROBE_TIMEOUT', 3)
+    try:
+        status_code = _state['session'].head(item_url, timeout=timeout).status_code
+    except:
+        logger.error("Failed to access video %s" % item_url, exc_info=True)
+        found = False
+    else:
+        found = status_code in FOUND_STATUS_CODES
+        if not found:
+            logger.debug("Could not read video %s. Error code: %s" % (item_url, status_code))
+    cache.set(key, found, PROBE_FOUND_TIMEOUT if found else PROBE_NOT_FOUND_TIMEOUT)
+    return found
+
+
+def is_found_cached(request, media, folder):
+    """
+    Tells whether media was found on folder by a probe which result is still cached.
+    """
+    return cache.get(_get_probe_key(media, folder, get_device(request))) is True
+
+
+def _percentile(values, share):
+    values = sorted(values)
+    return values[int(round(share * (len(values) - 1)))]
+
+
+def check_origin(url):
+    """
+    Sends a HEAD request to the root of a source. Any response below 500 means it is alive.
+    :return: tuple (latency, error): latency in milliseconds, None if the check failed
+    """
+    _get_pool()
+    timeout = getattr(settings, 'ORIGIN_PROBE_TIMEOUT', 3)
+    start = time.time()
+    try:
+        status_code = _state['session'].head(url, timeout=timeout, allow_redirects=False).status_code
+    except Exception as e:
+        return None, ('%s' % e)[:250]
+    if status_code >= 500:
+        return None, 'HTTP %d' % status_code
+    return int((time.time() - start) * 1000), ''
+
+
+def record_check(url, latency, error=''):
+    """
+    Adds the result of a check to the OriginHealth of url, marking the source down or up again when needed.
+    """
+    try:
+        health = OriginHealth.objects.get(url=url)
+    except OriginHealth.DoesNotExist:
+        health = OriginHealth(url=url)
+    health.samples = (list(health.samples) + [latency])[-HEALTH_WINDOW:]
+    latencies = [sample for sample in health.samples if sample is not None]
+    health.error_rate = 1 - float(len(latencies)) / len(health.samples)
+    health.p50_latency = _percentile(latencies, 0.5) if latencies else None
+    health.p95_latency = _percentile(latencies, 0.95) if latencies else None
+    health.last_checked_on = timezone.now()
+    if latency is None:
+        health.consecutive_failures += 1
+        health.consecutive_successes = 0
+        health.last_error = error
+        if health.is_up and health.consecutive_failures >= FAILURES_TO_DOWN:
+            health.is_up = False
+            health.down_since = health.last_checked_on
+            logger.error("Origin %s marked down: %s" % (url, error))
+    else:
+        health.consecutive_successes += 1
+        health.consecutive_failures = 0
+        if not health.is_up and health.consecutive_successes >= SUCCESSES_TO_UP:
+            health.is_up = True
+            health.down_since = None
+            logger.info("Origin %s is up again" % url)
+    health.save()
+    return health
+
+
+def publish_origin_health():
+    """
+    Caches the health of all the sources, as read by the play path.
+    :return: dict {url: (is_up, error_rate, p50_latency)}
+    """
+    health = dict([(origin.url, (origin.is_up, origin.error_rate, origin.p50_latency))
+                   for origin in OriginHealth.objects.all()])
+    cache.set(ORIGIN_HEALTH_KEY, health, None)
+    return health
+
+
+def get_origin_health():
+    """
+    :return: dict {url: (is_up, error_rate, p50_latency)} of the sources checked so far
+    """
+    health = cache.get(ORIGIN_HEALTH_KEY)
+    if health is None:
+        health = publish_origin_health()
+    return health
+
+
+def check_origins_health(urls):
+    """
+    Checks urls concurrently, records the results and publishes the new health of sources.
+    """
+    results = _get_pool().map(check_origin, urls)
+    for url, (latency, error) in zip(urls, results):
+        record_check(url, latency, error)
+    return publish_origin_health()
+
+
+def _monitor():
+    while True:
+        interval = getattr(settings, 'ORIGIN_HEALTH_CHECK_INTERVAL', 30)
+        with _lock:
+            urls = list(_state['watched'])
+        try:
+            # Sources just checked by the monitor of another process are skipped
+            threshold = timezone.now() - timedelta(seconds=interval / 2)
+            fresh = set([origin.url for origin in OriginHealth.objects.filter(url__in=urls,
+                                                                             last_checked_on__gte=threshold)])
+            urls = [url for url in urls if url not in fresh]
+            if urls:
+                check_origins_health(urls)
+        except:
+            logger.error("Failed to check health of origins", exc_info=True)
+        time.sleep(interval)
+
+
+def watch_origins(sources):
+    """
+    Adds sources to those checked by the monitor thread of the process, started at first call.
+    """
+    urls = set([folder.strip() for folder in sources if folder.strip()])
+    with _lock:
+        _state['watched'].update(urls)
+        monitor = _state['monitor']
+        if monitor is None or not monitor.is_alive():
+            monitor = Thread(target=_monitor)
+            monitor.daemon = True
+            monitor.start()
+            _state['monitor'] = monitor
+
+
+def rank_sources(sources, health=None):
+    """
+    :return: sources not marked down, most reliable first, then fastest first. Sources never
+        checked come after the checked ones. Sources ranked equal keep their order.
+    """
+    if health is None:
+        health = get_origin_health()
+    ranked = []
+    for i, folder in enumerate(sources):
+        state = health.get(folder.strip())
+        if state is None:
+            rank = (1, 0, 0, i)
+        else:
+            is_up, error_rate, p50_latency = state
+            if not is_up:
+                continue
+            rank = (0, int(round(error_rate / ERROR_RATE_STEP)), p50_latency or 0, i)
+        ranked.append((rank, folder))
+    ranked.sort()
+    return [folder for rank, folder in ranked]
+
+
+def find_media_url(request, media, sources, *args, **kwargs):
+    """
+    Gets the URL of media on the best of sources where it is not known to be missing.
+    See the module docstring for how it is chosen.
+    :return: tuple (item_url, folder, found). item_url and folder are the ones of the
+        last source if media is found on none of them.
+    """
+    watch_origins(sources)
+    health = get_origin_health()
+    ranked = rank_sources(sources, health)
+    url_maker = get_url_maker()
+    device = get_device(request)
+    candidates = []
+    for folder in ranked or sources:
+        item_url = url_maker(request, folder, media, *args, **kwargs)
+        candidates.append((folder, item_url, _get_probe_key(media, folder, device)))
+    cached = cache.get_many([key for folder, item_url, key in candidates])
+    if ranked and ranked[0].strip() in health:
+        available = [candidate for candidate in candidates if cached.get(candidate[2]) is not False]
+        sessions = get_active_sessions([folder for folder, item_url, key in available])
+        # Sort is stable: sources as loaded keep the order of their health
+        available.sort(key=lambda candidate: float(sessions[candidate[0]]) / get_origin_weight(candidate[0]))
+        deadline = time.time() + getattr(settings, 'ORIGIN_PROBE_TIMEOUT', 3)
+        for folder, item_url, key in available:
+            if cached.get(key):
+                return item_url, folder, True
+            try:
+                if _get_pool().apply_async(_probe, (item_url, key)).get(max(deadline - time.time(), 0)):
+                    return item_url, folder, True
+            except TimeoutError:
+                logger.debug("Probing video %s timed out" % item_url)
+        folder, item_url, key = candidates[-1]
+        return item_url, folder, False
+    results = []
+    for folder, item_url, key in candidates:
+        if key in cached:
+            results.append(cached[key])
+        else:
+            results.append(_get_pool().apply_async(_probe, (item_url, key)))
+    deadline = time.time() + getattr(settings, 'ORIGIN_PROBE_TIMEOUT', 3)
+    for (folder, item_url, key), result in zip(candidates, results):
+        if not isinstance(result, bool):
+            try:
+                result = result.get(max(deadline - time.time(), 0))
+            except TimeoutError:
+                logger.debug("Probing video %s timed out" % item_url)
+                result = False
+        if result:
+            return item_url, folder, True
+    folder, item_url, key = candidates[-1]
+    return item_url, folder, False
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Full-page cache of the catalog pages served to anonymous visitors. Pages
+vary by device (mobile, tablet or desktop), language, currency chosen in the
+session and _escaped_fragment_ only, so that links shared with tracking
+parameters hit the same entry.
+Authenticated members always get a fresh page.
+
+Keys embed the versions of the catalog snapshot and of the category
+registry, so that saving media or categories outdates all the pages at once.
+The CSRF token of the visitor who filled the cache is replaced by a
+placeholder and each visitor gets their own one back.
+"""
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.utils.translation import get_language
+
+from ikwen_shavida.movies.catalog import CATALOG_VERSION_KEY
+from ikwen_shavida.movies.categories import CATEGORY_REGISTRY_VERSION_KEY
+from ikwen_shavida.movies.utils import get_device
+
+__author__ = "Kom Sihon"
+
+PAGE_CACHE_KEY_PREFIX = 'anonymous_page:'
+PAGE_CACHE_TIMEOUT = 60 * 5
+CSRF_TOKEN_PLACEHOLDER = '__csrf_token_placeholder__'
+
+
+def _get_currency_code(request):
+    """
+    Code of the currency the currencies context processor renders prices in for request.
+    """
+    currency = request.session.get(getattr(settings, 'CURRENCY_SESSION_KEY', 'currency'))
+    return getattr(currency, 'code', currency) or ''
+
+
+def get_page_cache_key(request):
+    versions = cache.get_many([CATALOG_VERSION_KEY, CATEGORY_REGISTRY_VERSION_KEY])
+    parts = [request.path, get_device(request), get_language() or '', _get_currency_code(request),
+             request.GET.get('_escaped_fragment_', ''),
+             versions.get(CATALOG_VERSION_KEY), versions.get(CATEGORY_REGISTRY_VERSION_KEY)]
+    raw_key = u'|'.join([u'%s' % part for part in parts])
+    return PAGE_CACHE_KEY_PREFIX + hashlib.md5(raw_key.encode('utf8')).hexdigest()
+
+
+def anonymous_cache_page(timeout=PAGE_CACHE_TIMEOUT):
+    """
+    Decorator caching the responses of a view served to anonymous visitors.
+    Responses other than 200 and pages showing messages are not cached.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapped_view(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or request.user.is_authenticated():
+                return view_func(request, *args, **kwargs)
+            key = get_page_cache_key(request)
+            cached = cache.get(key)
+            if cached is not None:
+                content, content_type = cached
+                if CSRF_TOKEN_PLACEHOLDER in content:
+                    content = content.replace(CSRF_TOKEN_PLACEHOLDER, get_token(request))
+                response = HttpResponse(content, content_type)
+                response['X-Page-Cache'] = 'hit'
+                return response
+            response = view_func(request, *args, **kwargs)
+            if callable(getattr(response, 'render', None)):
+                response = response.render()
+            if response.status_code == 200 and not len(get_messages(request)):
+                content = response.content
+                token = request.META.get('CSRF_COOKIE')
+                if token:
+                    content = content.replace(token, CSRF_TOKEN_PLACEHOLDER)
+                cache.set(key, (content, response['Content-Type']), timeout)
+                response['X-Page-Cache'] = 'miss'
+            return response
+        return _wrapped_view
+    return decorator
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Short-lived play tokens minted by stream_or_download() once it authorized
+a member to play a media. A token is an HMAC of the member, media, action
+(stream or download), device class, expiry and revocation generation of the
+member. It expires after PLAY_TOKEN_TIMEOUT, or earlier along with the
+prepayment that granted access to the media. It is sent back by
+the player on follow-up requests (resume, replay, download redirect), which
+are then answered from the authorization cached along with the token: no
+media, prepayment or bundle is read again and the sources are not probed.
+
+revoke_play_tokens() bumps the generation of the member, which invalidates
+all their tokens. It is called when their balance runs out.
+"""
+import hashlib
+import hmac
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+
+__author__ = "Kom Sihon"
+
+PLAY_TOKEN_TIMEOUT = 2 * 3600
+PLAY_AUTHORIZATION_KEY_PREFIX = 'play_authorization:'
+PLAY_TOKEN_GENERATION_KEY_PREFIX = 'play_token_generation:'
+
+
+def _sign(member, media_type, media_id, action, device, expires, generation):
+    secret = getattr(settings, 'PLAY_TOKEN_SECRET', settings.SECRET_KEY)
+    payload = '%s:%s:%s:%s:%s:%d:%d' % (member.id, media_type, media_id, action, device, expires, generation)
+    return hmac.new(str(secret), payload, hashlib.sha256).hexdigest()
+
+
+def mint_play_token(member, media_type, media_id, action, device, authorization, expiry=None):
+    """
+    Creates a play token of member for action on the media on device.
+    :param authorization: JSON-serializable response given to the player, returned as is for valid tokens
+    :param expiry: datetime of expiry of the prepayment giving access to the media, if any
+    """
+    generation = cache.get(PLAY_TOKEN_GENERATION_KEY_PREFIX + member.id, 0)
+    now = int(time.time())
+    expires = now + PLAY_TOKEN_TIMEOUT
+    if expiry:
+        expires = min(expires, now + int((expiry - datetime.now()).total_seconds()))
+    signature = _sign(member, media_type, media_id, action, device, expires, generation)
+    cache.set(PLAY_AUTHORIZATION_KEY_PREFIX + signature, authorization, max(expires - now, 1))
+    return '%d.%d.%s' % (expires, generation, signature)
+
+
+def get_play_authorization(token, member, media_type, media_id, action, device):
+    """
+    :return: the authorization minted along with token, or None if the token is invalid,
+        expired, revoked or was not minted for that member, media, action and device.
+    """
+    try:
+        expires, generation, signature = token.split('.')
+        expires, generation = int(expires), int(generation)
+    except ValueError:
+        return None
+    if expires < time.time():
+        return None
+    expected = _sign(member, media_type, media_id, action, device, expires, generation)
+    if not hmac.compare_digest(str(signature), expected):
+        return None
+    generation_key = PLAY_TOKEN_GENERATION_KEY_PREFIX + member.id
+    authorization_key = PLAY_AUTHORIZATION_KEY_PREFIX + signature
+    values = cache.get_many([generation_key, authorization_key])
+    if values.get(generation_key, 0) != generation:
+        return None
+    return values.get(authorization_key)
+
+
+def revoke_play_tokens(member):
+    """
+    Invalidates all the play tokens of member.
+    """
+    try:
+        cache.incr(PLAY_TOKEN_GENERATION_KEY_PREFIX + member.id)
+    except ValueError:
+        cache.set(PLAY_TOKEN_GENERATION_KEY_PREFIX + member.id, 1, None)
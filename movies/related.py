@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Content-based similarity of media. Each movie or series is described by a
+TF-IDF vector of the words of its groups, tags and synopsis and of its
+categories. The ids of its most similar media of the same type by cosine
+similarity are stored in its related_ids field, so that detail pages
+serve their suggestions without running any query.
+
+related_ids of all media are computed by the command build_related_media,
+which also saves the vectors and the IDF it computed as JSON in the folder
+set by RELATED_MODEL_DIR.
+Each process loads those once, then keeps its copy current incrementally:
+when the fields a vector is made of change on a media, a background thread
+revectorizes that media and its neighborhood with the IDF of the build and
+refreshes their related_ids. Terms unknown to that IDF are ignored until
+the next build. Vectors are sparse dicts rather than NumPy matrices, which
+are not among the dependencies.
+"""
+import heapq
+import json
+import logging
+import math
+import os
+from threading import Lock, Thread
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from ikwen_shavida.movies.catalog import get_catalog
+from ikwen_shavida.movies.search import tokenize
+
+__author__ = "Kom Sihon"
+
+logger = logging.getLogger('ikwen')
+
+RELATED_COUNT = 10
+
+# Weight of each occurrence of a term depending on the field it comes from
+FIELD_WEIGHTS = (('groups', 3), ('tags', 2), ('categories', 2), ('synopsis', 1))
+
+# Terms found in more than this share of the media are too common to tell them apart.
+# They are only dropped above MIN_PRUNED_DOCUMENT_FREQUENCY media, so that small catalogs keep them.
+MAX_DOCUMENT_FREQUENCY = 0.2
+MIN_PRUNED_DOCUMENT_FREQUENCY = 100
+
+# Fields which change causes related_ids to be refreshed
+RELATED_SOURCE_FIELDS = ('groups', 'tags', 'categories', 'synopsis', 'visible')
+
+# Fields loaded to compute vectors and related_ids, leaving out the history lists of media
+VECTOR_FIELDS = ('id', 'visible', 'groups', 'tags', 'categories', 'synopsis', 'related_ids')
+
+_models_lock = Lock()
+_models = {}  # {(model, using): (file stamp, RelatedModel)}
+_refresh_lock = Lock()
+_refresh_state = {'running': False, 'pending': {}}
+
+
+def get_related_sources(media):
+    """
+    :return: tuple of the values of RELATED_SOURCE_FIELDS of media, to tell whether they changed
+    """
+    values = []
+    for field in RELATED_SOURCE_FIELDS:
+        if field == 'categories':
+            values.append(tuple([category.id for category in media.categories]))
+        else:
+            values.append(getattr(media, field))
+    return tuple(values)
+
+
+def get_terms(media):
+    """
+    :return: dict {term: weighted count of the term in media}
+    """
+    terms = {}
+    for field, weight in FIELD_WEIGHTS:
+        if field == 'categories':
+            words = ['category:%s' % category.id for category in media.categories]
+        else:
+            words = tokenize(getattr(media, field))
+        for word in words:
+            terms[word] = terms.get(word, 0) + weight
+    return terms
+
+
+class RelatedModel(object):
+    """
+    TF-IDF vectors of a list of media, normalized so that the
+    dot product of two of them is their cosine similarity.
+    """
+
+    def __init__(self, media_list=()):
+        terms_by_id = dict([(media.id, get_terms(media)) for media in media_list])
+        document_frequency = {}
+        for terms in terms_by_id.values():
+            for term in terms:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        count = len(terms_by_id)
+        max_frequency = max(MAX_DOCUMENT_FREQUENCY * count, MIN_PRUNED_DOCUMENT_FREQUENCY)
+        self.idf = dict([(term, math.log((1.0 + count) / (1 + frequency)) + 1)
+                         for term, frequency in document_frequency.items() if frequency <= max_frequency])
+        self.vectors = {}
+        self.postings = {}  # {term: {media_id: weight}}
+        for media_id, terms in terms_by_id.items():
+            self._add(media_id, self._vectorize(terms))
+
+    def to_dict(self):
+        return {'idf': self.idf, 'vectors': self.vectors}
+
+    @classmethod
+    def from_dict(cls, values):
+        related_model = cls()
+        related_model.idf = values['idf']
+        for media_id, vector in values['vectors'].items():
+            related_model._add(media_id, vector)
+        return related_model
+
+    def _add(self, media_id, vector):
+        self.vectors[media_id] = vector
+        for term, weight in vector.items():
+            self.postings.setdefault(term, {})[media_id] = weight
+
+    def remove(self, media_id):
+        vector = self.vectors.pop(media_id, {})
+        for term in vector:
+            del self.postings[term][media_id]
+
+    def update(self, media):
+        """
+        Computes again the vector of media with the current IDF.
+        """
+        self.remove(media.id)
+        self._add(media.id, self._vectorize(get_terms(media)))
+
+    def _vectorize(self, terms):
+        vector = dict([(term, (1 + math.log(frequency)) * self.idf[term])
+                       for term, frequency in terms.items() if term in self.idf])
+        norm = math.sqrt(sum([weight * weight for weight in vector.values()]))
+        if norm:
+            for term in vector:
+                vector[term] /= norm
+        return vector
+
+    def get_neighbors(self, media_id, count=RELATED_COUNT):
+        """
+        Ids of the count media most similar to media_id, most similar first.
+        Only media sharing at least a term with it are looked at.
+        """
+        vector = self.vectors.get(media_id)
+        if not vector:
+            return []
+        scores = {}
+        for term, weight in vector.items():
+            for other_id, other_weight in self.postings[term].items():
+                if other_id != media_id:
+                    scores[other_id] = scores.get(other_id, 0) + weight * other_weight
+        return heapq.nlargest(count, scores, key=lambda pk: (scores[pk], pk))
+
+
+def _save_related_ids(model, media, related_ids, using):
+    if related_ids != list(media.related_ids):
+        # update() rather than save() to not trigger the signals of the model
+        model.objects.using(using).filter(pk=media.id).update(related_ids=related_ids)
+
+
+def _get_model_path(model, using):
+    model_dir = getattr(settings, 'RELATED_MODEL_DIR', None)
+    if not model_dir:
+        raise ImproperlyConfigured("RELATED_MODEL_DIR must be set to a folder of the project")
+    return os.path.join(model_dir, '%s.%s.json' % (using, model.__name__.lower()))
+
+
+def _get_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime
+
+
+def _write_related_model(path, related_model):
+    model_dir = os.path.dirname(path)
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as fh:
+        json.dump(related_model.to_dict(), fh)
+    os.rename(tmp_path, path)
+
+
+def get_related_model(model, using='default'):
+    """
+    Gets the RelatedModel of model kept by this process. It is loaded from the file saved by the
+    last build, and loaded again when a new build is saved. It is built from the database if no
+    build was saved yet.
+    """
+    path = _get_model_path(model, using)
+    stamp = _get_stamp(path)
+    with _models_lock:
+        loaded_stamp, related_model = _models.get((model, using), (None, None))
+        if related_model is None or (stamp and stamp != loaded_stamp):
+            if stamp:
+                with open(path) as fh:
+                    related_model = RelatedModel.from_dict(json.load(fh))
+            else:
+                related_model = RelatedModel(model.objects.using(using).filter(visible=True).only(*VECTOR_FIELDS))
+            _models[(model, using)] = (stamp, related_model)
+    return related_model
+
+
+def build_related_media(model, using='default'):
+    """
+    Computes the related_ids of all visible media of model (Movie or Series),
+    then saves the vectors for processes to refresh them incrementally.
+    :return: number of media processed
+    """
+    media_list = list(model.objects.using(using).filter(visible=True).only(*VECTOR_FIELDS))
+    related_model = RelatedModel(media_list)
+    for media in media_list:
+        _save_related_ids(model, media, related_model.get_neighbors(media.id), using)
+    _write_related_model(_get_model_path(model, using), related_model)
+    return len(media_list)
+
+
+def refresh_related_media(model, media_ids, using='default'):
+    """
+    Revectorizes the given media of model, then recomputes their related_ids,
+    those of their neighbors and those of the media which listed them as related.
+    Vectors of these last ones are computed again as well, in case they changed
+    in another process.
+    """
+    related_model = get_related_model(model, using)
+    media_ids = set(media_ids)
+    queryset = model.objects.using(using).only(*VECTOR_FIELDS)
+    changed_list = [media for media in queryset.filter(pk__in=list(media_ids)) if media.visible]
+    changed_ids = set([media.id for media in changed_list])
+    for media in changed_list:
+        related_model.update(media)
+    for media_id in media_ids - changed_ids:
+        related_model.remove(media_id)
+    neighbor_ids = set()
+    for media_id in changed_ids:
+        neighbor_ids.update(related_model.get_neighbors(media_id))
+    affected = dict([(media.id, media) for media in changed_list])
+    for media in queryset.filter(pk__in=list(neighbor_ids - changed_ids)):
+        affected[media.id] = media
+    for media in queryset.filter(related_ids__in=list(media_ids)):
+        affected.setdefault(media.id, media)
+    for media in affected.values():
+        if media.id in changed_ids:
+            continue
+        if media.visible:
+            related_model.update(media)
+        else:
+            related_model.remove(media.id)
+    for media in affected.values():
+        if media.visible:
+            _save_related_ids(model, media, related_model.get_neighbors(media.id), using)
+
+
+def _refresh():
+    while True:
+        with _refresh_lock:
+            pending = _refresh_state['pending']
+            if not pending:
+                _refresh_state['running'] = False
+                return
+            _refresh_state['pending'] = {}
+        for model, media_ids in pending.items():
+            try:
+                refresh_related_media(model, media_ids)
+            except:
+                logger.error("Failed to refresh related %s" % model._meta.verbose_name_plural, exc_info=True)
+
+
+def refresh_related_media_async(media):
+    """
+    Refreshes the related_ids around media in a background thread. Media saved
+    while a refresh is running are refreshed together in the next run.
+    """
+    with _refresh_lock:
+        _refresh_state['pending'].setdefault(type(media), set()).add(media.id)
+        if _refresh_state['running']:
+            return
+        _refresh_state['running'] = True
+    thread = Thread(target=_refresh)
+    thread.daemon = True
+    thread.start()
+
+
+def get_suggested_ids(media, count):
+    """
+    Ids of visible media to suggest along with media: its related media, completed
+    if needed with the most recent media of its categories.
+    """
+    catalog = get_catalog()
+    if media.type == 'movie':
+        get_ids = catalog.get_movie_ids
+    else:
+        get_ids = catalog.get_series_ids
+    suggested_ids = [pk for pk in media.related_ids if catalog.get(pk)][:count]
+    if len(suggested_ids) < count:
+        excluded_ids = set(suggested_ids)
+        excluded_ids.add(media.id)
+        candidate_ids = set()
+        for category in media.categories:
+            candidate_ids.update(get_ids(category.id))
+        candidate_ids -= excluded_ids
+        suggested_ids.extend(sorted(candidate_ids, reverse=True)[:count - len(suggested_ids)])
+    return suggested_ids
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory search index of the visible movies and series of the process,
+built from their title, tags and groups normalized with the same rules as
+the tags (movies.utils.remove_special_words).
+
+Each word of a query matches the indexed tokens that are equal to it,
+that start with it (autocomplete), or that are close enough to it in
+trigrams (typo tolerance). Media are ranked by how well they match, then
+by popularity. Adult media are kept in a separate set of ids, so that they
+are filtered out while collecting the results.
+
+The index is updated incrementally upon save of a media in the process
+where it happens. Other processes see the version shared through the cache
+change and reload their index at next use.
+"""
+import heapq
+from threading import Lock
+
+from django.core.cache import cache
+from django.template.defaultfilters import slugify
+
+from ikwen_shavida.movies.models import Movie, Series
+from ikwen_shavida.movies.utils import remove_special_words
+
+__author__ = "Kom Sihon"
+
+SEARCH_INDEX_VERSION_KEY = 'search_index_version'
+
+MIN_PREFIX_LENGTH = 2
+MAX_PREFIX_LENGTH = 8
+FUZZY_MIN_LENGTH = 4  # Shorter words are not looked up for typos
+FUZZY_MIN_SIMILARITY = 0.5
+
+# Weight of a word of the query in the score of a media, depending on how it matches
+EXACT_MATCH = 1.0
+PREFIX_MATCH = 0.75
+FUZZY_MATCH = 0.5  # Multiplied by the similarity of the trigrams
+
+_index = None
+_lock = Lock()
+
+
+def tokenize(text):
+    """
+    Splits a text into normalized words: lowercase, stripped of accents,
+    punctuation and the special words removed from the tags.
+    """
+    if not text:
+        return []
+    text = remove_special_words(text.lower())
+    return [token for token in slugify(text).split('-') if len(token) >= MIN_PREFIX_LENGTH]
+
+
+def get_trigrams(token):
+    padded = '$%s$' % token
+    return set([padded[i:i + 3] for i in range(len(padded) - 2)])
+
+
+def get_popularity(media):
+    if isinstance(media, Series):
+        return media.first_episode_fake_clicks or 0
+    return media.fake_clicks
+
+
+class SearchIndex(object):
+    """
+    Inverted index of tokens to ids of media, with the prefixes and trigrams
+    of the tokens. Writes are serialized by a lock; reads only use atomic
+    operations on the sets, so they do not need it.
+    """
+
+    def __init__(self, version=None):
+        self.version = version
+        self.entries = {}  # {media_id: (tokens, popularity)}
+        self.postings = {}  # {token: set of media ids}
+        self.prefixes = {}  # {prefix: set of tokens}
+        self.trigrams = {}  # {trigram: set of tokens}
+        self.adult_ids = set()
+        self._lock = Lock()
+
+    @classmethod
+    def load(cls, version=None):
+        index = cls(version)
+        for media in Movie.objects.filter(visible=True):
+            index.add(media)
+        for media in Series.objects.filter(visible=True):
+            index.add(media)
+        return index
+
+    def add(self, media):
+        """
+        Indexes the media or refreshes its entry. Invisible media are removed from the index.
+        """
+        with self._lock:
+            self._remove(media.id)
+            if not media.visible:
+                return
+            tokens = set(tokenize(media.title))
+            tokens.update(tokenize(media.tags))
+            tokens.update(tokenize(media.groups))
+            self.entries[media.id] = (tokens, get_popularity(media))
+            if media.is_adult:
+                self.adult_ids.add(media.id)
+            for token in tokens:
+                if token not in self.postings:
+                    self.postings[token] = set()
+                    for i in range(MIN_PREFIX_LENGTH, min(len(token), MAX_PREFIX_LENGTH) + 1):
+                        self.prefixes.setdefault(token[:i], set()).add(token)
+                    for trigram in get_trigrams(token):
+                        self.trigrams.setdefault(trigram, set()).add(token)
+                self.postings[token].add(media.id)
+
+    def remove(self, media_id):
+        with self._lock:
+            self._remove(media_id)
+
+    def _remove(self, media_id):
+        entry = self.entries.pop(media_id, None)
+        if not entry:
+            return
+        self.adult_ids.discard(media_id)
+        for token in entry[0]:
+            ids = self.postings[token]
+            ids.discard(media_id)
+            if ids:
+                continue
+            del self.postings[token]
+            for i in range(MIN_PREFIX_LENGTH, min(len(token), MAX_PREFIX_LENGTH) + 1):
+                tokens = self.prefixes[token[:i]]
+                tokens.discard(token)
+                if not tokens:
+                    del self.prefixes[token[:i]]
+            for trigram in get_trigrams(token):
+                tokens = self.trigrams[trigram]
+                tokens.discard(token)
+                if not tokens:
+                    del self.trigrams[trigram]
+
+    def _match_word(self, word):
+        """
+        :return: dict {token: weight} of the tokens matching word
+        """
+        matches = {}
+        if word in self.postings:
+            matches[word] = EXACT_MATCH
+        for token in list(self.prefixes.get(word[:MAX_PREFIX_LENGTH], ())):
+            if token != word and token.startswith(word):
+                matches[token] = PREFIX_MATCH
+        if matches or len(word) < FUZZY_MIN_LENGTH:
+            return matches
+        trigrams = get_trigrams(word)
+        shared = {}
+        for trigram in trigrams:
+            for token in list(self.trigrams.get(trigram, ())):
+                shared[token] = shared.get(token, 0) + 1
+        for token, count in shared.items():
+            similarity = 2.0 * count / (len(trigrams) + len(get_trigrams(token)))
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                matches[token] = FUZZY_MATCH * similarity
+        return matches
+
+    def search(self, terms, limit=None, show_adult=False):
+        """
+        Gets ids of the media matching terms, best matches first.
+        :param limit: Maximum number of ids returned. All if None.
+        :param show_adult: Whether adult media can be part of the results.
+        """
+        scores = {}
+        for word in set(tokenize(terms)):
+            weights = {}
+            for token, weight in self._match_word(word).items():
+                for media_id in list(self.postings.get(token, ())):
+                    if weight > weights.get(media_id, 0):
+                        weights[media_id] = weight
+            for media_id, weight in weights.items():
+                scores[media_id] = scores.get(media_id, 0) + weight
+        if not show_adult:
+            for media_id in list(self.adult_ids):
+                scores.pop(media_id, None)
+
+        def rank(media_id):
+            entry = self.entries.get(media_id)
+            return scores[media_id], entry[1] if entry else 0, media_id
+
+        if limit is None:
+            return sorted(scores, key=rank, reverse=True)
+        return heapq.nlargest(limit, scores, key=rank)
+
+
+def get_search_index():
+    """
+    Gets the search index of the current process, loading it again if it is outdated.
+    """
+    global _index
+    version = cache.get(SEARCH_INDEX_VERSION_KEY)
+    index = _index
+    if index is None or index.version != version:
+        with _lock:
+            if _index is None or _index.version != version:
+                _index = SearchIndex.load(version)
+            index = _index
+    return index
+
+
+def update_search_index(media, deleted=False):
+    """
+    Applies the change of media to the search index of the current
+    process and marks those of other processes as outdated.
+    """
+    try:
+        version = cache.incr(SEARCH_INDEX_VERSION_KEY)
+    except ValueError:
+        version = 1
+        cache.set(SEARCH_INDEX_VERSION_KEY, version, None)
+    index = _index
+    if index is None:
+        return
+    if deleted:
+        index.remove(media.id)
+    else:
+        index.add(media)
+    # Only skip the reload if no other process changed the index in the meantime.
+    if index.version is not None and index.version + 1 == version:
+        index.version = version
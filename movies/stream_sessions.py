@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Live count of the stream sessions served by each data source (origin server),
+used by movies.origins to spread viewers across origins by weighted
+least-connections.
+
+A session is attached to an origin when stream_or_download() sends a member
+there, and is kept alive by the heartbeats the player sends to
+debit_vod_balance(). Time is cut in windows of STREAM_SESSION_WINDOW seconds
+and each origin has a cached counter per window, incremented once per
+session seen during that window. The active sessions of an origin are the
+highest of the counts of the current and previous windows, so that a
+session is forgotten at most two windows after its last heartbeat without
+ever listing sessions.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+__author__ = "Kom Sihon"
+
+STREAM_ORIGIN_KEY_PREFIX = 'stream_origin:'
+ORIGIN_SESSIONS_KEY_PREFIX = 'origin_sessions:'
+SESSION_SEEN_KEY_PREFIX = 'stream_session_seen:'
+
+
+def _get_window_length():
+    return getattr(settings, 'STREAM_SESSION_WINDOW', 60)
+
+
+def _get_origin_hash(origin):
+    return hashlib.md5(origin.strip().encode('utf8')).hexdigest()
+
+
+def _get_counter_key(origin, window):
+    return ORIGIN_SESSIONS_KEY_PREFIX + '%s:%d' % (_get_origin_hash(origin), window)
+
+
+def _count(member, origin):
+    length = _get_window_length()
+    window = int(time.time() / length)
+    seen_key = SESSION_SEEN_KEY_PREFIX + '%s:%s:%d' % (member.id, _get_origin_hash(origin), window)
+    if not cache.add(seen_key, True, length * 2):
+        return  # Already counted in this window
+    key = _get_counter_key(origin, window)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, length * 3):
+            cache.incr(key)  # Created meanwhile by another process
+
+
+def start_stream_session(member, origin):
+    """
+    Attaches the stream session of member to origin, where they were just sent to play a media.
+    """
+    origin = origin.strip()
+    cache.set(STREAM_ORIGIN_KEY_PREFIX + member.id, origin, _get_window_length() * 2)
+    _count(member, origin)
+
+
+def touch_stream_session(member):
+    """
+    Keeps the stream session of member alive on its origin, if they have one.
+    """
+    key = STREAM_ORIGIN_KEY_PREFIX + member.id
+    origin = cache.get(key)
+    if origin is None:
+        return
+    cache.set(key, origin, _get_window_length() * 2)
+    _count(member, origin)
+
+
+def end_stream_session(member):
+    """
+    Stops counting the stream session of member. It leaves the counters once their windows pass.
+    """
+    cache.delete(STREAM_ORIGIN_KEY_PREFIX + member.id)
+
+
+def get_active_sessions(origins):
+    """
+    :return: dict {origin: number of active stream sessions on origin}
+    """
+    window = int(time.time() / _get_window_length())
+    counter_keys = dict([(origin, (_get_counter_key(origin, window), _get_counter_key(origin, window - 1)))
+                         for origin in origins])
+    counts = cache.get_many([key for keys in counter_keys.values() for key in keys])
+    return dict([(origin, max(counts.get(current, 0), counts.get(previous, 0)))
+                 for origin, (current, previous) in counter_keys.items()])
+
+
+def get_origin_weight(origin):
+    """
+    Capacity of origin relative to the others, set in ORIGIN_WEIGHTS. Defaults to 1. Must be positive.
+    """
+    return getattr(settings, 'ORIGIN_WEIGHTS', {}).get(origin.strip(), 1)
@@ -1,17 +1,42 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+
 from datetime import datetime, timedelta
+import requests
 from django.core.cache import cache
 from django.core.management import call_command
 from django.test.utils import override_settings
 from django.utils.unittest import TestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
+from django.http import HttpResponse
 from ikwen.accesscontrol.models import Member
-from ikwen_shavida.movies.models import Movie, Series, Category
+from ikwen_shavida.movies.catalog import get_catalog, CatalogIndex
+from ikwen_shavida.movies.catalog_file import write_catalog_file, MappedCatalog
+from ikwen_shavida.movies.categories import get_category_registry
+from ikwen_shavida.movies.counters import get_media_counts
+from ikwen_shavida.movies.models import Movie, Series, Category, SeriesEpisode
+from ikwen_shavida.movies import origins
+from ikwen_shavida.movies.increments import buffer_increment, flush_increments, reload_without_counters
+from ikwen_shavida.movies.origins import record_check, rank_sources, publish_origin_health, FAILURES_TO_DOWN, \
+    SUCCESSES_TO_UP
+from ikwen_shavida.movies.play_tokens import mint_play_token, get_play_authorization, revoke_play_tokens
+from ikwen_shavida.movies import related
+from ikwen_shavida.movies.related import build_related_media, get_suggested_ids, get_related_model, \
+    refresh_related_media
+from ikwen_shavida.movies.search import get_search_index
+from ikwen_shavida.movies.stream_sessions import start_stream_session, touch_stream_session, get_active_sessions, \
+    end_stream_session
 from ikwen_shavida.movies.tests_views import wipe_test_data
 from ikwen_shavida.movies.utils import get_recommended_for_category, get_watched_categories, EXCLUDE_LIST_KEYS_KEY, \
-    get_all_recommended, get_unit_prepayment, extract_resource_url
+    get_all_recommended, get_unit_prepayment, extract_resource_url, serialize_media, resolve_owners, \
+    sample_media, reseed_rand, get_cached_exclude_ids, get_popular_ids
+from ikwen_shavida.movies.warmer import warm_recommendations, HOME_ROWS_COUNT
 from ikwen_shavida.reporting.utils import get_watched
 from ikwen_shavida.sales.models import UnitPrepayment, Prepayment
+from ikwen_shavida.shavida.middleware import RequestCacheMiddleware, get_service, get_config
 
 
 class MoviesUtilsTest(TestCase):
@@ -49,6 +74,20 @@ class MoviesUtilsTest(TestCase):
         for item in media:
             self.assertIn(item, expected_media)
 
+    def test_get_cached_exclude_ids(self):
+        member = Member.objects.get(pk='56eb6d04b37b3379b531e012')
+        exclude_list_keys_key = member.username + ':' + EXCLUDE_LIST_KEYS_KEY
+        self.assertEqual(get_cached_exclude_ids(member), (set(), set()))
+        movies = [Movie.objects.get(pk=pk) for pk in ('56eb6d04b37b3379b531e085', '56eb6d04b37b3379b531e086')]
+        cache.set(member.username + ':test1', movies[:1])
+        cache.set(member.username + ':test2', movies[1:])
+        cache.set(exclude_list_keys_key, {member.username + ':test1', member.username + ':test2',
+                                          member.username + ':expired'})
+        exclude_list_keys, exclude_ids = get_cached_exclude_ids(member)
+        self.assertEqual(len(exclude_list_keys), 3)
+        self.assertEqual(exclude_ids, set([movie.id for movie in movies]))
+        cache.delete_many([exclude_list_keys_key, member.username + ':test1', member.username + ':test2'])
+
     def test_get_watched_categories_with_no_smart_category(self):
         """
         categories of media watched are returned from most recent watched to less recent watched
@@ -74,6 +113,20 @@ class MoviesUtilsTest(TestCase):
         expected_categories = [Category.objects.get(pk=pk).slug for pk in ('56eb6d04b37b3379b531e092', '56eb6d04b37b3379b531e093')]
         self.assertListEqual(watched_categories, expected_categories)
 
+    def test_category_registry_is_refreshed_upon_category_save(self):
+        registry = get_category_registry()
+        self.assertIs(get_category_registry(), registry)
+        self.assertFalse(registry.is_smart('56eb6d04b37b3379b531e091'))
+        category = Category.objects.get(pk='56eb6d04b37b3379b531e091')
+        category.smart = True
+        category.is_adult = True
+        category.save()
+        registry = get_category_registry()
+        self.assertTrue(registry.is_smart('56eb6d04b37b3379b531e091'))
+        self.assertTrue(registry.is_adult('56eb6d04b37b3379b531e091'))
+        self.assertEqual(registry.get_order('56eb6d04b37b3379b531e091'), category.order_of_appearance)
+        self.assertIsNone(registry.get('56eb6d04b37b3379b531e999'))
+
     @override_settings(CACHES={  # Override the CACHES settings to avoid interference if running tests on prod server
         'default': {
             'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
@@ -122,6 +175,33 @@ class MoviesUtilsTest(TestCase):
         cache.delete(cache_key_watched)
         cache.delete(cache_key_recommended)
 
+    def test_warm_recommendations(self):
+        member = Member.objects.get(pk='56eb6d04b37b3379b531e011')
+        exclude_list_keys_key = 'member1:' + EXCLUDE_LIST_KEYS_KEY
+        cache.set('member1:stale', [Movie.objects.get(pk='56eb6d04b37b3379b531e085')])
+        cache.set(exclude_list_keys_key, {'member1:stale'})
+        warm_recommendations(member)
+        exclude_list_keys = cache.get(exclude_list_keys_key)
+        self.assertIsNone(cache.get('member1:stale'))
+        self.assertIn('member1:recommended', exclude_list_keys)
+        categories = [category for category in get_category_registry().all() if category.visible][:HOME_ROWS_COUNT]
+        row_ids = set()
+        for category in categories:
+            cache_key = 'member1:recommended-' + category.id
+            self.assertIn(cache_key, exclude_list_keys)
+            media_ids = [item.id for item in cache.get(cache_key)]
+            self.assertFalse(row_ids.intersection(media_ids))
+            row_ids.update(media_ids)
+        cache.delete_many(exclude_list_keys)
+        cache.delete(exclude_list_keys_key)
+
+    def test_get_popular_ids(self):
+        catalog = get_catalog()
+        popular_ids = get_popular_ids(4)
+        self.assertEqual(len(popular_ids), 4)
+        for pk in popular_ids:
+            self.assertFalse(catalog.get(pk).is_adult)
+
     def test_is_in_temp_prepayment_with_movie_actually_in_the_temp_prepayment(self):
         member = Member.objects.get(pk='56eb6d04b37b3379b531e011')
         media = Movie.objects.get(pk='56eb6d04b37b3379b531e086')
@@ -131,6 +211,383 @@ class MoviesUtilsTest(TestCase):
                                       amount=300, duration=2, paid_on=now, expiry=expiry, status=Prepayment.CONFIRMED)
         self.assertIsNotNone(get_unit_prepayment(member, media))
 
+    def test_series_episodes_aggregates_follow_episodes_changes(self):
+        """
+        Aggregates of a Series must reflect its episodes after they are saved or deleted
+        """
+        series = Series.objects.get(pk='56eb6d04b37b3379b531e073')
+        self.assertEqual(series.size, 341 * 2)
+        self.assertEqual(series.duration, 40 * 2)
+        self.assertEqual(series.orders, 102)
+        self.assertEqual(series.display_clicks, 630)
+        episode = SeriesEpisode.objects.get(pk='56eb6d04b37b3379b531e066')
+        episode.clicks = 1630
+        episode.save()
+        series = Series.objects.get(pk='56eb6d04b37b3379b531e073')
+        self.assertEqual(series.clicks, (630 + 1630) / 2)
+        episode.delete()
+        series = Series.objects.get(pk='56eb6d04b37b3379b531e073')
+        self.assertEqual(series.size, 341)
+        self.assertEqual(series.uploaded_episodes_count, 1)
+
+    @override_settings(IKWEN_SERVICE_ID='54ad2bd9b37b335a18fe5801')
+    def test_buffered_increments(self):
+        movie = Movie.objects.get(pk='56eb6d04b37b3379b531e081')
+        episode = SeriesEpisode.objects.get(pk='56eb6d04b37b3379b531e066')
+        flush_increments()
+        for i in range(3):
+            buffer_increment(movie, clicks=1)
+        buffer_increment(movie, orders=1, fake_orders=1)
+        buffer_increment(episode, clicks=1000)
+        flush_increments()
+        flushed_movie = Movie.objects.get(pk=movie.id)
+        self.assertEqual(flushed_movie.clicks, movie.clicks + 3)
+        self.assertEqual(flushed_movie.orders, movie.orders + 1)
+        self.assertEqual(flushed_movie.fake_orders, movie.fake_orders + 1)
+        series = Series.objects.get(pk='56eb6d04b37b3379b531e073')
+        self.assertEqual(series.clicks, (630 + 1630) / 2)
+        self.assertEqual(flush_increments(), 0)
+
+        # Increments of other media stay pending and saving a media reloaded without counters preserves them
+        movie = reload_without_counters(flushed_movie)
+        buffer_increment(movie, current_earnings=500)
+        buffer_increment(episode, clicks=1)
+        self.assertEqual(flush_increments(movie), 1)
+        movie.title = 'Edited title'
+        movie.save()
+        saved_movie = Movie.objects.get(pk=movie.id)
+        self.assertEqual(saved_movie.title, 'Edited title')
+        self.assertEqual(saved_movie.current_earnings, flushed_movie.current_earnings + 500)
+        self.assertEqual(flush_increments(), 1)
+
+    def test_serialize_media(self):
+        """
+        Episodes take the poster and view_price of their series and only requested fields are output
+        """
+        movie = Movie.objects.get(pk='56eb6d04b37b3379b531e086')
+        episode = SeriesEpisode.objects.get(pk='56eb6d04b37b3379b531e065')
+        series = Series.objects.get(pk='56eb6d04b37b3379b531e073')
+        media = serialize_media([movie, episode, series])
+        self.assertEqual(len(media), 3)
+        self.assertEqual(media[0]['id'], movie.id)
+        self.assertEqual(media[0]['type'], 'movie')
+        self.assertEqual(media[0]['display_clicks'], 630)
+        self.assertNotIn('season', media[0])
+        self.assertEqual(media[1]['series_id'], series.id)
+        self.assertEqual(media[1]['view_price'], series.view_price)
+        self.assertEqual(media[1]['poster'], media[2]['poster'])
+        self.assertEqual(media[2]['full_title'], series.full_title)
+        self.assertEqual(media[2]['load'], series.load)
+        media = serialize_media([movie], fields=('id', 'title'))
+        self.assertEqual(media, [{'id': movie.id, 'title': movie.title}])
+
+    @override_settings(IKWEN_SERVICE_ID='54ad2bd9b37b335a18fe5801')
+    def test_catalog_snapshot_is_refreshed_upon_media_save(self):
+        """
+        In-memory catalog must reflect the visibility and categories of media after they are saved
+        """
+        category_western_id = '56eb6d04b37b3379b531e092'
+        catalog = get_catalog()
+        self.assertEqual(catalog.get_movie_ids(category_western_id),
+                         ['56eb6d04b37b3379b531e086', '56eb6d04b37b3379b531e085',
+                          '56eb6d04b37b3379b531e084', '56eb6d04b37b3379b531e082'])
+        movie = Movie.objects.get(pk='56eb6d04b37b3379b531e085')
+        movie.visible = False
+        movie.save()
+        catalog = get_catalog()
+        self.assertEqual(catalog.count_movies(category_western_id), 3)
+        self.assertIsNone(catalog.get('56eb6d04b37b3379b531e085'))
+        self.assertEqual(catalog.get_cards(['56eb6d04b37b3379b531e086'])[0]['slug'], 'good-bad-ugly')
+
+    @override_settings(IKWEN_SERVICE_ID='54ad2bd9b37b335a18fe5801')
+    def test_mapped_catalog_matches_in_memory_catalog(self):
+        """
+        Catalog read from the shared catalog file must give the same results as the in-memory one
+        """
+        catalog = get_catalog()
+        path = tempfile.mktemp(suffix='.catalog')
+        try:
+            write_catalog_file(path, catalog)
+            mapped_catalog = MappedCatalog(path)
+            for category_id in (None, '56eb6d04b37b3379b531e092', '56eb6d04b37b3379b531e095'):
+                for ordering in (CatalogIndex.RECENT, CatalogIndex.RECOMMENDED, CatalogIndex.RELEASE):
+                    self.assertEqual(mapped_catalog.get_movie_ids(category_id, ordering),
+                                     catalog.get_movie_ids(category_id, ordering))
+                    self.assertEqual(mapped_catalog.get_series_ids(category_id, ordering),
+                                     catalog.get_series_ids(category_id, ordering))
+                self.assertEqual(mapped_catalog.count_movies(category_id), catalog.count_movies(category_id))
+                self.assertEqual(mapped_catalog.count_series(category_id), catalog.count_series(category_id))
+            self.assertEqual(mapped_catalog.get_movie_ids('56eb6d04b37b3379b531e0ff'), [])
+            self.assertEqual(mapped_catalog.count_movies('56eb6d04b37b3379b531e0ff'), 0)
+            media_ids = ['56eb6d04b37b3379b531e086', '56eb6d04b37b3379b531e073']
+            self.assertEqual(mapped_catalog.get_cards(media_ids), catalog.get_cards(media_ids))
+        finally:
+            os.remove(path)
+
+    def test_resolve_owners(self):
+        """
+        Owners of all media are resolved at once and unknown members are skipped
+        """
+        member1 = Member.objects.get(email='member1@ikwen.com')
+        member2 = Member.objects.get(email='member2@ikwen.com')
+        movie1 = Movie.objects.get(pk='56eb6d04b37b3379b531e081')
+        movie1.owner_fk_list = [member1.id, '56eb6d04b37b3379b531e999']
+        movie2 = Movie.objects.get(pk='56eb6d04b37b3379b531e082')
+        movie2.owner_fk_list = [member2.id, member1.id]
+        resolve_owners([movie1, movie2])
+        self.assertEqual([owner['id'] for owner in movie1.owner_list], [member1.id])
+        self.assertEqual([owner['id'] for owner in movie2.owner_list], [member2.id, member1.id])
+        self.assertEqual(movie2.owner_list[0]['full_name'], member2.full_name)
+
+    @override_settings(IKWEN_SERVICE_ID='54ad2bd9b37b335a18fe5801')
+    def test_request_cache_middleware(self):
+        """
+        Service and config are looked up once per request, and again after the config is saved
+        """
+        middleware = RequestCacheMiddleware()
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        config = get_config()
+        self.assertIs(get_config(), config)
+        self.assertIs(get_service(), get_service())
+        config.save()
+        self.assertIsNot(get_config(), config)
+        response = middleware.process_response(request, HttpResponse())
+        self.assertEqual(response['X-Lookups-Saved'], '3')
+
+    def test_sample_media(self):
+        """
+        Sampled media are visible, distinct and all found whatever the pivot drawn
+        """
+        visible_ids = set([movie.id for movie in Movie.objects.filter(visible=True)])
+        for i in range(5):
+            items = sample_media(Movie, 3)
+            self.assertEqual(len(items), 3)
+            self.assertEqual(len(set([item.id for item in items])), 3)
+            self.assertTrue(set([item.id for item in items]).issubset(visible_ids))
+        items = sample_media(Movie, len(visible_ids) + 10)
+        self.assertEqual(sorted([item.id for item in items]), sorted(visible_ids))
+        category = Category.objects.get(pk='56eb6d04b37b3379b531e092')
+        category_ids = set([movie.id for movie in category.get_movies_queryset()])
+        self.assertEqual(set([item.id for item in sample_media(Movie, 100, category)]), category_ids)
+
+    def test_reseed_rand(self):
+        """
+        All media get a new rand, whatever the number of batches it takes
+        """
+        previous = dict([(movie.id, movie.rand) for movie in Movie.objects.all()])
+        self.assertEqual(reseed_rand(Movie, batch_size=2), len(previous))
+        for movie in Movie.objects.all():
+            self.assertNotEqual(movie.rand, previous[movie.id])
+
+    def test_media_counters_follow_media_changes(self):
+        category = Category.objects.get(pk='56eb6d04b37b3379b531e092')
+
+        def count():
+            return category.get_movies_queryset().count(), category.get_series_queryset().count()
+
+        def count_all():
+            return Movie.objects.filter(visible=True).count(), Series.objects.filter(visible=True).count()
+
+        self.assertEqual(get_media_counts(), count_all())
+        self.assertEqual(get_media_counts(category.id), count())
+        movie = Movie.objects.filter(visible=True).exclude(pk__in=[m.id for m in category.get_movies_queryset()])[0]
+        movie.categories.append(category)
+        movie.save()
+        self.assertEqual(get_media_counts(category.id), count())
+        movie.visible = False
+        movie.save()
+        self.assertEqual(get_media_counts(category.id), count())
+        self.assertEqual(get_media_counts(), count_all())
+        Series.objects.filter(visible=True)[0].delete()
+        self.assertEqual(get_media_counts(), count_all())
+
+    def test_search_index(self):
+        """
+        Search matches words, prefixes and words with typos, hides adult media
+        unless asked and follows changes of media
+        """
+        index = get_search_index()
+        self.assertEqual(index.search('ugly'), ['56eb6d04b37b3379b531e086'])
+        self.assertEqual(index.search('scan olivia'), index.search('scandal'))
+        self.assertEqual(len(index.search('scandal')), 3)
+        self.assertEqual(index.search('magnificnt'), ['56eb6d04b37b3379b531e085'])
+        self.assertEqual(index.search('daredevil'), [])
+        self.assertEqual(index.search('daredevil', show_adult=True), ['56eb6d04b37b3379b531e071'])
+        movie = Movie.objects.get(pk='56eb6d04b37b3379b531e085')
+        movie.tags = 'seven magnificent cowboys'
+        movie.save()
+        self.assertEqual(get_search_index().search('cowboy'), ['56eb6d04b37b3379b531e085'])
+        movie.visible = False
+        movie.save()
+        self.assertEqual(get_search_index().search('magnificent'), [])
+
+    def test_build_related_media(self):
+        """
+        Series of the same group are the most related and suggestions are completed with media of the same categories
+        """
+        model_dir = tempfile.mkdtemp()
+        with override_settings(RELATED_MODEL_DIR=model_dir):
+            build_related_media(Series)
+        shutil.rmtree(model_dir)
+        series = Series.objects.get(pk='56eb6d04b37b3379b531e073')
+        self.assertEqual(set(series.related_ids[:2]), {'56eb6d04b37b3379b531e072', '56eb6d04b37b3379b531e074'})
+        self.assertNotIn(series.id, series.related_ids)
+
+    def test_refresh_related_media(self):
+        """
+        Related media are refreshed incrementally, only when the fields they are computed from change
+        """
+        model_dir = tempfile.mkdtemp()
+        with override_settings(RELATED_MODEL_DIR=model_dir):
+            try:
+                build_related_media(Series)
+                refreshed = []
+                refresh_related_media_async = related.refresh_related_media_async
+                related.refresh_related_media_async = lambda media: refreshed.append(media.id)
+                try:
+                    series = Series.objects.get(pk='56eb6d04b37b3379b531e074')
+                    series.save()
+                    series.title = 'Scandal reloaded'  # Titles are not among the terms of vectors
+                    series.save()
+                    self.assertEqual(refreshed, [])
+                    series.visible = False
+                    series.save()
+                    self.assertEqual(refreshed, [series.id])
+                finally:
+                    related.refresh_related_media_async = refresh_related_media_async
+                refresh_related_media(Series, [series.id])
+                self.assertNotIn(series.id, Series.objects.get(pk='56eb6d04b37b3379b531e073').related_ids)
+                self.assertNotIn(series.id, get_related_model(Series).vectors)
+            finally:
+                shutil.rmtree(model_dir)
+        suggested_ids = get_suggested_ids(series, 1)
+        self.assertEqual(suggested_ids, series.related_ids[:1])
+        movie = Movie.objects.get(pk='56eb6d04b37b3379b531e082')
+        movie.related_ids = []
+        suggested_ids = get_suggested_ids(movie, 10)
+        self.assertNotIn(movie.id, suggested_ids)
+        self.assertEqual(suggested_ids, sorted(suggested_ids, reverse=True))
+
+    def test_play_tokens(self):
+        member = Member.objects.get(pk='56eb6d04b37b3379b531e011')
+        movie_id = '56eb6d04b37b3379b531e081'
+        authorization = {'media_url': 'http://cdn.ikwen.com/movie.mp4'}
+        token = mint_play_token(member, 'movie', movie_id, 'stream', 'desktop', authorization)
+        self.assertEqual(get_play_authorization(token, member, 'movie', movie_id, 'stream', 'desktop'), authorization)
+        self.assertIsNone(get_play_authorization(token, member, 'movie', movie_id, 'download', 'desktop'))
+        self.assertIsNone(get_play_authorization(token, member, 'movie', movie_id, 'stream', 'mobile'))
+        self.assertIsNone(get_play_authorization(token, member, 'movie', '56eb6d04b37b3379b531e082', 'stream', 'desktop'))
+        self.assertIsNone(get_play_authorization(token + '0', member, 'movie', movie_id, 'stream', 'desktop'))
+        self.assertIsNone(get_play_authorization('garbage', member, 'movie', movie_id, 'stream', 'desktop'))
+        revoke_play_tokens(member)
+        self.assertIsNone(get_play_authorization(token, member, 'movie', movie_id, 'stream', 'desktop'))
+        # Tokens do not outlive the prepayment giving access to the media
+        token = mint_play_token(member, 'movie', movie_id, 'stream', 'desktop', authorization,
+                                datetime.now() - timedelta(seconds=5))
+        self.assertIsNone(get_play_authorization(token, member, 'movie', movie_id, 'stream', 'desktop'))
+        token = mint_play_token(member, 'movie', movie_id, 'stream', 'desktop', authorization,
+                                datetime.now() + timedelta(minutes=5))
+        self.assertLessEqual(int(token.split('.')[0]), time.time() + 300)
+        self.assertEqual(get_play_authorization(token, member, 'movie', movie_id, 'stream', 'desktop'), authorization)
+
+    def test_origin_health_routing(self):
+        slow, fast, dead = 'http://slow.ikwen.com/vod', 'http://fast.ikwen.com/vod', 'http://dead.ikwen.com/vod'
+        for i in range(FAILURES_TO_DOWN):
+            record_check(slow, 400)
+            record_check(fast, 50)
+            health = record_check(dead, None, 'Connection refused')
+        self.assertFalse(health.is_up)
+        self.assertEqual(health.error_rate, 1)
+        sources = [dead, slow, fast, 'http://new.ikwen.com/vod']
+        self.assertEqual(rank_sources(sources, publish_origin_health()), [fast, slow, 'http://new.ikwen.com/vod'])
+        for i in range(SUCCESSES_TO_UP):
+            health = record_check(dead, 10)
+        self.assertTrue(health.is_up)
+        self.assertEqual(health.p50_latency, 10)
+        self.assertEqual(rank_sources(sources, publish_origin_health())[-1], 'http://new.ikwen.com/vod')
+
+    @override_settings(ORIGIN_PROBE_TIMEOUT=0.5)
+    def test_find_media_url_probing(self):
+        """
+        Without health data, sources are probed concurrently: the first one in order where the media is found
+        is used, timeouts count as not found and a source known to lack the media is not probed again
+        """
+        class Response(object):
+            def __init__(self, status_code):
+                self.status_code = status_code
+
+        class Session(object):
+            def __init__(self):
+                self.behaviors, self.urls = {}, []
+
+            def head(self, url, **kwargs):
+                self.urls.append(url)
+                behavior = self.behaviors[url[:url.rindex('/')]]
+                if behavior == 'timeout':
+                    raise requests.Timeout()
+                if isinstance(behavior, float):
+                    time.sleep(behavior)
+                    return Response(200)
+                return Response(behavior)
+
+        class UserAgent(object):
+            is_mobile = is_tablet = False
+
+        s1, s2, s3 = 'http://vod1.ikwen.com', 'http://vod2.ikwen.com', 'http://vod3.ikwen.com'
+        request = RequestFactory().get('/')
+        request.user_agent = UserAgent()
+        hd_movie = Movie.objects.get(pk='56eb6d04b37b3379b531e081')
+        western_movie = Movie.objects.get(pk='56eb6d04b37b3379b531e082')
+        cache.delete_many([origins._get_probe_key(media, folder, 'desktop') for media in (hd_movie, western_movie)
+                           for folder in (s1, s2, s3, 'http://vod4.ikwen.com', 'http://vod5.ikwen.com')])
+        origins._get_pool()
+        session, watch_origins = origins._state['session'], origins.watch_origins
+        origins._state['session'] = fake_session = Session()
+        origins.watch_origins = lambda sources: None  # No health data
+        try:
+            fake_session.behaviors = {s1: 404, s2: 0.2, s3: 200}
+            self.assertEqual(origins.find_media_url(request, hd_movie, [s1, s2, s3]),
+                             (s2 + '/hd-movie.mp4', s2, True))
+            fake_session.behaviors[s1] = 200
+            fake_session.urls = []
+            self.assertEqual(origins.find_media_url(request, hd_movie, [s1, s2, s3]),
+                             (s2 + '/hd-movie.mp4', s2, True))
+            self.assertNotIn(s1 + '/hd-movie.mp4', fake_session.urls)
+
+            fake_session.behaviors = {s1: 1.5, s2: 'timeout', s3: 200}
+            self.assertEqual(origins.find_media_url(request, western_movie, [s1, s2, s3]),
+                             (s3 + '/western-movie.mp4', s3, True))
+            fake_session.behaviors[s3] = 404
+            self.assertEqual(origins.find_media_url(request, western_movie, [s2, s3]),
+                             (s3 + '/western-movie.mp4', s3, True))  # Found result of s3 is cached
+
+            # Health of sources known: the least loaded one is used at once only if known to have the media
+            s4, s5 = 'http://vod4.ikwen.com', 'http://vod5.ikwen.com'
+            cache.set(origins.ORIGIN_HEALTH_KEY, {s4: (True, 0, 10), s5: (True, 0, 10)}, None)
+            fake_session.behaviors = {s4: 404, s5: 200}
+            self.assertEqual(origins.find_media_url(request, hd_movie, [s4, s5]), (s5 + '/hd-movie.mp4', s5, True))
+            fake_session.urls = []
+            self.assertEqual(origins.find_media_url(request, hd_movie, [s4, s5]), (s5 + '/hd-movie.mp4', s5, True))
+            self.assertEqual(fake_session.urls, [])
+            self.assertTrue(origins.is_found_cached(request, hd_movie, s5))
+        finally:
+            origins._state['session'], origins.watch_origins = session, watch_origins
+
+    @override_settings(STREAM_SESSION_WINDOW=3600)
+    def test_stream_sessions(self):
+        origin1, origin2 = 'http://vod1.ikwen.com', 'http://vod2.ikwen.com'
+        member1 = Member.objects.get(pk='56eb6d04b37b3379b531e011')
+        member2 = Member.objects.get(pk='56eb6d04b37b3379b531e012')
+        start_stream_session(member1, origin1)
+        start_stream_session(member2, origin1)
+        touch_stream_session(member1)  # Heartbeats do not count a session twice
+        self.assertEqual(get_active_sessions([origin1, origin2]), {origin1: 2, origin2: 0})
+        start_stream_session(member2, origin2)
+        end_stream_session(member1)
+        touch_stream_session(member1)
+        self.assertEqual(get_active_sessions([origin2])[origin2], 1)
+
     def test_extract_resource_url(self):
         iframe_code = '<iframe width="560" height="315" src="https://www.youtube.com/embed/nl5dlbCh8lY" frameborder="0" allowfullscreen></iframe>'
         extracted_url = extract_resource_url(iframe_code)
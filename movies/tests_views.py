@@ -15,7 +15,7 @@ from django.test.utils import override_settings
 from ikwen.accesscontrol.models import Member
 from ikwen.core.utils import get_service_instance
 from ikwen_shavida.movies.models import Category, Movie, Series
-from ikwen_shavida.movies.utils import EXCLUDE_LIST_KEYS_KEY
+from ikwen_shavida.movies.utils import EXCLUDE_LIST_KEYS_KEY, serialize_media
 from ikwen_shavida.sales.models import VODPrepayment, UnitPrepayment, Prepayment
 
 __author__ = "Kom Sihon"
@@ -33,15 +33,23 @@ def wipe_test_data():
     for name in ('OperatorProfile', 'Customer'):
         model = getattr(ikwen_shavida.shavida.models, name)
         model.objects.all().delete()
-    for name in ('Category', 'Movie', 'Series', 'SeriesEpisode'):
+    for name in ('Category', 'Movie', 'Series', 'SeriesEpisode', 'MediaCounter', 'OriginHealth'):
         model = getattr(ikwen_shavida.movies.models, name)
         model.objects.all().delete()
     for name in ('RetailBundle', 'VODBundle', 'VODPrepayment', 'UnitPrepayment', 'RetailPrepayment', 'ContentUpdate'):
         model = getattr(ikwen_shavida.sales.models, name)
         model.objects.all().delete()
-    for name in ('StreamLogEntry',):
+    for name in ('StreamLogEntry', 'CoWatch', 'CoWatchCheckpoint', 'VODLease'):
         model = getattr(ikwen_shavida.reporting.models, name)
         model.objects.all().delete()
+    from ikwen_shavida.movies.counters import MEDIA_COUNTERS_KEY
+    from ikwen_shavida.movies.origins import ORIGIN_HEALTH_KEY
+    from ikwen_shavida.reporting.metering import LEASE_KEY_PREFIX
+    from ikwen_shavida.shavida.entitlements import ENTITLEMENTS_KEY_PREFIX
+    cache.delete_many([MEDIA_COUNTERS_KEY, ORIGIN_HEALTH_KEY])
+    member_ids = [member.id for member in Member.objects.all()]
+    cache.delete_many([prefix + member_id for prefix in (ENTITLEMENTS_KEY_PREFIX, LEASE_KEY_PREFIX)
+                       for member_id in member_ids])
 
 
 class MoviesViewsTest(TestCase):
@@ -128,10 +136,10 @@ class MoviesViewsTest(TestCase):
         url = reverse('movies:get_recommended_for_single_category')
         response = self.client.get(url, {'category_id': category_id})
         media = json.loads(response.content)
-        expected_media = [Movie.objects.get(pk=pk).to_dict() for pk in ('56eb6d04b37b3379b531e084', '56eb6d04b37b3379b531e083', '56eb6d04b37b3379b531e082')]
-        expected_media.extend([Series.objects.get(pk=pk).to_dict() for pk in ('56eb6d04b37b3379b531e074', '56eb6d04b37b3379b531e073')])
+        expected_media = serialize_media([Movie.objects.get(pk=pk) for pk in ('56eb6d04b37b3379b531e084', '56eb6d04b37b3379b531e083', '56eb6d04b37b3379b531e082')])
+        expected_media.extend(serialize_media([Series.objects.get(pk=pk) for pk in ('56eb6d04b37b3379b531e074', '56eb6d04b37b3379b531e073')]))
         cached_recommended = cache.get(cache_key_recommended)
-        json_cached_recommended = [item.to_dict() for item in cached_recommended]
+        json_cached_recommended = serialize_media(cached_recommended)
         cached_ex_list_keys = cache.get(exclude_list_keys_key)
         for item in media:
             self.assertIn(item, expected_media)
@@ -273,6 +281,25 @@ class MoviesViewsTest(TestCase):
         response = self.client.get(reverse('movies:home'), HTTP_USER_AGENT='Mozilla 5.1')
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(IKWEN_SERVICE_ID = '54ad2bd9b37b335a18fe5801')
+    def test_Home_page_cache(self):
+        """
+        Anonymous visitors are served the cached page until the catalog changes. Members always get a fresh one.
+        """
+        url = reverse('movies:home')
+        response = self.client.get(url, {'fbclid': 'share1'}, HTTP_USER_AGENT='Mozilla 5.1')
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        response = self.client.get(url, {'fbclid': 'share2'}, HTTP_USER_AGENT='Mozilla 5.1')
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        response = self.client.get(url, {'_escaped_fragment_': 'movie-ugly'}, HTTP_USER_AGENT='Mozilla 5.1')
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        Movie.objects.all()[0].save()
+        response = self.client.get(url, HTTP_USER_AGENT='Mozilla 5.1')
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.client.login(username='member1@ikwen.com', password='admin')
+        response = self.client.get(url, HTTP_USER_AGENT='Mozilla 5.1')
+        self.assertFalse(response.has_header('X-Page-Cache'))
+
     @override_settings(IKWEN_SERVICE_ID = '54ad2bd9b37b335a18fe5801')
     def test_stream_with_direct_access(self):
         """
@@ -4,7 +4,7 @@ from django.conf.urls import *
 
 from ikwen_shavida.movies.views import stream_or_download, TestVideoBytesCounter, Home, MediaList, Checkout, \
     MovieDetail, get_media, get_recommended_for_single_category, Search, SeriesDetail, Bundles, MoMoCheckout
-from ikwen_shavida.reporting.views import debit_vod_balance
+from ikwen_shavida.reporting.views import debit_vod_balance, telemetry
 
 __author__ = "Kom Sihon"
 
@@ -24,5 +24,6 @@ urlpatterns = patterns(
     url(r'^search$', Search.as_view(), name='search'),
     url(r'^stream/$', stream_or_download, name='stream_or_download'),
     url(r'^debit_vod_balance$', debit_vod_balance, name='debit_vod_balance'),
+    url(r'^telemetry$', telemetry, name='telemetry'),
     url(r'^testVideoBytesCounter/$', TestVideoBytesCounter.as_view()),
 )
\ No newline at end of file
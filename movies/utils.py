@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 import base64
 import hashlib
+import random
+import re
 import time
-from bson import ObjectId
 from datetime import datetime
 
+from bson import ObjectId
 from currencies.context_processors import currencies
 from django.conf import settings
 from django.core.cache import cache
@@ -12,12 +14,18 @@ from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.template import Context
 from django.template.loader import get_template
-from ikwen.core.utils import get_service_instance
+from ikwen.accesscontrol.models import Member
+from ikwen.accesscontrol.templatetags.shared_media import from_provider
+from ikwen.core.models import Service
 
-from ikwen_shavida.movies.models import Category, Movie, Series, SeriesEpisode
+from ikwen_shavida.movies.catalog import get_catalog, CatalogIndex
+from ikwen_shavida.movies.categories import get_category_registry
+from ikwen_shavida.movies.counters import get_media_counts
+from ikwen_shavida.movies.models import Movie, Series, SeriesEpisode
 from ikwen_shavida.reporting.models import StreamLogEntry
 from ikwen_shavida.reporting.utils import get_watched
 from ikwen_shavida.sales.models import UnitPrepayment, Prepayment
+from ikwen_shavida.shavida.middleware import get_config
 
 __author__ = 'komsihon'
 
@@ -27,6 +35,17 @@ EXCLUDE_LIST_KEYS_KEY = 'exclude_list_keys'
 MAX_CATEGORIES_IN_RECOMMENDATIONS = 5
 TOTAL_RECOMMENDED = 12
 
+# Keys output by serialize_media() when no fields are specified. They are
+# the ones used to render a media card, either in templates or in javascript.
+# Keys that do not apply to a type of media (Eg: season for a Movie) are skipped.
+MEDIA_CARD_FIELDS = ('id', 'type', 'title', 'full_title', 'season', 'series_id', 'slug', 'tags', 'poster',
+                     'price', 'view_price', 'download_price', 'size', 'duration', 'load', 'display_load',
+                     'display_orders', 'display_clicks', 'is_adult', 'trailer_resource', 'release')
+DEFAULT_POSTER = 'default_poster.jpg'
+
+MEMBER_DISPLAY_CACHE_KEY_PREFIX = 'member_display:'
+MEMBER_DISPLAY_CACHE_TIMEOUT = 5 * 60
+
 
 def get_all_recommended(member, count):
     """
@@ -36,42 +55,58 @@ def get_all_recommended(member, count):
     :return: list of Movies and/or Series
     """
     if StreamLogEntry.objects.filter(member=member).count() == 0:
-        recommended = []
-    else:
-        exclude_list_keys = set()
-        cache_key_recommended = member.username + ':recommended'
-        recommended = cache.get(cache_key_recommended)
-        if recommended:
-            return recommended
-        else:
-            recommended = []
-
-        cache_key_watched = member.username + ':already_watched'
-        already_watched = cache.get(cache_key_watched)
-        if not already_watched:
-            already_watched = get_watched(member)
-            if len(already_watched) > 0:
-                cache.set(cache_key_watched, already_watched)
-                exclude_list_keys.add(cache_key_watched)
-        exclude_list = already_watched
-
-        categories = get_watched_categories(already_watched)
-        if len(categories) > 0:
-            # Main category is the category of the media most recently watched
-            main_category = categories[0]
-            cnt = count - (len(categories) - 1)
-            media = get_recommended_for_category(main_category, cnt, exclude_list)
-            recommended = media
-            exclude_list.extend(media)
-        categories = categories[1:]
-        for category in categories:  # Grab one item for each category other than the main
-            media = get_recommended_for_category(category, 1, exclude_list)
-            recommended.extend(media)
-            exclude_list.extend(media)
-        cache.set(cache_key_recommended, recommended)
-        exclude_list_keys.add(cache_key_recommended)
-        cache.set(member.username + ':' + EXCLUDE_LIST_KEYS_KEY, exclude_list_keys)
-    return recommended
+        return []
+    cache_key_recommended = member.username + ':recommended'
+    recommended = cache.get(cache_key_recommended)
+    if recommended:
+        return recommended
+    rows = compute_recommended_rows(member, count)
+    cache.set_many(rows)
+    return rows[cache_key_recommended]
+
+
+def compute_recommended_rows(member, count, categories=()):
+    """
+    Computes the recommendations of a Member from scratch: the general row of count media
+    followed by a row for each of the categories, each row excluding the media of the previous ones.
+    :param categories: Categories to compute a row for, with their previews_length media
+    :return: dict {cache key: value} of the rows, the media already watched and the keys of the
+        lists to exclude from subsequent recommendations, ready to be written with cache.set_many()
+    """
+    rows = {}
+    exclude_list_keys = set()
+    cache_key_watched = member.username + ':already_watched'
+    already_watched = get_watched(member)
+    if len(already_watched) > 0:
+        rows[cache_key_watched] = already_watched
+        exclude_list_keys.add(cache_key_watched)
+    exclude_ids = set([item.id for item in already_watched])
+
+    recommended_ids = []
+    watched_categories = get_watched_categories(already_watched)
+    if len(watched_categories) > 0:
+        # Main category is the category of the media most recently watched
+        main_category = watched_categories[0]
+        cnt = count - (len(watched_categories) - 1)
+        recommended_ids = get_recommended_ids_for_category(main_category, cnt, exclude_ids)
+        exclude_ids.update(recommended_ids)
+    for category in watched_categories[1:]:  # Grab one item for each category other than the main
+        media_ids = get_recommended_ids_for_category(category, 1, exclude_ids)
+        recommended_ids.extend(media_ids)
+        exclude_ids.update(media_ids)
+    catalog = get_catalog()
+    cache_key_recommended = member.username + ':recommended'
+    rows[cache_key_recommended] = catalog.fetch(recommended_ids)
+    exclude_list_keys.add(cache_key_recommended)
+
+    for category in categories:
+        media_ids = get_recommended_ids_for_category(category, category.previews_length, exclude_ids)
+        exclude_ids.update(media_ids)
+        cache_key = member.username + ':recommended-' + category.id
+        rows[cache_key] = catalog.fetch(media_ids)
+        exclude_list_keys.add(cache_key)
+    rows[member.username + ':' + EXCLUDE_LIST_KEYS_KEY] = exclude_list_keys
+    return rows
 
 
 def get_recommended_for_category(category, count, exclude_list):
@@ -86,19 +121,52 @@ def get_recommended_for_category(category, count, exclude_list):
     :param exclude_list: an arbitrary list of movies to exclude from the result
     :return: list of recommended movies and series
     """
+    exclude_ids = set([item.id for item in exclude_list])
+    return get_catalog().fetch(get_recommended_ids_for_category(category, count, exclude_ids))
+
+
+def get_recommended_ids_for_category(category, count, exclude_ids):
+    """
+    Same as get_recommended_for_category(), but with exclusions and results given as ids. Ids are read in the
+    pre-sorted order of the catalog snapshot and the scan stops as soon as count media are found. So it costs
+    O(count + number of excluded ids met) whatever the size of the category.
+    :param exclude_ids: set of ids of media to exclude from the result
+    :return: list of ids of recommended movies and series
+    """
     movies_count, series_count = get_movies_series_share(count)
-    recommended = []
+    catalog = get_catalog()
+    recommended_ids = []
     if movies_count > 0:
-        movies_qs = Movie.objects.raw_query({'categories': {'$elemMatch': {'id': ObjectId(category.id)}}, 'visible': True})
-        for movie in movies_qs.order_by('-release', '-fake_clicks', '-fake_orders', '-id'):
-            if movie not in recommended and movie not in exclude_list and len(recommended) < movies_count:
-                recommended.append(movie)
+        for pk in catalog.get_movie_ids(category.id, CatalogIndex.RECOMMENDED):
+            if len(recommended_ids) >= movies_count:
+                break
+            if pk not in exclude_ids:
+                recommended_ids.append(pk)
     if series_count > 0:
-        series_qs = Series.objects.raw_query({'categories': {'$elemMatch': {'id': ObjectId(category.id)}}, 'visible': True})
-        for series in series_qs.order_by('-release', '-season', '-id'):
-            if series not in recommended and series not in exclude_list and len(recommended) < count:
-                recommended.append(series)
-    return recommended
+        for pk in catalog.get_series_ids(category.id, CatalogIndex.RECOMMENDED):
+            if len(recommended_ids) >= count:
+                break
+            if pk not in exclude_ids:
+                recommended_ids.append(pk)
+    return recommended_ids
+
+
+def get_popular_ids(count):
+    """
+    Ids of the count most recommended visible media of the whole catalog, adult ones left
+    out. They are shown to members whose own recommendations are not computed yet.
+    """
+    movies_count, series_count = get_movies_series_share(count)
+    catalog = get_catalog()
+    popular_ids = []
+    for media_ids, limit in ((catalog.get_movie_ids(None, CatalogIndex.RECOMMENDED), movies_count),
+                             (catalog.get_series_ids(None, CatalogIndex.RECOMMENDED), count)):
+        for pk in media_ids:
+            if len(popular_ids) >= limit:
+                break
+            if not catalog.get(pk).is_adult:
+                popular_ids.append(pk)
+    return popular_ids
 
 
 def get_movies_series_share(count, category=None):
@@ -109,12 +177,7 @@ def get_movies_series_share(count, category=None):
     :param category:
     :return: tuple movies_count, series_count
     """
-    if category:
-        total_movies = Movie.objects.raw_query({'categories': {'$elemMatch': {'id': ObjectId(category.id)}}, 'visible': True}).count()
-        total_series = Series.objects.raw_query({'categories': {'$elemMatch': {'id': ObjectId(category.id)}}, 'visible': True}).count()
-    else:
-        total_movies = Movie.objects.filter(visible=True).count()
-        total_series = Series.objects.filter(visible=True).count()
+    total_movies, total_series = get_media_counts(category.id if category else None)
     if count == 1:
         if total_movies > total_series:
             return 1, 0
@@ -128,17 +191,71 @@ def get_movies_series_share(count, category=None):
     return movies_count, series_count
 
 
+def sample_media(model, k=1, category=None):
+    """
+    Picks k random visible media of the given model (Movie or Series), optionally in a category.
+    It runs a range scan on the indexed field rand from a random pivot, then wraps around
+    to the beginning of the range if that was not enough. So only k documents are read,
+    whatever the size of the catalog. Media being close to each other on rand come
+    together; hence those values are periodically redrawn by reseed_rand().
+    :return: list of at most k media
+    """
+    if category:
+        queryset = model.objects.raw_query({'categories': {'$elemMatch': {'id': ObjectId(category.id)}}, 'visible': True})
+    else:
+        queryset = model.objects.filter(visible=True)
+    pivot = random.random()
+    items = list(queryset.filter(rand__gte=pivot).order_by('rand')[:k])
+    if len(items) < k:
+        items.extend(queryset.filter(rand__lt=pivot).order_by('rand')[:k - len(items)])
+    return items
+
+
+def reseed_rand(model, using='default', batch_size=1000):
+    """
+    Draws new values of the field rand for all media of the given model.
+    Only ids are read, batch_size at a time.
+    :return: number of media reseeded
+    """
+    queryset = model.objects.using(using).order_by('id')
+    count = 0
+    ids = list(queryset.values_list('id', flat=True)[:batch_size])
+    while ids:
+        for pk in ids:
+            model.objects.using(using).filter(pk=pk).update(rand=random.random())
+        count += len(ids)
+        ids = list(queryset.filter(pk__gt=ids[-1]).values_list('id', flat=True)[:batch_size])
+    return count
+
+
 def get_watched_categories(watched_media):
+    registry = get_category_registry()
     categories = []
     for media in watched_media:
         for category in media.categories:
             # Media categories are embedded, so check the smart status
-            # from the original category. So re-get from the database
-            if not Category.objects.get(pk=category.id).smart:
+            # from the original category, held in the registry.
+            original = registry.get(category.id)
+            if original and not original.smart:
                 categories.append(category)
     return categories
 
 
+def get_cached_exclude_ids(member):
+    """
+    Gets the ids of media in the lists already recommended to member and cached.
+    :return: tuple (set of keys of the cached lists, set of ids of media in those lists)
+    """
+    exclude_list_keys = cache.get(member.username + ':' + EXCLUDE_LIST_KEYS_KEY)
+    if not exclude_list_keys:
+        return set(), set()
+    exclude_ids = set()
+    for items in cache.get_many(list(exclude_list_keys)).values():
+        if items:
+            exclude_ids.update([item.id for item in items])
+    return exclude_list_keys, exclude_ids
+
+
 def clear_user_cache(member):
     """
     Delete all the exclude list from the cache, as well as the list containing their keys
@@ -152,14 +269,186 @@ def clear_user_cache(member):
         cache.delete_many(exclude_list_keys)
 
 
+def serialize_media(items, fields=None):
+    """
+    Turns a list of Movie, Series and/or SeriesEpisode into a list of dict
+    suitable for JSON output. Unlike calling to_dict() on each item, objects
+    shared by items (Series of episodes, providers, config) are resolved once
+    for the whole list and only the requested keys are computed.
+    :param items: list of Movie, Series or SeriesEpisode
+    :param fields: keys to output. Defaults to MEDIA_CARD_FIELDS
+    :return: list of dict in the same order as items
+    """
+    items = list(items)
+    if not items:
+        return []
+    if fields is None:
+        fields = MEDIA_CARD_FIELDS
+
+    series_ids = set([item.series_id for item in items if isinstance(item, SeriesEpisode)])
+    series_by_id = {}
+    if series_ids:
+        series_by_id = dict([(series.id, series) for series in Series.objects.filter(pk__in=list(series_ids))])
+
+    def get_parent(item):
+        # Episodes take their poster, provider and view_price from their Series
+        if isinstance(item, SeriesEpisode):
+            return series_by_id.get(item.series_id) or item.series
+        return item
+
+    providers_by_id = {}
+    if 'poster' in fields:
+        provider_ids = set([get_parent(item).provider_id for item in items])
+        provider_ids.discard(None)
+        if provider_ids:
+            providers_by_id = dict([(provider.id, provider)
+                                    for provider in Service.objects.filter(pk__in=list(provider_ids))])
+
+    config = None
+    if 'display_load' in fields and getattr(settings, 'IS_GAME_VENDOR', False):
+        config = get_config()
+
+    posters = {}
+
+    def get_poster(media):
+        poster = media.poster
+        key = (poster.name, media.provider_id)
+        if key not in posters:
+            if poster.name:
+                provider = providers_by_id.get(media.provider_id)
+                posters[key] = {
+                    'url': from_provider(poster.url, provider),
+                    'small_url': from_provider(poster.small_url, provider),
+                    'thumb_url': from_provider(poster.thumb_url, provider)
+                }
+            else:
+                posters[key] = {'url': DEFAULT_POSTER, 'small_url': DEFAULT_POSTER, 'thumb_url': DEFAULT_POSTER}
+        return dict(posters[key])
+
+    missing = object()
+    serialized = []
+    for item in items:
+        parent = get_parent(item)
+        is_episode = parent is not item
+        var = {}
+        for field in fields:
+            if field == 'poster':
+                var['poster'] = get_poster(parent)
+            elif field == 'display_load':
+                var['display_load'] = item.get_display_load(config)
+            elif field == 'view_price' and is_episode:
+                var['view_price'] = parent.view_price
+            elif field == 'release':
+                release = getattr(item, 'release', missing)
+                if release is not missing:
+                    var['release'] = release.strftime('%Y-%m-%d') if release else None
+            else:
+                value = getattr(item, field, missing)
+                if value is not missing:
+                    var[field] = value
+        serialized.append(var)
+    return serialized
+
+
+def get_members_display_data(member_ids):
+    """
+    Gets display data of Members from the cache, fetching those missing
+    with a single query and caching them for MEMBER_DISPLAY_CACHE_TIMEOUT.
+    :param member_ids: ids of the members
+    :return: dict mapping the id of each member found to {'id', 'full_name', 'email'}
+    """
+    keys = dict([(MEMBER_DISPLAY_CACHE_KEY_PREFIX + pk, pk) for pk in set(member_ids)])
+    display_data = dict([(keys[key], data) for key, data in cache.get_many(keys.keys()).items()])
+    missing_ids = [pk for pk in keys.values() if pk not in display_data]
+    if missing_ids:
+        fetched = {}
+        for member in Member.objects.filter(pk__in=missing_ids):
+            fetched[member.id] = {'id': member.id, 'full_name': member.full_name, 'email': member.email}
+        cache.set_many(dict([(MEMBER_DISPLAY_CACHE_KEY_PREFIX + pk, data) for pk, data in fetched.items()]),
+                       MEMBER_DISPLAY_CACHE_TIMEOUT)
+        display_data.update(fetched)
+    return display_data
+
+
+def resolve_owners(media_list):
+    """
+    Sets the owner_list of all the media at once, so that the
+    members are resolved with at most one query for the whole list.
+    Owners that do not exist anymore are skipped.
+    :param media_list: list of Movie and/or Series
+    """
+    media_list = list(media_list)
+    owner_ids = [pk for media in media_list for pk in media.owner_fk_list]
+    display_data = get_members_display_data(owner_ids) if owner_ids else {}
+    for media in media_list:
+        media.owner_list = [display_data[pk] for pk in media.owner_fk_list if pk in display_data]
+    return media_list
+
+
+def remove_special_words(s):
+    s = re.sub("^the ", '', s)
+    s = re.sub("^at ", '', s)
+    s = re.sub("^in ", '', s)
+    s = re.sub("^le ", '', s)
+    s = re.sub("^la ", '', s)
+    s = re.sub("^les ", '', s)
+    s = re.sub("^l'", '', s)
+    s = re.sub("^un ", '', s)
+    s = re.sub("^une ", '', s)
+    s = re.sub("^des ", '', s)
+    s = re.sub("^d'", '', s)
+    s = re.sub("^de ", '', s)
+    s = re.sub("^du ", '', s)
+    s = re.sub("^a ", '', s)
+    s = re.sub("^et ", '', s)
+    s = re.sub("^en ", '', s)
+    s = s.replace(" the ", " ")\
+        .replace(" at ", " ")\
+        .replace(" in ", " ")\
+        .replace(" of ", " ")\
+        .replace(" le ", " ")\
+        .replace(" la ", " ")\
+        .replace(" les ", " ")\
+        .replace(" l'", " ")\
+        .replace(" un ", " ")\
+        .replace(" une ", " ")\
+        .replace(" des ", " ")\
+        .replace(" d'", " ")\
+        .replace(" de ", " ")\
+        .replace(" du ", " ")\
+        .replace(" a ", " ")\
+        .replace(" et ", " ")\
+        .replace(" en ", " ")\
+        .replace(" 1", "")\
+        .replace(" 2", "")\
+        .replace(" 3", "")\
+        .replace(" 4", "")\
+        .replace(" 5", "")\
+        .replace(" 6", "")\
+        .replace(" 7", "")\
+        .replace(" 8", "")\
+        .replace(" 9", "")
+    return s
+
+
 def get_unit_prepayment(member, media):
     now = datetime.now()
-    for tp in UnitPrepayment.objects.filter(member=member, status=Prepayment.CONFIRMED, expiry__gte=now):
-        if type(media).__name__ == "Movie":
-            if media.id == tp.media_id:
-                return tp
-        elif media.series.id == tp.media_id:
-            return tp
+    media_id = media.id if type(media).__name__ == "Movie" else media.series_id
+    prepayments = list(UnitPrepayment.objects.filter(member=member, status=Prepayment.CONFIRMED, expiry__gte=now,
+                                                     media_id=media_id)[:1])
+    return prepayments[0] if prepayments else None
+
+
+def get_device(request):
+    """
+    Class of the device of the visitor: mobile, tablet or desktop
+    """
+    user_agent = request.user_agent
+    if user_agent.is_mobile:
+        return 'mobile'
+    if user_agent.is_tablet:
+        return 'tablet'
+    return 'desktop'
 
 
 def extract_resource_url(iframe_code):
@@ -177,7 +466,7 @@ def extract_resource_url(iframe_code):
 
 
 def render_suggest_payment_template(request, media):
-    config = get_service_instance().config
+    config = get_config()
     html_template = get_template('movies/snippets/suggest_payment.html')
     if isinstance(media, SeriesEpisode):
         media = media.series
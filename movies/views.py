@@ -4,24 +4,36 @@ import logging
 from datetime import datetime
 from random import shuffle
 
-import requests
 from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 from django.http.response import HttpResponse, HttpResponseRedirect, HttpResponseForbidden
 from django.shortcuts import render, get_object_or_404
-from django.template.defaultfilters import slugify
 from django.utils.decorators import method_decorator
-from django.utils.module_loading import import_by_path
 from django.utils.translation import gettext as _
 from django.views.decorators.cache import cache_page
 from ikwen.accesscontrol.utils import VerifiedEmailTemplateView
+from ikwen_shavida.movies.catalog import get_catalog
+from ikwen_shavida.movies.counters import get_media_counts
 from ikwen_shavida.movies.models import *
-from ikwen_shavida.movies.utils import get_all_recommended, EXCLUDE_LIST_KEYS_KEY, get_recommended_for_category, \
-    get_movies_series_share, get_unit_prepayment, render_suggest_payment_template, extract_resource_url
-from ikwen_shavida.reporting.models import StreamLogEntry
+from ikwen_shavida.movies.increments import buffer_increment
+from ikwen_shavida.movies.origins import find_media_url, is_found_cached
+from ikwen_shavida.movies.stream_sessions import start_stream_session, touch_stream_session
+from ikwen_shavida.movies.page_cache import anonymous_cache_page
+from ikwen_shavida.movies.play_tokens import mint_play_token, get_play_authorization
+from ikwen_shavida.movies.related import get_suggested_ids
+from ikwen_shavida.movies.search import get_search_index
+from ikwen_shavida.movies.utils import EXCLUDE_LIST_KEYS_KEY, get_recommended_ids_for_category, \
+    get_cached_exclude_ids, get_movies_series_share, get_unit_prepayment, render_suggest_payment_template, \
+    extract_resource_url, serialize_media, sample_media, get_popular_ids, get_device
+from ikwen_shavida.movies.warmer import warm_recommendations_async
+from ikwen_shavida.reporting.cowatch import get_co_watched_recommended
+from ikwen_shavida.reporting.metering import get_vod_balance
+from ikwen_shavida.reporting.stream_log import log_stream
 from ikwen_shavida.sales.models import RetailBundle, VODBundle, VODPrepayment, Prepayment, UnitPrepayment, \
     RetailPrepayment
+from ikwen_shavida.shavida.entitlements import get_entitlements
+from ikwen_shavida.shavida.middleware import get_service, get_config
 from ikwen_shavida.shavida.views import BaseView
 
 logger = logging.getLogger('ikwen')
@@ -33,10 +45,10 @@ class CustomerView(VerifiedEmailTemplateView):
         context = super(CustomerView, self).get_context_data(**kwargs)
         member = self.request.user
         if member.is_authenticated():
-            last_prepayment = member.customer.get_last_retail_prepayment()
-            last_vod_prepayment = member.customer.get_last_vod_prepayment()
+            entitlements = get_entitlements(member)
+            last_prepayment = entitlements.last_prepayment
             context['last_prepayment'] = last_prepayment
-            context['last_vod_prepayment'] = last_vod_prepayment
+            context['last_vod_prepayment'] = entitlements.last_vod_prepayment
             context['is_iOS'] = 'OS' in self.request.user_agent.os.family
             available_quota = 0
             if last_prepayment:
@@ -58,13 +70,25 @@ class CustomerView(VerifiedEmailTemplateView):
 class Home(CustomerView):
     template_name = 'movies/home.html'
 
-    # @method_decorator(cache_page(60 * 5))
+    @method_decorator(anonymous_cache_page())
+    def get(self, request, *args, **kwargs):
+        return super(Home, self).get(request, *args, **kwargs)
+
     def get_context_data(self, **kwargs):
         context = super(Home, self).get_context_data(**kwargs)
         member = self.request.user
         recommended_items = []
         if member.is_authenticated():
-            recommended_items = get_all_recommended(member, 12)
+            recommended_items = get_co_watched_recommended(member, 12)
+            if len(recommended_items) < 12:
+                recommended_ids = set([item.id for item in recommended_items])
+                all_recommended = cache.get(member.username + ':recommended')
+                if all_recommended is None:
+                    # Recommendations are computed in background, popular media are shown meanwhile.
+                    warm_recommendations_async(member)
+                    all_recommended = get_catalog().fetch(get_popular_ids(12))
+                additional_items = [item for item in all_recommended if item.id not in recommended_ids]
+                recommended_items.extend(additional_items[:12 - len(recommended_items)])
             if len(recommended_items) < Movie.MIN_RECOMMENDED:
                 additional = Movie.MIN_RECOMMENDED - len(recommended_items)
                 additional_items = Movie.objects.filter(visible=True).order_by('-release')[:additional]
@@ -72,16 +96,17 @@ class Home(CustomerView):
         else:
             try:
                 top = Category.objects.get(slug='top')
-                recommended_items = list(Movie.objects.raw_query({'categories': {'$elemMatch': {'id': ObjectId(top.id)}}, 'visible': True}))
-                recommended_items.extend(list(Series.objects.raw_query({'categories': {'$elemMatch': {'id': ObjectId(top.id)}}, 'visible': True})))
+                catalog = get_catalog()
+                top_ids = list(catalog.get_movie_ids(top.id))
+                top_ids.extend(catalog.get_series_ids(top.id))
+                recommended_items = catalog.fetch(top_ids)
                 context['top_title'] = top.previews_title if top.previews_title else top.title
             except Category.DoesNotExist:
                 pass
 
         context['recommended_items'] = recommended_items
-        recent_releases = list(Movie.objects.filter(visible=True).order_by('-release', '-id')[:Movie.MAX_RECENT])
-        shuffle(recent_releases)
-        sample_media = recent_releases[0] if len(recent_releases) > 0 else None
+        sample_list = sample_media(Movie)
+        og_item = sample_list[0] if sample_list else None
         og_url = ''
         hash = self.request.GET.get('_escaped_fragment_')
         if hash:
@@ -89,14 +114,14 @@ class Home(CustomerView):
             slug = hash.replace('movie-', '') if media_type == 'movie' else hash.replace('series-', '')
             try:
                 if media_type == 'movie':
-                    sample_media = Movie.objects.get(slug=slug)
+                    og_item = Movie.objects.get(slug=slug)
                     og_url = '/#!movie-' + slug
                 else:
-                    sample_media = Series.objects.get(slug=slug)
+                    og_item = Series.objects.get(slug=slug)
                     og_url = '/#!series-' + slug
             except ObjectDoesNotExist:
                 pass
-        context['og_item'] = sample_media
+        context['og_item'] = og_item
         context['og_url'] = og_url
         return context
 
@@ -110,14 +135,12 @@ class MediaList(CustomerView):
         category = Category.objects.get(slug=slug)
         context['current_category'] = category
         context['category_top'] = Category.objects.get(slug='top')
-        movies_qs = category.get_movies_queryset()
-        series_qs = category.get_series_queryset()
+        catalog = get_catalog()
+        sample_ids = catalog.get_movie_ids(category.id)[:1] or catalog.get_series_ids(category.id)[:1]
         sample_media = None
         og_url = ''
-        if movies_qs.count() > 0:
-            sample_media = movies_qs[0]
-        elif series_qs.count() > 0:
-            sample_media = series_qs[0]
+        if sample_ids:
+            sample_media = catalog.fetch(sample_ids)[0]
         hash = self.request.GET.get('_escaped_fragment_')
         if hash:
             media_type = 'movie' if hash.startswith('movie-') else 'series'
@@ -135,7 +158,7 @@ class MediaList(CustomerView):
         context['og_url'] = og_url
         return context
 
-    # @method_decorator(cache_page(60 * 5))
+    @method_decorator(anonymous_cache_page())
     def get(self, request, *args, **kwargs):
         slug = kwargs['slug']
         category = get_object_or_404(Category, slug=slug)
@@ -167,7 +190,7 @@ class Bundles(CustomerView):
         context['is_bundle_page'] = True
         return context
 
-    # @method_decorator(cache_page(60 * 5))
+    @method_decorator(anonymous_cache_page())
     def get(self, request, *args, **kwargs):
         # Wipe Prepayment resulting from an incomplete checkout operation
         if request.user.is_authenticated():
@@ -207,24 +230,8 @@ class MovieDetail(CustomerView):
             slug = self.kwargs.get('slug', None)
         movie = get_object_or_404(Movie, slug=slug)
         context['media'] = movie
-        groups = ' '.join([val.strip() for val in movie.groups.split(' ') if val != ''])
-        suggestions = []
-        if groups:
-            suggestions = [movie for movie in
-                           Movie.objects.raw_query(
-                               {'$text': {'$search': groups}, 'visible': True}
-                           ).exclude(pk=movie.id).order_by("-id")]
-        if len(suggestions) < MovieDetail.MAX_SUGGESTIONS:
-            limit = MovieDetail.MAX_SUGGESTIONS - len(suggestions)
-            categories_ids = [ObjectId(category.id) for category in movie.categories]
-            exclude_ids = [item.id for item in suggestions]
-            exclude_ids.append(movie.id)
-            categories_suggestions = [movie for movie in
-                                      Movie.objects.raw_query(
-                                          {'categories': {'$elemMatch': {'id': {'$in': categories_ids}}}, 'visible': True}
-                                      ).exclude(pk__in=exclude_ids).order_by("-id")[:limit]]
-            suggestions.extend(categories_suggestions)
-        context['suggestions'] = [movie.to_dict() for movie in suggestions]
+        suggested_ids = get_suggested_ids(movie, MovieDetail.MAX_SUGGESTIONS)
+        context['suggestions'] = get_catalog().get_cards(suggested_ids)
         return context
 
     def render_to_response(self, context, **response_kwargs):
@@ -249,24 +256,8 @@ class SeriesDetail(CustomerView):
         current_series = get_object_or_404(Series, slug=slug)
         context['episodes'] = [ep for ep in SeriesEpisode.objects.filter(series=current_series).order_by('id')]
         context['media'] = current_series
-        groups = ' '.join([val.strip() for val in current_series.groups.split(' ') if val != ''])
-        suggestions = []
-        if groups:
-            suggestions = [series for series in
-                           Series.objects.raw_query(
-                               {'$text': {'$search': groups}, 'visible': True}
-                           ).exclude(pk=current_series.id).order_by("-id")]
-        if len(suggestions) < SeriesDetail.MAX_SUGGESTIONS:
-            limit = SeriesDetail.MAX_SUGGESTIONS - len(suggestions)
-            categories_ids = [ObjectId(category.id) for category in current_series.categories]
-            exclude_ids = [item.id for item in suggestions]
-            exclude_ids.append(current_series.id)
-            categories_suggestions = [series for series in
-                                      Series.objects.raw_query(
-                                          {'categories': {'$elemMatch': {'id': {'$in': categories_ids}}}, 'visible': True}
-                                      ).exclude(pk__in=exclude_ids).order_by("-id")[:limit]]
-            suggestions.extend(categories_suggestions)
-        context['suggestions'] = [series.to_dict() for series in suggestions]
+        suggested_ids = get_suggested_ids(current_series, SeriesDetail.MAX_SUGGESTIONS)
+        context['suggestions'] = get_catalog().get_cards(suggested_ids)
         return context
 
     def render_to_response(self, context, **response_kwargs):
@@ -282,7 +273,7 @@ class Search(CustomerView):
         context = super(Search, self).get_context_data(**kwargs)
         context['page_title'] = ''
         radix = self.request.GET.get('q')
-        results = [item.to_dict() for item in self.grab_items_by_radix(radix)]
+        results = self.grab_items_by_radix(radix)
         sample_media = None
         og_url = ''
         hash = self.request.GET.get('_escaped_fragment_')
@@ -306,7 +297,7 @@ class Search(CustomerView):
     def render_to_response(self, context, **response_kwargs):
         if self.request.GET.get('format') == 'json':
             terms = self.request.GET.get('q')
-            response = [item.to_dict() for item in self.grab_items_by_radix(terms, use_limit=True)]
+            response = self.grab_items_by_radix(terms, use_limit=True)
             return HttpResponse(
                 json.dumps(response),
                 'content-type: text/json',
@@ -318,46 +309,21 @@ class Search(CustomerView):
             return super(Search, self).render_to_response(context, **response_kwargs)
 
     def grab_items_by_radix(self, terms, use_limit=False):
-        total = 10 if use_limit else 10000
-        if use_limit:
-            limit_movies, limit_series = get_movies_series_share(total)
-        else:
-            limit_movies, limit_series = 10000, 10000
-        items = set()
-        if terms and len(terms) >= 2:
-            word = slugify(terms)
-            if word:
-                movies = [movie for movie in
-                          Movie.objects.filter(tags__icontains=word, visible=True)[:limit_movies]]
-                items = items.union(movies)
-                if len(items) < total:
-                    limit_series = total - len(items) if use_limit else 10000
-                    series = [series for series in Series.objects.filter(tags__icontains=word, visible=True)[:limit_series]]
-                    items = items.union(series)
-        # if terms and len(terms) >= 2:
-        #     stripped_terms = ' '.join([term.strip()[:4] for term in terms.split(' ') if term])
-        #     if limit_movies > 0:
-        #         movies = [movie for movie in Movie.objects.raw_query(
-        #             {'$text': {'$search': stripped_terms}, 'visible': True}
-        #         )[:limit_movies]]
-        #         items.extend(movies)
-        #     if limit_series:
-        #         series = [series for series in Series.objects.raw_query(
-        #             {'$text': {'$search': stripped_terms}, 'visible': True}
-        #         )[:limit_series]]
-        #         items.extend(series)
-        show_adult = self.request.user.is_authenticated() and self.request.user.customer.get_can_access_adult_content()
-        items = list(items)
-        for item in items:
-            if type(item).__name__ == "Movie" and item.is_adult:
-                if not show_adult:
-                    items.remove(item)
-        return items
+        """
+        :return: serialized media matching terms, best matches first
+        """
+        if not terms or len(terms) < 2:
+            return []
+        limit = 10 if use_limit else None
+        member = self.request.user
+        show_adult = member.is_authenticated() and get_entitlements(member).can_access_adult_content
+        media_ids = get_search_index().search(terms, limit, show_adult)
+        return get_catalog().get_cards(media_ids)
 
 
 def get_media(request, *args, **kwargs):
     """
-    :param request:
+    :param request: Passing sample=yes returns random media of the category instead of a page of it.
     :return: list of media (movies and/or series)
     """
     category_id = request.GET.get('category_id') if request.GET.get('category_id') else None
@@ -369,30 +335,29 @@ def get_media(request, *args, **kwargs):
     if not length:
         length = category.previews_length
     response = []
-    if category_id and length and (start_movies != '' or start_series != ''):
+    if category_id and length and request.GET.get('sample'):
+        movies_length, series_length = get_movies_series_share(length)
+        media = sample_media(Movie, movies_length, category)
+        media.extend(sample_media(Series, series_length, category))
+        response = get_catalog().get_cards([item.id for item in media])
+        shuffle(response)
+    elif category_id and length and (start_movies != '' or start_series != ''):
         start_movies = int(start_movies)
         start_series = int(start_series)
-        cache_key = '%s-%d-%d-%d' % (category_id, start_movies, start_series, length)
-        media = cache.get(cache_key)
-        if not media:
-            movies_length, series_length = get_movies_series_share(length)
-            movies_qs = Movie.objects.raw_query({'categories': {'$elemMatch': {'id': ObjectId(category.id)}}, 'visible': True}).order_by('-id')
-            series_qs = Series.objects.raw_query({'categories': {'$elemMatch': {'id': ObjectId(category.id)}}, 'visible': True}).order_by('-id')
-            movies_qs_count = movies_qs.count()
-            series_qs_count = series_qs.count()
-            if movies_qs_count < movies_length:
-                series_length += (movies_length - movies_qs_count)
-            if series_qs_count < series_length:
-                movies_length += (series_length - series_qs_count)
-            limit_movies = start_movies + movies_length
-            limit_series = start_series + series_length
-            media = list(movies_qs[start_movies:limit_movies])
-            series = list(series_qs[start_series:limit_series])
-            media.extend(series)
-            cache.set(cache_key, media, 10 * 60)
+        catalog = get_catalog()
+        movies_length, series_length = get_movies_series_share(length)
+        total_movies, total_series = get_media_counts(category.id)
+        if total_movies < movies_length:
+            series_length += (movies_length - total_movies)
+        if total_series < series_length:
+            movies_length += (series_length - total_series)
+        movie_ids = catalog.get_movie_ids(category.id)
+        series_ids = catalog.get_series_ids(category.id)
+        media_ids = movie_ids[start_movies:start_movies + movies_length]
+        media_ids.extend(series_ids[start_series:start_series + series_length])
+        response = catalog.get_cards(media_ids)
         if request.GET.get('shuffle'):
-            shuffle(media)
-        response = [item.to_dict() for item in media]
+            shuffle(response)
     return HttpResponse(
         json.dumps(response),
         'content-type: text/json'
@@ -401,7 +366,7 @@ def get_media(request, *args, **kwargs):
 
 def stream_or_download(request, *args, **kwargs):
     # TODO: Handle the reading of multipart files, else only the first part will be streamed
-    service = get_service_instance()
+    service = get_service()
     media_type = request.GET['type']
     item_id = request.GET['item_id']
     action = request.GET['action']
@@ -409,9 +374,20 @@ def stream_or_download(request, *args, **kwargs):
     if not referrer:
         return HttpResponseForbidden("You don't have permission to access this resource.")
     try:
-        config = get_service_instance().config
         is_check = request.GET.get('is_check')
         member = request.user
+        device = get_device(request)
+        token = request.GET.get('token')
+        if token and member.is_authenticated():
+            # Follow-up of an authorized play: answer without checking the access again
+            authorization = get_play_authorization(token, member, media_type, item_id, action, device)
+            if authorization:
+                touch_stream_session(member)
+                if is_check:
+                    return HttpResponse(json.dumps(authorization), 'content-type: text/json')
+                if authorization.get('media_url'):
+                    return HttpResponseRedirect(authorization['media_url'])
+        config = get_config()
         if media_type == 'movie':
             media = Movie.objects.get(pk=item_id)
         elif media_type == 'series':
@@ -427,15 +403,17 @@ def stream_or_download(request, *args, **kwargs):
                     return HttpResponse(json.dumps(response), 'content-type: text/json')
 
         if is_check:
-            media.clicks += 1
-            media.save()
+            buffer_increment(media, clicks=1)
             if member.is_authenticated():
                 # Saving a LogEntry with duration=0 and bytes=0.
                 # This is just to make the history aware that user was interested
                 # in this media; and later use it in the suggestion algorithm.
-                StreamLogEntry.objects.create(member=member, media_type=media_type, media_id=item_id, duration=0,
-                                              bytes=0)
+                log_stream(member, media_type, item_id, duration=0, bytes=0)
+                # Starting a stream ends the previous session, which can now be reduced and
+                # taken into account by the recommendations.
+                warm_recommendations_async(member)
 
+        access_expiry = None  # Expiry of the prepayment giving access to the media
         if media_type != 'trailer' and (media.view_price > 0 or media.download_price > 0):
             if not member.is_authenticated():
                 response = {"error": _("Please login first.")}
@@ -455,7 +433,7 @@ def stream_or_download(request, *args, **kwargs):
                         "html": render_suggest_payment_template(request, media)
                     }
                     return HttpResponse(json.dumps(response), 'content-type: text/json')
-                elif latest_vod_prepayment.balance <= 0:
+                elif get_vod_balance(member, latest_vod_prepayment) <= 0:
                     response = {
                         "error": _("Sorry, your VOD bundle is sold out. Please buy a new one."),
                         "html": render_suggest_payment_template(request, media)
@@ -472,37 +450,30 @@ def stream_or_download(request, *args, **kwargs):
                         else:
                             response = {"error": _("Sorry, you can't access this content. Please contact your provider.")}
                             return HttpResponse(json.dumps(response), 'content-type: text/json')
+                access_expiry = latest_vod_prepayment.get_expiry()
+            else:
+                access_expiry = unit_prepayment.expiry
 
             if action == 'download':
                 return HttpResponseRedirect(unit_prepayment.download_link)
 
-        item_url = ''
-        found = False
-        resource_to_use = None
         media_sources = config.data_sources.split(',')
-        for folder in media_sources:
-            path = getattr(settings, 'MAKE_MEDIA_URL', 'ikwen_shavida.movies.views.make_media_url')
-            url_maker = import_by_path(path)
-            item_url = url_maker(request, folder, media, *args, **kwargs)
-            resource_to_use = get_resource_to_use(request, folder, media)
-            try:
-                status_code = requests.head(item_url).status_code
-                if status_code == 200 or status_code == 302 or status_code == 301:
-                    found = True
-                    break
-                else:
-                    logger.debug("%s - Could not read video %s. Error code: %s" % (service.project_name, item_url, status_code))
-            except:
-                logger.error("%s - Failed to access video %s" % (service.project_name, item_url), exc_info=True)
-                continue
+        item_url, folder, found = find_media_url(request, media, media_sources, *args, **kwargs)
+        resource_to_use = get_resource_to_use(request, folder, media)
         if is_check:
             if not found:
                 response = {"error": _("Resource unavailable. Please try again later."), "item_url": item_url}
                 return HttpResponse(json.dumps(response), 'content-type: text/json')
             if '<iframe ' in resource_to_use:
                 response = {'html': resource_to_use}
-                return HttpResponse(json.dumps(response), 'content-type: text/json')
-            response = {'media_url': item_url}
+            else:
+                response = {'media_url': item_url}
+            if member.is_authenticated():
+                start_stream_session(member, folder)
+            if member.is_authenticated() and is_found_cached(request, media, folder):
+                # Only a URL known to serve the media is handed to follow-up requests
+                response['token'] = mint_play_token(member, media_type, item_id, action, device, dict(response),
+                                                    access_expiry)
             return HttpResponse(json.dumps(response), 'content-type: text/json')
 
         return HttpResponseRedirect(item_url)
@@ -547,20 +518,13 @@ def get_recommended_for_single_category(request, *args, **kwargs):
         cache_key = member.username + ':recommended-' + category_id
         recommended = cache.get(cache_key)
         if not recommended:
-            exclude_list_keys = cache.get(member.username + ':' + EXCLUDE_LIST_KEYS_KEY)
-            exclude_list = []
-            if not exclude_list_keys:
-                exclude_list_keys = set()
-            else:
-                for key in exclude_list_keys:
-                    items = cache.get(key)
-                    if items:
-                        exclude_list.extend(items)
-            recommended = get_recommended_for_category(category, category.previews_length, exclude_list)
+            exclude_list_keys, exclude_ids = get_cached_exclude_ids(member)
+            recommended_ids = get_recommended_ids_for_category(category, category.previews_length, exclude_ids)
+            recommended = get_catalog().fetch(recommended_ids)
             exclude_list_keys.add(cache_key)
             cache.set(cache_key, recommended)
             cache.set(member.username + ':' + EXCLUDE_LIST_KEYS_KEY, exclude_list_keys)
-        response = [item.to_dict() for item in recommended]
+        response = serialize_media(recommended)
     return HttpResponse(
         json.dumps(response),
         'content-type: text/json'
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Background computation of the recommendation rows of members. Computing
+them involves get_watched() which reduces the stream log entries of the
+member, so it is kept off the request path: rows are recomputed by a
+worker thread when the member logs in and when a stream session ends,
+then written to the cache at once with cache.set_many().
+
+The home page reads the rows from the cache and shows popular media
+while they are not ready yet.
+"""
+import logging
+from Queue import Queue
+from threading import Lock, Thread
+
+from django.core.cache import cache
+
+from ikwen_shavida.movies.categories import get_category_registry
+from ikwen_shavida.movies.utils import EXCLUDE_LIST_KEYS_KEY, TOTAL_RECOMMENDED, compute_recommended_rows
+
+__author__ = "Kom Sihon"
+
+logger = logging.getLogger('ikwen')
+
+HOME_ROWS_COUNT = 5  # Category rows loaded by the home page before the member scrolls
+
+_queue = Queue()
+_lock = Lock()
+_state = {'worker': None, 'queued': set()}
+
+
+def warm_recommendations(member):
+    """
+    Computes the general and home category recommendation rows of member and
+    replaces the ones in cache. Lists previously cached and not recomputed are dropped.
+    """
+    categories = [category for category in get_category_registry().all() if category.visible][:HOME_ROWS_COUNT]
+    rows = compute_recommended_rows(member, TOTAL_RECOMMENDED, categories)
+    exclude_list_keys_key = member.username + ':' + EXCLUDE_LIST_KEYS_KEY
+    previous_keys = cache.get(exclude_list_keys_key)
+    if previous_keys:
+        stale_keys = [key for key in previous_keys if key not in rows]
+        if stale_keys:
+            cache.delete_many(stale_keys)
+    cache.set_many(rows)
+
+
+def _work():
+    while True:
+        member = _queue.get()
+        with _lock:
+            _state['queued'].discard(member.id)
+        try:
+            warm_recommendations(member)
+        except:
+            logger.error("Failed to warm recommendations of %s" % member.username, exc_info=True)
+        finally:
+            _queue.task_done()
+
+
+def warm_recommendations_async(member):
+    """
+    Queues the computation of the recommendation rows of member. A member
+    already waiting in the queue is not queued again.
+    """
+    with _lock:
+        if member.id in _state['queued']:
+            return
+        _state['queued'].add(member.id)
+        worker = _state['worker']
+        if worker is None or not worker.is_alive():
+            worker = Thread(target=_work)
+            worker.daemon = True
+            worker.start()
+            _state['worker'] = worker
+    _queue.put(member)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Item-to-item collaborative filtering. Two media are similar when the same
+members watched both. The reduced StreamLogEntry make a sparse member x media
+matrix; each CoWatch keeps a column of its product with itself: the number
+of watchers of a media and the number of watchers it shares with each other
+media. The similarity of two media is the cosine of their columns:
+co_count / sqrt(watchers_count_1 * watchers_count_2).
+
+update_co_watches() folds the entries reduced since the last checkpoint into
+those counts and recomputes the neighbors of the media whose counts changed.
+Entries logged too recently to be surely inserted are left for a later run
+(see reporting.stream_log), since the checkpoint only moves forward.
+It is meant to run periodically with the command update_co_watches. Columns
+are sparse dicts rather than SciPy matrices, which are not among the dependencies.
+"""
+import heapq
+import math
+
+from ikwen_shavida.movies.catalog import get_catalog
+from ikwen_shavida.movies.models import SeriesEpisode
+from ikwen_shavida.reporting.models import StreamLogEntry, CoWatch, CoWatchCheckpoint
+from ikwen_shavida.reporting.stream_log import get_settled_id
+from ikwen_shavida.reporting.utils import reduce_stream_log_entries
+
+__author__ = "Kom Sihon"
+
+NEIGHBORS_COUNT = 20
+RECENT_ENTRIES_COUNT = 50  # Entries read to find the media a member recently watched
+RECENT_ITEMS_COUNT = 10  # Recently watched media whose neighbors are merged for recommendations
+
+
+def _get_items(entries):
+    """
+    Maps stream log entries to the media they are about: movies, or
+    series in the case of episodes. Entries of deleted episodes are dropped.
+    :return: list of tuples (entry, media_type, media_id)
+    """
+    episode_ids = list(set([entry.media_id for entry in entries if entry.media_type.lower() != 'movie']))
+    series_ids = {}
+    if episode_ids:
+        series_ids = dict([(episode.id, episode.series_id) for episode in SeriesEpisode.objects.filter(pk__in=episode_ids)])
+    items = []
+    for entry in entries:
+        if entry.media_type.lower() == 'movie':
+            items.append((entry, 'movie', entry.media_id))
+        elif entry.media_id in series_ids:
+            items.append((entry, 'series', series_ids[entry.media_id]))
+    return items
+
+
+def _get_checkpoint():
+    try:
+        return CoWatchCheckpoint.objects.all()[0]
+    except IndexError:
+        return CoWatchCheckpoint()
+
+
+def _get_new_entries(checkpoint):
+    """
+    Reduces pending entries, then gets the reduced entries created since the checkpoint. Entries
+    from the first one still being Single or which insert may still be pending are left for the
+    next run, so that none is missed.
+    """
+    for member_id in set([entry.member_id for entry in StreamLogEntry.objects.filter(status=StreamLogEntry.SINGLE)]):
+        reduce_stream_log_entries(member_id)
+    entries = StreamLogEntry.objects.filter(status=StreamLogEntry.REDUCED, id__lt=get_settled_id())
+    if checkpoint.last_entry_id:
+        entries = entries.filter(id__gt=checkpoint.last_entry_id)
+    singles = list(StreamLogEntry.objects.filter(status=StreamLogEntry.SINGLE).order_by('id')[:1])
+    if singles:
+        entries = entries.filter(id__lt=singles[0].id)
+    return list(entries.order_by('id'))
+
+
+def _get_co_watch(co_watches, media_type, media_id):
+    co_watch = co_watches.get(media_id)
+    if co_watch is None:
+        co_watch = CoWatch(media_id=media_id, media_type=media_type, co_counts={}, neighbor_ids=[])
+        co_watches[media_id] = co_watch
+    return co_watch
+
+
+def _increment(co_watch, media_id):
+    co_watch.co_counts[media_id] = co_watch.co_counts.get(media_id, 0) + 1
+
+
+def get_neighbors(co_watch, watchers_counts):
+    """
+    Ids of the media most similar to the one of co_watch, most similar first
+    :param watchers_counts: dict {media_id: watchers_count} of the media in co_watch.co_counts
+    """
+    scores = {}
+    for media_id, co_count in co_watch.co_counts.items():
+        watchers_count = watchers_counts.get(media_id)
+        if watchers_count and co_watch.watchers_count:
+            scores[media_id] = co_count / math.sqrt(co_watch.watchers_count * watchers_count)
+    return heapq.nlargest(NEIGHBORS_COUNT, scores, key=lambda pk: (scores[pk], pk))
+
+
+def update_co_watches(full=False):
+    """
+    Folds the stream log entries reduced since the last run into the CoWatch
+    statistics and recomputes the neighbors of the media affected.
+    :param full: If True, statistics are computed again from all the entries
+    :return: number of entries processed
+    """
+    checkpoint = _get_checkpoint()
+    if full:
+        CoWatch.objects.all().delete()
+        checkpoint.last_entry_id = None
+    entries = _get_new_entries(checkpoint)
+    if not entries:
+        return 0
+
+    new_items_by_member = {}
+    for entry, media_type, media_id in _get_items(entries):
+        new_items_by_member.setdefault(entry.member_id, {})[media_id] = media_type
+    old_items_by_member = {}
+    if checkpoint.last_entry_id:
+        for member_id in new_items_by_member.keys():
+            old_entries = list(StreamLogEntry.objects.filter(member=member_id, status=StreamLogEntry.REDUCED,
+                                                             id__lte=checkpoint.last_entry_id))
+            old_items_by_member[member_id] = dict([(media_id, media_type)
+                                                   for entry, media_type, media_id in _get_items(old_entries)])
+
+    media_ids = set()
+    for member_id, new_items in new_items_by_member.items():
+        media_ids.update(new_items.keys())
+        media_ids.update(old_items_by_member.get(member_id, {}).keys())
+    co_watches = dict([(co_watch.media_id, co_watch)
+                       for co_watch in CoWatch.objects.filter(media_id__in=list(media_ids))])
+
+    touched_ids = set()
+    for member_id, new_items in new_items_by_member.items():
+        old_items = old_items_by_member.get(member_id, {})
+        new_ids = [media_id for media_id in new_items if media_id not in old_items]
+        for i, media_id in enumerate(new_ids):
+            co_watch = _get_co_watch(co_watches, new_items[media_id], media_id)
+            co_watch.watchers_count += 1
+            touched_ids.add(media_id)
+            others = [(old_id, old_items[old_id]) for old_id in old_items]
+            others.extend([(other_id, new_items[other_id]) for other_id in new_ids[i + 1:]])
+            for other_id, other_type in others:
+                _increment(co_watch, other_id)
+                _increment(_get_co_watch(co_watches, other_type, other_id), media_id)
+                touched_ids.add(other_id)
+
+    watchers_counts = dict([(media_id, co_watch.watchers_count) for media_id, co_watch in co_watches.items()])
+    missing_ids = set()
+    for media_id in touched_ids:
+        missing_ids.update([pk for pk in co_watches[media_id].co_counts if pk not in watchers_counts])
+    if missing_ids:
+        for co_watch in CoWatch.objects.filter(media_id__in=list(missing_ids)):
+            watchers_counts[co_watch.media_id] = co_watch.watchers_count
+    for media_id in touched_ids:
+        co_watch = co_watches[media_id]
+        co_watch.neighbor_ids = get_neighbors(co_watch, watchers_counts)
+        co_watch.save()
+
+    checkpoint.last_entry_id = entries[-1].id
+    checkpoint.save()
+    return len(entries)
+
+
+def get_co_watched_recommended(member, count):
+    """
+    Gets media recommended for a member by merging the neighbors of the media the member
+    recently watched. Neighbors of the most recent ones and those ranked first weigh more.
+    :return: list of Movies and/or Series not yet watched by the member
+    """
+    entries = list(StreamLogEntry.objects.filter(member=member).order_by('-id')[:RECENT_ENTRIES_COUNT])
+    watched_ids = set()
+    recent_ids = []
+    for entry, media_type, media_id in _get_items(entries):
+        watched_ids.add(media_id)
+        if media_id not in recent_ids and len(recent_ids) < RECENT_ITEMS_COUNT:
+            recent_ids.append(media_id)
+    if not recent_ids:
+        return []
+    co_watches = dict([(co_watch.media_id, co_watch) for co_watch in CoWatch.objects.filter(media_id__in=recent_ids)])
+    scores = {}
+    for rank, media_id in enumerate(recent_ids):
+        co_watch = co_watches.get(media_id)
+        if not co_watch:
+            continue
+        for position, neighbor_id in enumerate(co_watch.neighbor_ids):
+            if neighbor_id not in watched_ids:
+                scores[neighbor_id] = scores.get(neighbor_id, 0) + 1.0 / ((rank + 1) * (position + 1))
+    catalog = get_catalog()
+    recommended_ids = [pk for pk in sorted(scores, key=lambda pk: (scores[pk], pk), reverse=True) if catalog.get(pk)]
+    return catalog.fetch(recommended_ids[:count])
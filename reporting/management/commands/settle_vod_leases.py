@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from ikwen_shavida.reporting.metering import settle_leases, get_metering_stats, METERING_STATS
+
+__author__ = "Kom Sihon"
+
+
+class Command(BaseCommand):
+    help = "Gives back to VOD prepayments the unused bytes of the balance leases of members who stopped " \
+           "streaming, then prints the metering figures. Meant to run periodically in a cron."
+
+    def handle(self, *args, **options):
+        count = settle_leases()
+        self.stdout.write("%d balance leases settled." % count)
+        stats = get_metering_stats()
+        self.stdout.write(', '.join(["%s: %d" % (name, stats[name]) for name in METERING_STATS]))
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ikwen_shavida.reporting.cowatch import update_co_watches
+
+__author__ = "Kom Sihon"
+
+
+class Command(BaseCommand):
+    help = "Folds the stream log entries reduced since the last run into the co-watch statistics " \
+           "used for recommendations. Meant to run periodically in a cron."
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+                    help="Compute the statistics again from all the stream log entries."),
+    )
+
+    def handle(self, *args, **options):
+        count = update_co_watches(full=options.get('full'))
+        self.stdout.write("%d stream log entries folded into co-watch statistics." % count)
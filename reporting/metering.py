@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Metering of the VOD balance with leases. The first heartbeat of a member
+streaming reserves VOD_LEASE_SIZE bytes of their VODPrepayment in a VODLease
+with a conditional $inc, which never takes the balance below zero. Following
+heartbeats, from any of their devices, are debited from the lease with an
+atomic cache increment. The prepayment is touched again only when the lease
+is used up: it is then extended by another reservation, or the member is
+told at once that their balance is exhausted.
+
+A lease no heartbeat was received for in VOD_LEASE_TIMEOUT seconds is settled
+at the next heartbeat of the member or by the command settle_vod_leases:
+its unused bytes are given back to the prepayment. The usage counter of a
+lease never expires, so that it is still there whenever the lease is
+settled. Leases of a member are opened, renewed and settled under a lock of
+that member in cache, so that concurrent heartbeats from their devices end
+up debiting the same lease. Figures of what could not
+be metered exactly are kept for get_metering_stats():
+  - lost_bytes: bytes of leases which usage counter was evicted from the
+    cache. They are considered streamed.
+  - overdraft_bytes: bytes streamed beyond what was left to the member.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+
+from ikwen_shavida.reporting.models import VODLease
+from ikwen_shavida.sales.models import VODPrepayment
+
+__author__ = "Kom Sihon"
+
+LEASE_KEY_PREFIX = 'vod_lease:'
+LEASE_USED_KEY_PREFIX = 'vod_lease_used:'
+METERING_STATS_KEY_PREFIX = 'vod_metering:'
+LEASE_LOCK_TIMEOUT = 10
+METERING_STATS = ('granted', 'extended', 'settled', 'exhausted', 'refunded_bytes', 'lost_bytes', 'overdraft_bytes')
+
+
+def _get_lease_size():
+    return getattr(settings, 'VOD_LEASE_SIZE', 20000000)
+
+
+def _get_lease_timeout():
+    return getattr(settings, 'VOD_LEASE_TIMEOUT', 300)
+
+
+def _incr_stat(name, delta=1):
+    key = METERING_STATS_KEY_PREFIX + name
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        cache.set(key, delta, None)
+
+
+def get_metering_stats():
+    """
+    :return: dict {name: value} of the counters listed in METERING_STATS
+    """
+    values = cache.get_many([METERING_STATS_KEY_PREFIX + name for name in METERING_STATS])
+    return dict([(name, values.get(METERING_STATS_KEY_PREFIX + name, 0)) for name in METERING_STATS])
+
+
+def _reserve(prepayment_id, size):
+    """
+    Takes up to size bytes from the balance of a VODPrepayment.
+    :return: number of bytes taken
+    """
+    if VODPrepayment.objects.filter(pk=prepayment_id, balance__gte=size).update(balance=F('balance') - size):
+        return size
+    for i in range(3):  # Less than size is left: take all of it, unless it changes meanwhile
+        balance = VODPrepayment.objects.get(pk=prepayment_id).balance
+        if balance <= 0:
+            return 0
+        if VODPrepayment.objects.filter(pk=prepayment_id, balance=balance).update(balance=0):
+            return balance
+    return 0
+
+
+def _get_pool(prepayment_id):
+    return VODPrepayment.objects.get(pk=prepayment_id).balance
+
+
+def _grant(member, prepayment):
+    """
+    Opens a lease of member on prepayment.
+    :return: dict describing the lease as kept in cache, or None if nothing is left on prepayment
+    """
+    granted = _reserve(prepayment.id, _get_lease_size())
+    if not granted:
+        return None
+    lease = VODLease.objects.create(member_id=member.id, prepayment_id=prepayment.id, granted=granted)
+    cache.set(LEASE_USED_KEY_PREFIX + lease.id, 0, None)
+    _incr_stat('granted')
+    return {'id': lease.id, 'prepayment_id': prepayment.id, 'granted': granted, 'pool': _get_pool(prepayment.id)}
+
+
+def _debit_lease(state, bytes):
+    """
+    :return: bytes used on the lease described by state, including those debited now
+    """
+    key = LEASE_USED_KEY_PREFIX + state['id']
+    try:
+        return cache.incr(key, bytes)
+    except ValueError:
+        # Usage counter evicted: the lease is considered used up
+        _incr_stat('lost_bytes', state['granted'])
+        used = state['granted'] + bytes
+        cache.set(key, used, None)
+        return used
+
+
+def settle_lease(lease):
+    """
+    Closes lease and gives its unused bytes back to the prepayment.
+    :return: number of bytes given back
+    """
+    used = cache.get(LEASE_USED_KEY_PREFIX + lease.id)
+    if used is None:
+        _incr_stat('lost_bytes', lease.granted)
+        used = lease.granted
+    if not VODLease.objects.filter(pk=lease.id, settled=False).update(settled=True, used=used):
+        return 0  # Settled meanwhile
+    cache.delete(LEASE_USED_KEY_PREFIX + lease.id)
+    _incr_stat('settled')
+    remainder = lease.granted - used
+    if remainder > 0:
+        VODPrepayment.objects.filter(pk=lease.prepayment_id).update(balance=F('balance') + remainder)
+        _incr_stat('refunded_bytes', remainder)
+        return remainder
+    if remainder < 0:
+        overdraft = -remainder - _reserve(lease.prepayment_id, -remainder)
+        if overdraft:
+            _incr_stat('overdraft_bytes', overdraft)
+    return 0
+
+
+def _lock(member_id):
+    """
+    Takes the lease lock of member_id, waiting for it if needed.
+    """
+    lock_key = LEASE_KEY_PREFIX + member_id + ':lock'
+    while not cache.add(lock_key, True, LEASE_LOCK_TIMEOUT):
+        time.sleep(0.05)
+
+
+def _unlock(member_id):
+    cache.delete(LEASE_KEY_PREFIX + member_id + ':lock')
+
+
+def _settle_idle_leases(leases):
+    """
+    Settles those of leases not in use anymore. Lease locks of their members must be held.
+    """
+    states = cache.get_many([LEASE_KEY_PREFIX + lease.member_id for lease in leases])
+    count = 0
+    for lease in leases:
+        state = states.get(LEASE_KEY_PREFIX + lease.member_id)
+        if state and state['id'] == lease.id:
+            continue
+        settle_lease(lease)
+        count += 1
+    return count
+
+
+def settle_leases(member=None):
+    """
+    Settles the leases not in use anymore, of member or of all members.
+    :return: number of leases settled
+    """
+    leases = VODLease.objects.filter(settled=False)
+    if member:
+        leases = leases.filter(member_id=member.id)
+    leases_by_member = {}
+    for lease in leases:
+        leases_by_member.setdefault(lease.member_id, []).append(lease)
+    count = 0
+    for member_id, member_leases in leases_by_member.items():
+        _lock(member_id)
+        try:
+            count += _settle_idle_leases(member_leases)
+        finally:
+            _unlock(member_id)
+    return count
+
+
+def _open_lease(member):
+    """
+    Gets the lease of member in use, opening one if there is none.
+    :return: dict describing the lease, or None if nothing is left to member
+    """
+    key = LEASE_KEY_PREFIX + member.id
+    _lock(member.id)
+    try:
+        state = cache.get(key)
+        if state is None:
+            _settle_idle_leases(list(VODLease.objects.filter(member_id=member.id, settled=False)))
+            prepayment = member.customer.get_last_vod_prepayment()
+            state = _grant(member, prepayment) if prepayment else None
+            if state:
+                cache.set(key, state, _get_lease_timeout())
+        return state
+    finally:
+        _unlock(member.id)
+
+
+def _renew_lease(member, state):
+    """
+    Settles the lease described by state, used up with nothing left to extend it, then
+    moves on to a newer prepayment if the member bought one. A lease renewed meanwhile
+    by another request of member is used as is.
+    :return: dict describing the lease now in use, or None if nothing is left to member
+    """
+    key = LEASE_KEY_PREFIX + member.id
+    _lock(member.id)
+    try:
+        current = cache.get(key)
+        if current and current['id'] != state['id']:
+            return current
+        cache.set(LEASE_USED_KEY_PREFIX + state['id'], state['granted'], None)
+        cache.delete(key)
+        settle_lease(VODLease.objects.get(pk=state['id']))
+        prepayment = member.customer.get_last_vod_prepayment()
+        state = _grant(member, prepayment) if prepayment and prepayment.id != state['prepayment_id'] else None
+        if state:
+            cache.set(key, state, _get_lease_timeout())
+        return state
+    finally:
+        _unlock(member.id)
+
+
+def debit(member, bytes):
+    """
+    Debits bytes streamed by member from their lease, opening or extending it as needed.
+    :return: tuple (balance, exhausted). balance is what is left to member, unused bytes of the lease included.
+    """
+    key = LEASE_KEY_PREFIX + member.id
+    state = cache.get(key)
+    if state is None:
+        state = _open_lease(member)
+        if state is None:
+            _incr_stat('exhausted')
+            return 0, True
+    used = _debit_lease(state, bytes)
+    while used >= state['granted']:
+        extra = _reserve(state['prepayment_id'], max(_get_lease_size(), used - state['granted']))
+        if not extra:
+            break
+        VODLease.objects.filter(pk=state['id']).update(granted=F('granted') + extra)
+        state['granted'] += extra
+        state['pool'] = _get_pool(state['prepayment_id'])
+        _incr_stat('extended')
+    if used >= state['granted']:
+        # Lease used up and nothing left to extend it
+        overflow = used - state['granted']
+        state = _renew_lease(member, state)
+        if state is None:
+            if overflow:
+                _incr_stat('overdraft_bytes', overflow)
+            _incr_stat('exhausted')
+            return 0, True
+        if overflow:
+            used = _debit_lease(state, overflow)
+        else:
+            used = cache.get(LEASE_USED_KEY_PREFIX + state['id'], 0)
+    cache.set(key, state, _get_lease_timeout())
+    return max(state['pool'] + state['granted'] - used, 0), False
+
+
+def get_vod_balance(member, prepayment):
+    """
+    Balance left to member on prepayment, unused bytes of their lease on it included.
+    """
+    state = cache.get(LEASE_KEY_PREFIX + member.id)
+    if state is None or state['prepayment_id'] != prepayment.id:
+        return prepayment.balance
+    used = cache.get(LEASE_USED_KEY_PREFIX + state['id'], state['granted'])
+    return prepayment.balance + max(state['granted'] - used, 0)
@@ -2,6 +2,7 @@
 
 from django.db import models
 from django.utils import timezone
+from djangotoolbox.fields import DictField, ListField
 from ikwen.accesscontrol.models import Member
 from ikwen.core.models import Model
 
@@ -27,6 +28,20 @@ class StreamLogEntry(models.Model):
     updated_on = models.DateTimeField(default=timezone.now, auto_now_add=True)
 
 
+class VODLease(Model):
+    """
+    Bytes reserved from a VODPrepayment for the streams of its member, which
+    heartbeats are debited from. Maintained by reporting.metering.
+    """
+    member_id = models.CharField(max_length=24, db_index=True)
+    prepayment_id = models.CharField(max_length=24)
+    granted = models.IntegerField(default=0,
+                                  help_text="Bytes reserved from the prepayment.")
+    used = models.IntegerField(default=0,
+                               help_text="Bytes actually streamed. Known once the lease is settled.")
+    settled = models.BooleanField(default=False, db_index=True)
+
+
 class HistoryEntry(Model):
     member = models.ForeignKey(Member)
     media_type = models.CharField(max_length=15)
@@ -36,3 +51,23 @@ class HistoryEntry(Model):
 
     class Meta:
         unique_together = ('member', 'media_id')
+
+
+class CoWatch(Model):
+    """
+    Co-watch statistics of a Movie or Series, used for item-to-item recommendations.
+    Maintained from the reduced StreamLogEntry by reporting.cowatch.update_co_watches()
+    """
+    media_id = models.CharField(max_length=24, unique=True)
+    media_type = models.CharField(max_length=15)
+    watchers_count = models.IntegerField(default=0,
+                                         help_text="Number of members who watched the media")
+    co_counts = DictField()  # {media_id: number of members who watched both media}
+    neighbor_ids = ListField()  # Ids of the media most watched along with this one, most similar first
+
+
+class CoWatchCheckpoint(Model):
+    """
+    Last StreamLogEntry folded into the CoWatch statistics.
+    """
+    last_entry_id = models.CharField(max_length=24, blank=True, null=True)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind buffer of the StreamLogEntry created on the request path: the
+"interest" entries of stream_or_download() and the heartbeats received by
+debit_vod_balance() every VOD_COUNTER_INTERVAL seconds per viewer.
+
+Entries are queued in memory per process and inserted by a background
+thread with a single bulk insert, as soon as STREAM_LOG_BATCH_SIZE entries
+are queued or every STREAM_LOG_FLUSH_INTERVAL seconds. Their ids are
+assigned when they are queued, so that ordering entries by id still
+follows the order in which they were logged. Readers going through entries
+by increasing id must thus stop at get_settled_id(): entries with higher
+ids may still be waiting for their insert.
+
+Each entry is also appended to a spill file of the process in
+STREAM_LOG_SPILL_DIR before being queued. A new file is started at each
+flush and the previous one is deleted once its entries are inserted. Spill
+files left by processes that died are inserted at first use of the buffer
+by another process, skipping the entries that were inserted already. The
+others are given new ids as they are inserted, so that they come after
+those readers went through already. Each file is first claimed by renaming
+it after the replaying process, so that processes starting together do not
+insert the same entries twice. Files claimed by a process that died while
+replaying them are claimed again.
+"""
+import atexit
+import json
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+
+from bson.objectid import ObjectId
+from django.conf import settings
+from django.utils import timezone
+
+from ikwen_shavida.reporting.models import StreamLogEntry
+
+__author__ = "Kom Sihon"
+
+logger = logging.getLogger('ikwen')
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+SPILL_FILE_PREFIX = 'stream_log.'
+SPILL_FILE_SUFFIX = '.jsonl'
+REPLAYING_INFIX = '.replaying.'
+
+_lock = Lock()
+_wake_up = Event()
+_state = {'flusher': None, 'queue': [], 'spill_file': None, 'spill_count': 0}
+_stats = {'flushed': 0, 'batches': 0, 'failures': 0, 'replayed': 0,
+          'last_flush_latency': None, 'max_flush_latency': None}
+
+
+def get_spill_dir():
+    return getattr(settings, 'STREAM_LOG_SPILL_DIR', os.path.join(tempfile.gettempdir(), 'shavida_stream_log'))
+
+
+def _open_spill_file():
+    spill_dir = get_spill_dir()
+    if not os.path.exists(spill_dir):
+        os.makedirs(spill_dir)
+    _state['spill_count'] += 1
+    filename = '%s%d.%d%s' % (SPILL_FILE_PREFIX, os.getpid(), _state['spill_count'], SPILL_FILE_SUFFIX)
+    return open(os.path.join(spill_dir, filename), 'a')
+
+
+def _to_dict(entry):
+    return {'id': entry.id, 'member_id': entry.member_id, 'media_type': entry.media_type,
+            'media_id': entry.media_id, 'bytes': entry.bytes, 'duration': entry.duration,
+            'created_on': entry.created_on.strftime(DATETIME_FORMAT)}
+
+
+def _from_dict(values):
+    values = dict(values)
+    values['created_on'] = datetime.strptime(values['created_on'], DATETIME_FORMAT)
+    values['updated_on'] = values['created_on']
+    return StreamLogEntry(**values)
+
+
+def _insert(entries, renew_ids=False):
+    """
+    Inserts entries, skipping those already in the database.
+    :param renew_ids: If True, entries inserted are given new ids, in the order of their former ones
+    """
+    ids = [entry.id for entry in entries]
+    existing = set([entry.id for entry in StreamLogEntry.objects.filter(pk__in=ids)])
+    entries = [entry for entry in entries if entry.id not in existing]
+    if renew_ids:
+        entries.sort(key=lambda entry: entry.id)
+        for entry in entries:
+            entry.id = str(ObjectId())
+    if entries:
+        StreamLogEntry.objects.bulk_create(entries)
+    return len(entries)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def replay_spill_files():
+    """
+    Inserts the entries of the spill files left by dead processes, then deletes those files.
+    :return: number of entries inserted
+    """
+    spill_dir = get_spill_dir()
+    if not os.path.exists(spill_dir):
+        return 0
+    count = 0
+    for filename in sorted(os.listdir(spill_dir)):
+        if not filename.startswith(SPILL_FILE_PREFIX):
+            continue
+        if filename.endswith(SPILL_FILE_SUFFIX):
+            base_name = filename
+            pid = int(filename[len(SPILL_FILE_PREFIX):].split('.')[0])
+        elif REPLAYING_INFIX in filename:
+            base_name, pid = filename.split(REPLAYING_INFIX)
+            pid = int(pid)
+        else:
+            continue
+        if pid == os.getpid() or _is_alive(pid):
+            continue
+        path = os.path.join(spill_dir, base_name + REPLAYING_INFIX + str(os.getpid()))
+        try:
+            os.rename(os.path.join(spill_dir, filename), path)
+        except OSError:
+            # Claimed by another process meanwhile
+            continue
+        with open(path) as fh:
+            # A process killed while writing may leave its last line incomplete
+            entries = [_from_dict(json.loads(line)) for line in fh if line.endswith('\n')]
+        count += _insert(entries, renew_ids=True)
+        os.unlink(path)
+    _stats['replayed'] += count
+    return count
+
+
+def get_settled_id():
+    """
+    Id below which all the entries logged are inserted, processes that died aside: entries
+    are inserted at most STREAM_LOG_FLUSH_INTERVAL seconds after they are logged, plus
+    STREAM_LOG_SETTLE_MARGIN seconds for slow or retried inserts.
+    """
+    lag = getattr(settings, 'STREAM_LOG_FLUSH_INTERVAL', 5) + getattr(settings, 'STREAM_LOG_SETTLE_MARGIN', 60)
+    return str(ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=lag)))
+
+
+def log_stream(member, media_type, media_id, duration, bytes):
+    """
+    Queues the creation of a StreamLogEntry. Arguments are those of the entry.
+    """
+    entry = StreamLogEntry(id=str(ObjectId()), member=member, media_type=media_type, media_id=media_id,
+                           duration=duration, bytes=bytes, created_on=timezone.now())
+    entry.updated_on = entry.created_on
+    line = json.dumps(_to_dict(entry)) + '\n'
+    with _lock:
+        flusher = _state['flusher']
+        if flusher is None or not flusher.is_alive():
+            flusher = Thread(target=_work)
+            flusher.daemon = True
+            flusher.start()
+            _state['flusher'] = flusher
+        if _state['spill_file'] is None:
+            _state['spill_file'] = _open_spill_file()
+        _state['spill_file'].write(line)
+        _state['spill_file'].flush()
+        _state['queue'].append(entry)
+        if len(_state['queue']) >= getattr(settings, 'STREAM_LOG_BATCH_SIZE', 200):
+            _wake_up.set()
+    return entry
+
+
+def flush_stream_log():
+    """
+    Inserts the queued entries. They are queued again if that fails.
+    :return: number of entries inserted
+    """
+    with _lock:
+        entries = _state['queue']
+        spill_file = _state['spill_file']
+        _state['queue'] = []
+        _state['spill_file'] = None
+    if not entries:
+        return 0
+    start = time.time()
+    try:
+        _insert(entries)
+    except:
+        _stats['failures'] += 1
+        logger.error("Failed to insert %d stream log entries" % len(entries), exc_info=True)
+        lines = ''.join([json.dumps(_to_dict(entry)) + '\n' for entry in entries])
+        with _lock:
+            if _state['spill_file'] is None:
+                _state['spill_file'] = _open_spill_file()
+            _state['spill_file'].write(lines)
+            _state['spill_file'].flush()
+            _state['queue'] = entries + _state['queue']
+        spill_file.close()
+        os.unlink(spill_file.name)
+        return 0
+    spill_file.close()
+    os.unlink(spill_file.name)
+    latency = int((time.time() - start) * 1000)
+    _stats['flushed'] += len(entries)
+    _stats['batches'] += 1
+    _stats['last_flush_latency'] = latency
+    _stats['max_flush_latency'] = max(_stats['max_flush_latency'], latency)
+    logger.debug("Inserted %d stream log entries in %d ms. %d queued" % (len(entries), latency,
+                                                                        len(_state['queue'])))
+    return len(entries)
+
+
+def get_stream_log_stats():
+    """
+    :return: dict of the figures of the buffer of this process: queue depth, entries flushed,
+        batches, failures, entries replayed from spill files and flush latencies in milliseconds
+    """
+    stats = dict(_stats)
+    stats['queued'] = len(_state['queue'])
+    return stats
+
+
+def _work():
+    try:
+        replay_spill_files()
+    except:
+        logger.error("Failed to replay stream log spill files", exc_info=True)
+    while True:
+        _wake_up.wait(getattr(settings, 'STREAM_LOG_FLUSH_INTERVAL', 5))
+        _wake_up.clear()
+        try:
+            flush_stream_log()
+        except:
+            logger.error("Failed to flush stream log", exc_info=True)
+
+
+atexit.register(flush_stream_log)
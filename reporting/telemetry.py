@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Events of the player, batched by ikwen.trackPlayerEvent() of movies.js and
+posted to the telemetry view every few intervals and at page unload, rather
+than one request per event:
+  - play: playback of a media started
+  - heartbeat: bytes streamed over an interval, debited from the VOD balance
+  - progress: percentage of a media watched, kept in the history
+  - error: playback error, logged
+
+Events of a batch are validated together, then dispatched in one pass: the
+heartbeats make a single debit and each media watched a single update of
+its HistoryEntry.
+"""
+import logging
+
+from django.utils.translation import gettext as _
+
+from ikwen_shavida.movies.play_tokens import revoke_play_tokens
+from ikwen_shavida.movies.stream_sessions import touch_stream_session, end_stream_session
+from ikwen_shavida.reporting.metering import debit
+from ikwen_shavida.reporting.models import HistoryEntry
+from ikwen_shavida.reporting.stream_log import log_stream
+from ikwen_shavida.shavida.entitlements import set_vod_balance
+
+__author__ = "Kom Sihon"
+
+logger = logging.getLogger('ikwen')
+
+MAX_EVENTS = 200  # Events of a batch beyond this are rejected
+
+# Fields expected for each type of event, with their kind
+EVENT_FIELDS = {
+    'play': (('media_type', unicode), ('media_id', unicode)),
+    'heartbeat': (('media_type', unicode), ('media_id', unicode), ('bytes', int), ('duration', int)),
+    'progress': (('media_type', unicode), ('media_id', unicode), ('percentage', int)),
+    'error': (('media_type', unicode), ('media_id', unicode), ('message', unicode)),
+}
+
+
+def _clean(value, kind):
+    if kind == int:
+        value = int(value)
+        if value < 0:
+            raise ValueError("Negative value %d" % value)
+        return value
+    if not isinstance(value, basestring):
+        raise ValueError("Not a string: %r" % value)
+    return value[:255]
+
+
+def validate_events(events):
+    """
+    :return: tuple (valid_events, rejected_count). valid_events are
+        dicts holding the type and the expected fields of the events only.
+    """
+    if not isinstance(events, list):
+        return [], 1
+    valid_events = []
+    for event in events[:MAX_EVENTS]:
+        if not isinstance(event, dict) or event.get('type') not in EVENT_FIELDS:
+            continue
+        try:
+            clean = dict([(name, _clean(event[name], kind)) for name, kind in EVENT_FIELDS[event['type']]])
+        except (KeyError, TypeError, ValueError):
+            continue
+        clean['type'] = event['type']
+        valid_events.append(clean)
+    return valid_events, len(events) - len(valid_events)
+
+
+def dispatch_events(member, events):
+    """
+    Applies validated events of member.
+    :return: dict of the response to the player
+    """
+    response = {'success': True}
+    total_bytes = 0
+    watched = {}  # {media_id: (media_type, percentage)}
+    for event in events:
+        if event['type'] == 'heartbeat' and event['bytes'] > 0:
+            total_bytes += event['bytes']
+            log_stream(member, event['media_type'], event['media_id'], duration=event['duration'],
+                       bytes=event['bytes'])
+        elif event['type'] in ('play', 'progress'):
+            percentage = min(event.get('percentage', 0), 100)
+            previous = watched.get(event['media_id'], (None, 0))[1]
+            watched[event['media_id']] = (event['media_type'], max(percentage, previous))
+        elif event['type'] == 'error':
+            logger.warning("Player error on %s %s for %s: %s" % (event['media_type'], event['media_id'],
+                                                                  member.username, event['message']))
+    if total_bytes:
+        balance, exhausted = debit(member, total_bytes)
+        if exhausted:
+            revoke_play_tokens(member)
+            end_stream_session(member)
+            response['error'] = _("Sorry, you just ran out of balance. Please refill your account.")
+        else:
+            touch_stream_session(member)
+        set_vod_balance(member, balance)
+        response['balance'] = balance
+    elif watched:
+        touch_stream_session(member)
+    for media_id, (media_type, percentage) in watched.items():
+        entry, created = HistoryEntry.objects.get_or_create(member=member, media_id=media_id,
+                                                            defaults={'media_type': media_type,
+                                                                      'percentage': percentage})
+        if not created and percentage > entry.percentage:
+            entry.percentage = percentage
+            entry.save()
+    return response
@@ -6,9 +6,12 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import json
 import os
+import tempfile
 
 import shutil
+from bson.objectid import ObjectId
 from django.conf import settings
 from django.core.management import call_command
 from django.test.utils import override_settings
@@ -18,7 +21,10 @@ from ikwen_shavida.movies.models import Movie, Series, SeriesEpisode
 from ikwen.core.models import Service
 from ikwen.accesscontrol.models import Member
 from ikwen_shavida.movies.tests_views import wipe_test_data
-from ikwen_shavida.reporting.models import StreamLogEntry
+from ikwen_shavida.reporting.cowatch import update_co_watches, get_co_watched_recommended
+from ikwen_shavida.reporting.models import StreamLogEntry, CoWatch
+from ikwen_shavida.reporting.stream_log import log_stream, flush_stream_log, replay_spill_files, \
+    get_stream_log_stats, SPILL_FILE_PREFIX, SPILL_FILE_SUFFIX, REPLAYING_INFIX
 from ikwen_shavida.reporting.utils import reduce_stream_log_entries, get_watched, get_ordered, generate_add_list_info, \
     add_media_to_update, sync_changes
 from ikwen_shavida.reporting.views import get_series_from_episodes
@@ -57,6 +63,55 @@ class ReportingUtilsTest(TestCase):
         self.assertEqual(entry2.bytes, 780000)
         self.assertEqual(entry3.bytes, 765000)
 
+    def test_stream_log_write_behind(self):
+        spill_dir = tempfile.mkdtemp()
+        with override_settings(STREAM_LOG_SPILL_DIR=spill_dir):
+            member = Member.objects.get(pk='56eb6d04b37b3379b531e011')
+            count = StreamLogEntry.objects.all().count()
+            flush_stream_log()
+            entry1 = log_stream(member, 'movie', '56eb6d04b37b3379b531e081', duration=3, bytes=1000)
+            entry2 = log_stream(member, 'movie', '56eb6d04b37b3379b531e081', duration=3, bytes=2000)
+            self.assertEqual(len(os.listdir(spill_dir)), 1)
+            flush_stream_log()
+            self.assertEqual(os.listdir(spill_dir), [])
+            self.assertEqual(get_stream_log_stats()['queued'], 0)
+            entries = list(StreamLogEntry.objects.filter(pk__in=[entry1.id, entry2.id]).order_by('id'))
+            self.assertEqual([entry.bytes for entry in entries], [1000, 2000])
+
+            # Spill file of a dead process, which last entry was already inserted
+            dead_pid = 2 ** 22 + 1
+            path = os.path.join(spill_dir, '%s%d.1%s' % (SPILL_FILE_PREFIX, dead_pid, SPILL_FILE_SUFFIX))
+            with open(path, 'w') as fh:
+                fh.write(json.dumps({'id': '56eb6d04b37b3379b531f001', 'member_id': member.id, 'media_type': 'movie',
+                                     'media_id': '56eb6d04b37b3379b531e082', 'bytes': 500, 'duration': 3,
+                                     'created_on': '2016-03-18T10:00:00.000000'}) + '\n')
+                fh.write(json.dumps({'id': entry2.id, 'member_id': member.id, 'media_type': 'movie',
+                                     'media_id': '56eb6d04b37b3379b531e081', 'bytes': 2000, 'duration': 3,
+                                     'created_on': '2016-03-18T10:00:05.000000'}) + '\n')
+            self.assertEqual(replay_spill_files(), 1)
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(StreamLogEntry.objects.all().count(), count + 3)
+            # Entries replayed get new ids, not to be skipped by readers which went past their former ones
+            self.assertEqual(StreamLogEntry.objects.filter(pk='56eb6d04b37b3379b531f001').count(), 0)
+            replayed = StreamLogEntry.objects.get(member=member, bytes=500)
+            self.assertGreater(replayed.id, entry2.id)
+
+            # Files being replayed by a live process are left to it, those claimed by a dead one are claimed again
+            claimed = os.path.join(spill_dir, '%s%d.2%s%s%d' % (SPILL_FILE_PREFIX, dead_pid, SPILL_FILE_SUFFIX,
+                                                                REPLAYING_INFIX, os.getppid()))
+            orphan = os.path.join(spill_dir, '%s%d.3%s%s%d' % (SPILL_FILE_PREFIX, dead_pid, SPILL_FILE_SUFFIX,
+                                                               REPLAYING_INFIX, dead_pid + 1))
+            for path, bytes in ((claimed, 600), (orphan, 700)):
+                with open(path, 'w') as fh:
+                    fh.write(json.dumps({'id': str(ObjectId()), 'member_id': member.id, 'media_type': 'movie',
+                                         'media_id': '56eb6d04b37b3379b531e082', 'bytes': bytes, 'duration': 3,
+                                         'created_on': '2016-03-18T10:00:10.000000'}) + '\n')
+            self.assertEqual(replay_spill_files(), 1)
+            self.assertTrue(os.path.exists(claimed))
+            self.assertEqual(os.listdir(spill_dir), [os.path.basename(claimed)])
+            self.assertEqual(StreamLogEntry.objects.filter(member=member, bytes=700).count(), 1)
+        shutil.rmtree(spill_dir)
+
     def test_get_watched(self):
         member = Member.objects.get(pk='56eb6d04b37b3379b531e011')
         watched = get_watched(member)
@@ -95,6 +150,36 @@ class ReportingUtilsTest(TestCase):
         for medium in ordered:
             self.assertIn(medium, expected)
 
+    @override_settings(STREAM_LOG_SETTLE_MARGIN=-10)  # Do not wait for inserts of entries logged now
+    def test_update_co_watches(self):
+        """
+        Media watched by the same members are neighbors, and entries added later are folded in incrementally
+        """
+        member2 = Member.objects.get(pk='56eb6d04b37b3379b531e012')
+        for media_id in ('56eb6d04b37b3379b531e081', '56eb6d04b37b3379b531e082'):
+            StreamLogEntry.objects.create(member=member2, media_type='movie', media_id=media_id, bytes=1000, duration=3)
+        with override_settings(STREAM_LOG_SETTLE_MARGIN=60):
+            # Entries logged this recently may have others still pending insert before them
+            self.assertEqual(update_co_watches(), 0)
+        update_co_watches()
+        co_watch = CoWatch.objects.get(media_id='56eb6d04b37b3379b531e081')
+        self.assertEqual(co_watch.watchers_count, 2)
+        self.assertEqual(co_watch.neighbor_ids, ['56eb6d04b37b3379b531e082', '56eb6d04b37b3379b531e083'])
+
+        StreamLogEntry.objects.create(member=member2, media_type='movie', media_id='56eb6d04b37b3379b531e084',
+                                      bytes=1000, duration=3)
+        update_co_watches()
+        co_watch = CoWatch.objects.get(media_id='56eb6d04b37b3379b531e081')
+        self.assertEqual(co_watch.watchers_count, 2)
+        self.assertEqual(co_watch.co_counts['56eb6d04b37b3379b531e084'], 1)
+        co_watch = CoWatch.objects.get(media_id='56eb6d04b37b3379b531e084')
+        self.assertEqual(set(co_watch.neighbor_ids), {'56eb6d04b37b3379b531e081', '56eb6d04b37b3379b531e082'})
+        self.assertEqual(update_co_watches(), 0)
+
+        member1 = Member.objects.get(pk='56eb6d04b37b3379b531e011')
+        recommended = get_co_watched_recommended(member1, 12)
+        self.assertEqual([media.id for media in recommended], ['56eb6d04b37b3379b531e084'])
+
     @override_settings(IKWEN_SERVICE_ID='54ad2bd9b37b335a18fe5801')
     def test_sync_changes(self):
         """
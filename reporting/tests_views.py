@@ -9,6 +9,7 @@ Replace this with more appropriate tests for your application.
 import json
 
 import time
+from django.core.cache import cache
 from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test import Client
@@ -19,7 +20,10 @@ from ikwen_shavida.movies.models import Movie, SeriesEpisode, Trailer
 
 from ikwen_shavida.movies.tests_views import wipe_test_data
 from ikwen_shavida.sales.models import ContentUpdate, SalesConfig
-from ikwen_shavida.sales.models import RetailPrepayment
+from ikwen_shavida.reporting.metering import settle_leases, get_vod_balance, LEASE_KEY_PREFIX
+from ikwen_shavida.reporting.models import HistoryEntry, VODLease
+from ikwen_shavida.sales.models import RetailPrepayment, VODPrepayment
+from ikwen_shavida.shavida.entitlements import get_entitlements
 
 
 class ReportingViewsTest(TestCase):
@@ -144,6 +148,7 @@ class ReportingViewsTest(TestCase):
         ContentUpdate.objects.get(member=member).delete()
         ContentUpdate.objects.create(member=member, add_list=','.join(add_list), add_list_size=40000,
                                      delete_list=','.join(delete_list), delete_list_size=15000, status=ContentUpdate.AUTHORIZED)
+        self.assertEqual(get_entitlements(member).last_prepayment.balance, 100000)
         response = self.client.get(reverse('reporting:get_repo_files_update'),
                                    {'username': 'member1@ikwen.com', 'password': 'admin', 'operator_username': 'member2@ikwen.com',
                                     'available_space': '35000'})
@@ -153,6 +158,7 @@ class ReportingViewsTest(TestCase):
         prepayment = RetailPrepayment.objects.filter(member=member).order_by('-id')[0]
         self.assertEqual(update.status, ContentUpdate.AUTHORIZED)
         self.assertEqual(prepayment.balance, 60000)
+        self.assertEqual(get_entitlements(member).last_prepayment.balance, 60000)
 
     def test_debit_user_with_direct_url_hit(self):
         """
@@ -170,3 +176,68 @@ class ReportingViewsTest(TestCase):
                                    HTTP_REFERER='referer')
         json_content = json.loads(response.content)
         self.assertEqual(json_content['balance'], 197000000)
+
+    @override_settings(VOD_LEASE_SIZE=20000000)
+    def test_debit_user_with_balance_lease(self):
+        """
+        Heartbeats are debited from a lease reserved on the VODPrepayment, which unused bytes are given back
+        once settled. Running out of balance is reported at once.
+        """
+        member = Member.objects.get(email='member3@ikwen.com')
+        self.client.login(username='member3@ikwen.com', password='admin')
+        for i in range(2):
+            response = self.client.get(reverse('reporting:debit_vod_balance'),
+                                       {'bytes': 3000000, 'duration': 3, 'type': 'movie',
+                                        'media_id': '56eb6d04b37b3379b531e081'}, HTTP_REFERER='referer')
+        self.assertEqual(json.loads(response.content)['balance'], 194000000)
+        self.assertIsNone(cache.get(LEASE_KEY_PREFIX + member.id + ':lock'))
+        prepayment = member.customer.get_last_vod_prepayment()
+        self.assertEqual(prepayment.balance, 180000000)
+        self.assertEqual(get_vod_balance(member, prepayment), 194000000)
+
+        lease = VODLease.objects.get(member_id=member.id)
+        self.assertEqual(lease.granted, 20000000)
+        cache.delete(LEASE_KEY_PREFIX + member.id)  # As if the lease expired
+        self.assertEqual(settle_leases(), 1)
+        self.assertEqual(VODLease.objects.get(pk=lease.id).used, 6000000)
+        self.assertEqual(VODPrepayment.objects.get(pk=prepayment.id).balance, 194000000)
+
+        response = self.client.get(reverse('reporting:debit_vod_balance'),
+                                   {'bytes': 194000000, 'duration': 3, 'type': 'movie',
+                                    'media_id': '56eb6d04b37b3379b531e081'}, HTTP_REFERER='referer')
+        json_content = json.loads(response.content)
+        self.assertEqual(json_content['balance'], 0)
+        self.assertTrue(json_content['error'])
+        self.assertEqual(VODPrepayment.objects.get(pk=prepayment.id).balance, 0)
+
+    def test_telemetry(self):
+        """
+        A batch of player events makes a single debit of its heartbeats and a single history update
+        per media. Invalid events are counted as rejected.
+        """
+        member = Member.objects.get(email='member3@ikwen.com')
+        self.client.login(username='member3@ikwen.com', password='admin')
+        media = {'media_type': 'movie', 'media_id': '56eb6d04b37b3379b531e081'}
+        events = [dict(media, type='play')]
+        events += [dict(media, type='heartbeat', bytes=3000000, duration=3) for i in range(3)]
+        events += [dict(media, type='progress', percentage=10), dict(media, type='progress', percentage=12)]
+        events += [{'type': 'heartbeat', 'bytes': -1}]
+        response = self.client.post(reverse('movies:telemetry'), {'events': json.dumps(events)},
+                                    HTTP_REFERER='referer')
+        json_content = json.loads(response.content)
+        self.assertEqual(json_content['balance'], 191000000)
+        self.assertEqual(json_content['rejected'], 1)
+        self.assertEqual(get_vod_balance(member, member.customer.get_last_vod_prepayment()), 191000000)
+        self.assertEqual(HistoryEntry.objects.get(member=member, media_id=media['media_id']).percentage, 12)
+
+    def test_debit_user_updates_entitlements(self):
+        """
+        Debiting user should update the balance in the entitlements snapshot without rebuilding it
+        """
+        member = Member.objects.get(email='member3@ikwen.com')
+        self.assertEqual(get_entitlements(member).last_vod_prepayment.balance, 200000000)
+        self.client.login(username='member3@ikwen.com', password='admin')
+        self.client.get(reverse('reporting:debit_vod_balance'), {'bytes': 3000000, 'duration': 3, 'type': 'movie',
+                                                                 'media_id': '56eb6d04b37b3379b531e081'},
+                        HTTP_REFERER='referer')
+        self.assertEqual(get_entitlements(member).last_vod_prepayment.balance, 197000000)
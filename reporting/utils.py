@@ -6,6 +6,7 @@ from django.shortcuts import get_object_or_404
 from ikwen.core.models import Service
 from ikwen.core.utils import get_service_instance, add_database_to_settings
 
+from ikwen_shavida.movies.increments import buffer_increment
 from ikwen_shavida.movies.models import SeriesEpisode, Movie, Trailer
 from ikwen_shavida.reporting.models import StreamLogEntry
 from ikwen_shavida.sales.models import ContentUpdate
@@ -91,9 +92,10 @@ def sync_changes(content_update):
 
     if content_update.movies_add_list:
         for movie in content_update.movies_add_list:
+            buffer_increment(movie, orders=1, fake_orders=1)
+            # The copy in the operator database gets the counters as they are after this order
             movie.orders += 1
             movie.fake_orders += 1
-            movie.save()
             movie.save(using=db)
             # dst_poster = operator.media_root + movie.poster.name
             # dst_poster_small = operator.media_root + movie.poster.small_name
@@ -114,9 +116,9 @@ def sync_changes(content_update):
                 # shutil.copy(current_series.poster.path, dst_poster)
                 # shutil.copy(current_series.poster.small_path, dst_poster_small)
                 # shutil.copy(current_series.poster.thumb_path, dst_poster_thumb)
+            buffer_increment(episode, orders=1, fake_orders=1)
             episode.orders += 1
             episode.fake_orders += 1
-            episode.save()
             episode.save(using=db)
 
     # Make media in delete_lists invisible rather than deleting them in the user database
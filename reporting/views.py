@@ -7,16 +7,24 @@ from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse
 from django.http.response import HttpResponseForbidden
 from django.utils.translation import gettext as _
+from django.views.decorators.http import require_POST
 
 from ikwen.accesscontrol.models import Member
 from ikwen.core.utils import get_service_instance
 
 from ikwen_shavida.conf.files_selector import collect_movies, collect_series
 from ikwen_shavida.movies.models import Movie, SeriesEpisode
+from ikwen_shavida.movies.play_tokens import revoke_play_tokens
+from ikwen_shavida.movies.stream_sessions import touch_stream_session, end_stream_session
+from ikwen_shavida.movies.utils import serialize_media
 from ikwen_shavida.movies.views import CustomerView
-from ikwen_shavida.reporting.models import StreamLogEntry, HistoryEntry
+from ikwen_shavida.reporting.metering import debit, get_vod_balance
+from ikwen_shavida.reporting.models import HistoryEntry
+from ikwen_shavida.reporting.stream_log import log_stream
+from ikwen_shavida.reporting.telemetry import validate_events, dispatch_events
 from ikwen_shavida.sales.models import ContentUpdate
 from ikwen_shavida.sales.models import SalesConfig
+from ikwen_shavida.shavida.entitlements import build_entitlements, set_vod_balance
 
 __author__ = "Kom Sihon"
 
@@ -126,11 +134,9 @@ def check_auto_selection_status(request, *args, **kwargs):
     except ContentUpdate.DoesNotExist:
         response = {'error': "No such Content update"}
     else:
-        response = []
-        for movie in update.movies_add_list:
-            response.append(movie.to_dict())
-        for episode in update.series_episodes_add_list:
-            response.append(episode.to_dict())
+        media = list(update.movies_add_list)
+        media.extend(update.series_episodes_add_list)
+        response = serialize_media(media)
     return HttpResponse(json.dumps(response), 'content-type: text/json')
 
 
@@ -167,6 +173,7 @@ def get_repo_files_update(request, *args, **kwargs):
     latest_prepayment.save()
     update.provider = provider
     update.save()
+    build_entitlements(member)
     if not getattr(settings, 'UNIT_TESTING', False):
         update.save(using=database)
     response = {
@@ -182,26 +189,54 @@ def debit_vod_balance(request, *args, **kwargs):
     if not referrer:
         return HttpResponseForbidden("You don't have permission to access this resource.")
     member = request.user
-    last_vod_prepayment = member.customer.get_last_vod_prepayment()
     response = {'success': True}
+    balance = None
     try:
         bytes = int(request.GET.get('bytes'))
         duration = int(request.GET.get('duration'))
         type = request.GET.get('type')
         media_id = request.GET.get('media_id')
         if bytes and bytes > 0:
-            if bytes >= last_vod_prepayment.balance:
-                last_vod_prepayment.balance = 0
+            balance, exhausted = debit(member, bytes)
+            if exhausted:
+                revoke_play_tokens(member)
+                end_stream_session(member)
                 response['error'] = _("Sorry, you just ran out of balance. Please refill your account.")
             else:
-                last_vod_prepayment.balance -= bytes
-            StreamLogEntry.objects.create(member=member, media_type=type, media_id=media_id, duration=duration, bytes=bytes)
-            last_vod_prepayment.save()
+                touch_stream_session(member)
+            log_stream(member, type, media_id, duration=duration, bytes=bytes)
+            set_vod_balance(member, balance)
     finally:
-        response['balance'] = last_vod_prepayment.balance
+        if balance is None:
+            last_vod_prepayment = member.customer.get_last_vod_prepayment()
+            balance = get_vod_balance(member, last_vod_prepayment) if last_vod_prepayment else 0
+        response['balance'] = balance
         return HttpResponse(json.dumps(response), 'content-type: text/json')
 
 
+@require_POST
+def telemetry(request, *args, **kwargs):
+    """
+    Receives the batches of player events described in reporting.telemetry.
+    Events are posted as a JSON list in the field "events".
+    """
+    referrer = request.META.get('HTTP_REFERER')
+    if not referrer:
+        return HttpResponseForbidden("You don't have permission to access this resource.")
+    member = request.user
+    if not member.is_authenticated():
+        response = {"error": _("Your session was closed. May be you logged in elsewhere.")}
+        return HttpResponse(json.dumps(response), 'content-type: text/json')
+    try:
+        events = json.loads(request.POST.get('events', '[]'))
+    except ValueError:
+        events = None
+    events, rejected = validate_events(events)
+    response = dispatch_events(member, events)
+    response['rejected'] = rejected
+    return HttpResponse(json.dumps(response), 'content-type: text/json')
+
+
 class History(CustomerView):
     template_name = 'reporting/history.html'
 
@@ -6,7 +6,6 @@ from django.contrib import admin
 from django.db.models import Q
 from django.utils.translation import gettext as _
 from ikwen.core.constants import CONFIRMED
-from ikwen.core.utils import get_service_instance
 from import_export import resources
 from import_export.admin import ExportMixin
 from ikwen.accesscontrol.models import Member
@@ -15,9 +14,11 @@ from ikwen_shavida.conf.utils import is_vod_operator, is_content_vendor
 from ikwen_shavida.reporting.utils import sync_changes
 from ikwen_shavida.sales.models import SalesConfig, RetailBundle, RetailPrepayment, VODBundle, VODPrepayment, Prepayment, \
     ContentUpdate, UnitPrepayment
+from ikwen_shavida.shavida.entitlements import build_entitlements
+from ikwen_shavida.shavida.middleware import get_config
 
 
-allow_cash_payment = get_service_instance().config.allow_cash_payment
+allow_cash_payment = get_config().allow_cash_payment
 
 
 class RetailPrepaymentResource(resources.ModelResource):
@@ -76,8 +77,12 @@ class RetailPrepaymentAdmin(ExportMixin, admin.ModelAdmin):
     search_fields = ('member_email', 'member_phone', )
     ordering = ('-id', )
 
+    def save_model(self, request, obj, form, change):
+        super(RetailPrepaymentAdmin, self).save_model(request, obj, form, change)
+        build_entitlements(obj.member)
+
     def get_queryset(self, request):
-        config = get_service_instance().config
+        config = get_config()
         if config.allow_cash_payment:
             return super(RetailPrepaymentAdmin, self).get_queryset(request)
         return RetailPrepayment.objects.filter(status=CONFIRMED)
@@ -111,7 +116,7 @@ class VODPrepaymentAdmin(ExportMixin, admin.ModelAdmin):
     ordering = ('-id', )
 
     def get_queryset(self, request):
-        config = get_service_instance().config
+        config = get_config()
         if config.allow_cash_payment:
             return super(VODPrepaymentAdmin, self).get_queryset(request)
         return VODPrepayment.objects.filter(status=CONFIRMED)
@@ -128,6 +133,7 @@ class VODPrepaymentAdmin(ExportMixin, admin.ModelAdmin):
                 obj.teller = request.user
                 obj.paid_on = datetime.now()
         super(VODPrepaymentAdmin, self).save_model(request, obj, form, change)
+        build_entitlements(obj.member)
 
     def get_search_results(self, request, queryset, search_term):
         if not search_term:
@@ -165,9 +171,10 @@ class UnitPrepaymentAdmin(ExportMixin, admin.ModelAdmin):
                 obj.paid_on = datetime.now()
                 obj.expiry = obj.paid_on + timedelta(days=obj.duration)
         super(UnitPrepaymentAdmin, self).save_model(request, obj, form, change)
+        build_entitlements(obj.member)
 
     def get_queryset(self, request):
-        config = get_service_instance().config
+        config = get_config()
         if config.allow_cash_payment:
             return super(UnitPrepaymentAdmin, self).get_queryset(request)
         return UnitPrepayment.objects.filter(status=CONFIRMED)
@@ -253,6 +260,7 @@ class ContentUpdateAdmin(admin.ModelAdmin, ExportMixin):
             thread = Thread(target=sync_changes, args=(obj, ))  # Syncing changes may last long, so run it in another thread.
             thread.start()
         super(ContentUpdateAdmin, self).save_model(request, obj, form, change)
+        build_entitlements(obj.member)
 
     def get_search_results(self, request, queryset, search_term):
         if is_vod_operator():
@@ -5,6 +5,7 @@ import sys, os
 sys.path.append("/home/cinemax/apps/prod")
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Cinemax.settings")
 from ikwen.accesscontrol.models import Member
+from ikwen_shavida.shavida.entitlements import build_entitlements
 
 
 customers = Member.objects.filter(account_type=Member.CUSTOMER)
@@ -13,3 +14,4 @@ for customer in customers:
     if latest_prepayment and latest_prepayment.days_left < 0:
         latest_prepayment.balance = 0
         latest_prepayment.save()
+        build_entitlements(customer)
@@ -23,18 +23,21 @@ from ikwen.billing.mtnmomo.views import MTN_MOMO
 from ikwen.billing.orangemoney.views import ORANGE_MONEY
 from ikwen.conf.settings import FALLBACK_SHARE_RATE
 from ikwen.core.models import Service
-from ikwen.core.utils import get_service_instance, add_database_to_settings, set_counters, increment_history_field, \
+from ikwen.core.utils import add_database_to_settings, set_counters, increment_history_field, \
     add_event, calculate_watch_info, rank_watch_objects, slice_watch_objects
 from ikwen.core.views import DashboardBase, HybridListView
 from ikwen.partnership.models import ApplicationRetailConfig
+from ikwen_shavida.movies.increments import buffer_increment, flush_increments, reload_without_counters
 from ikwen_shavida.movies.models import Movie, Series
 from ikwen_shavida.movies.views import CustomerView
-from ikwen_shavida.movies.utils import generate_download_link
+from ikwen_shavida.movies.utils import generate_download_link, resolve_owners
 from ikwen_shavida.reporting.utils import generate_add_list_info, add_media_to_update
 from ikwen_shavida.sales.models import ContentUpdate
 from ikwen_shavida.sales.models import VODBundle, Prepayment, VODPrepayment, RetailBundle, RetailPrepayment, UnitPrepayment, \
     SalesConfig
 from ikwen_shavida.shavida.events import NEW_ORDER, BUNDLE_PURCHASE
+from ikwen_shavida.shavida.entitlements import build_entitlements
+from ikwen_shavida.shavida.middleware import get_service, get_config, get_umbrella_service
 from ikwen_shavida.shavida.models import Customer, PartnerWallet
 from math import ceil
 
@@ -45,7 +48,7 @@ def set_momo_order_checkout(request, payment_mean, *args, **kwargs):
     This function has no URL associated with it.
     It serves as ikwen setting "MOMO_BEFORE_CHECKOUT"
     """
-    service = get_service_instance()
+    service = get_service()
     member = request.user
     bundle_id = request.POST.get('bundle_id')
     media_id = request.POST.get('media_id')
@@ -77,7 +80,7 @@ def set_momo_order_checkout(request, payment_mean, *args, **kwargs):
             request.session['media_type'] = 'series'
             hashbang = 'series-' + media.slug
         amount = media.download_price if action == 'download' else media.view_price
-        config = service.config
+        config = get_config()
         duration = config.movies_timeout if media_type == UnitPrepayment.MOVIE else config.series_timeout
         prepayment = UnitPrepayment.objects.create(media_type=media_type, media_id=media_id,  member=member,
                                                    amount=amount, duration=duration, currency=currency,
@@ -128,7 +131,7 @@ def confirm_payment(request, *args, **kwargs):
 
 @login_required
 def choose_vod_bundle(request, *args, **kwargs):
-    config = get_service_instance().config
+    config = get_config()
     member = request.user
 
     pay_cash = False
@@ -149,11 +152,12 @@ def choose_vod_bundle(request, *args, **kwargs):
         prepayment.status = Prepayment.CONFIRMED
         prepayment.paid_on = datetime.now()
         prepayment.save()
-        service = get_service_instance()
+        service = get_service()
         sudo_group = Group.objects.get(name=SUDO)
         add_event(service, BUNDLE_PURCHASE, group_id=sudo_group.id, object_id=prepayment.id)
         add_event(service, BUNDLE_PURCHASE, member=request.user, object_id=prepayment.id)
         share_payment_and_set_stats(member.customer, prepayment)
+    build_entitlements(member)
 
     messages.success(request, _("Your bundle was successfully activated."))
 
@@ -190,11 +194,12 @@ def choose_retail_bundle(request, *args, **kwargs):
         prepayment.status = Prepayment.CONFIRMED
         prepayment.paid_on = datetime.now()
         prepayment.save()
-        service = get_service_instance()
+        service = get_service()
         sudo_group = Group.objects.get(name=SUDO)
         add_event(service, BUNDLE_PURCHASE, group_id=sudo_group.id, object_id=prepayment.id)
         add_event(service, BUNDLE_PURCHASE, member=request.user, object_id=prepayment.id)
         share_payment_and_set_stats(member.customer, prepayment)
+    build_entitlements(member)
 
     messages.success(request, _("Your bundle was successfully activated."))
 
@@ -213,7 +218,7 @@ def choose_temp_bundle(request, *args, **kwargs):
         prepayment.expiry = expiry
         prepayment.status = Prepayment.CONFIRMED
         prepayment.save()
-        service = get_service_instance()
+        service = get_service()
         sudo_group = Group.objects.get(name=SUDO)
         add_event(service, BUNDLE_PURCHASE, group_id=sudo_group.id, object_id=prepayment.id)
         add_event(service, BUNDLE_PURCHASE, member=member, object_id=prepayment.id)
@@ -225,6 +230,7 @@ def choose_temp_bundle(request, *args, **kwargs):
                 prepayment.download_link = generate_download_link(media.filename, expires)
                 prepayment.save()
         share_payment_and_set_stats(member.customer, prepayment)
+    build_entitlements(member)
 
     messages.success(request, _("Your bundle was successfully activated."))
 
@@ -232,10 +238,10 @@ def choose_temp_bundle(request, *args, **kwargs):
 def share_payment_and_set_stats(customer, prepayment):
     amount = prepayment.amount
     payment_mean = prepayment.payment_mean
-    service = get_service_instance()
-    service_umbrella = get_service_instance(UMBRELLA)
+    service = get_service()
+    service_umbrella = get_umbrella_service()
     app_umbrella = service_umbrella.app
-    profile_umbrella = service_umbrella.config
+    profile_umbrella = get_config(UMBRELLA)
     ikwen_earnings_rate = amount * profile_umbrella.ikwen_share_rate / 100
     ikwen_earnings_fixed = profile_umbrella.ikwen_share_fixed
     if ikwen_earnings_fixed > (amount / 10):
@@ -305,7 +311,11 @@ def share_payment_and_set_stats(customer, prepayment):
 
     if type(prepayment) == UnitPrepayment:
         media = prepayment.get_media()
-        media.current_earnings += operator_earnings
+        if hasattr(media, 'current_earnings'):  # Series do not have it
+            buffer_increment(media, current_earnings=operator_earnings)
+            flush_increments(media)  # Before the daily rollover of set_counters() reads the earnings
+        # set_counters() and increment_history_field() save the media: they must not overwrite the counters
+        media = reload_without_counters(media)
         set_counters(media)
         increment_history_field(media, 'earnings_history', operator_earnings)
         if amount == media.download_price:
@@ -316,7 +326,7 @@ def share_payment_and_set_stats(customer, prepayment):
 
 @login_required
 def confirm_order(request, *args, **kwargs):
-    service = get_service_instance()
+    service = get_service()
     member = request.user
     sudo_group = Group.objects.get(name=SUDO)
     if member.customer.get_has_pending_update():
@@ -334,6 +344,7 @@ def confirm_order(request, *args, **kwargs):
             update.save()
             add_event(service, NEW_ORDER, group_id=sudo_group.id, object_id=update.id)
             add_event(service, NEW_ORDER, member=member, object_id=update.id)
+            build_entitlements(member)
             response = {'success': True}
         return HttpResponse(json.dumps(response))
 
@@ -366,6 +377,7 @@ def confirm_order(request, *args, **kwargs):
         db = member.customer.service.database
         add_database_to_settings(db)
         update.save(using=db)
+    build_entitlements(member)
     return HttpResponse(json.dumps({'success': True}))
 
 
@@ -394,6 +406,7 @@ def cancel_order(request, *args, **kwargs):
     last_update = member.customer.get_last_update()
     if last_update.status == ContentUpdate.PENDING:
         last_update.delete()
+        build_entitlements(member)
     response = {"success": True}
     jsonp = callback + '(' + json.dumps(response) + ')'
     return HttpResponse(jsonp, content_type='application/json')
@@ -412,6 +425,7 @@ def confirm_processed(request, *args, **kwargs):
         # thread.start()
         order.status = ContentUpdate.DELIVERED
         order.save()
+        build_entitlements(order.member)
     response = {"success": True}
     jsonp = callback + '(' + json.dumps(response) + ')'
     return HttpResponse(jsonp, content_type='application/json')
@@ -429,7 +443,7 @@ def render_bundle_purchased_event(event, request):
             prepayment = RetailPrepayment.objects.get(pk=event.object_id)
     except ObjectDoesNotExist:
         return ''
-    currency_symbol = get_service_instance().config.currency_symbol
+    currency_symbol = get_config().currency_symbol
     html_template = get_template('sales/events/bundle_purchased.html')
     member = prepayment.member
     if request_user == member:
@@ -460,7 +474,7 @@ def render_order_event(event, request):
     if len(media_list) > 15:
         more = len(media_list) - 15
     html_template = get_template('sales/events/order_notice.html')
-    service = get_service_instance()
+    service = get_service()
     from ikwen.conf import settings as ikwen_settings
     c = Context({'event': event, 'order': order, 'title': title, 'size': size, 'more': more,
                  'show_button': order.status == ContentUpdate.PENDING, 'user_id': user_id, 'service': service,
@@ -481,7 +495,7 @@ class Dashboard(DashboardBase):
         earnings_last_week = context['earnings_report']['last_week']
         earnings_last_28_days = context['earnings_report']['last_28_days']
 
-        service = get_service_instance()
+        service = get_service()
         set_counters(service)
         orders_count_today = calculate_watch_info(service.transaction_count_history)
         orders_count_yesterday = calculate_watch_info(service.transaction_count_history, 1)
@@ -536,16 +550,15 @@ class PartnerDashboard(TemplateView):
     def get_context_data(self, **kwargs):
         context = super(PartnerDashboard, self).get_context_data(**kwargs)
         member = self.request.user
-        service = get_service_instance()
+        service = get_service()
         partner_wallet, update = PartnerWallet.objects.using('shavida_wallets').get_or_create(service_id=service.id, member_id=member.id)
         if member.is_superuser:
-            movie_list = []
-            for movie in Movie.objects.all():
-                if movie.owner_fk_list:
-                    movie_list.append(movie)
+            movie_list = Movie.objects.raw_query({'owner_fk_list.0': {'$exists': True}}).order_by('-id')
         else:
             movie_list = Movie.objects.raw_query({'owner_fk_list': {'$elemMatch': {'$eq': member.id}}}).order_by('-id')
         series_list = Series.objects.raw_query({'owner_fk_list': {'$elemMatch': {'$eq': member.id}}}).order_by('-id')
+        movie_list = resolve_owners(movie_list)
+        series_list = resolve_owners(series_list)
         # movie_list = Movie.objects.all()[:10]
         context['movie_list'] = movie_list
         context['series_list'] = series_list
@@ -562,7 +575,7 @@ class PartnerDashboard(TemplateView):
     def share_revenue(self, request):
         if not request.user.is_superuser:
             return HttpResponse("Not allowed")
-        service = get_service_instance()
+        service = get_service()
         share_list = request.GET['shares'].split(',')
         media_id = request.GET['media_id']
         movie = Movie.objects.get(pk=media_id)
@@ -585,7 +598,7 @@ class PartnerWalletList(HybridListView):
     html_results_template_name = 'sales/snippets/partner_wallet_list_results.html'
 
     def get_queryset(self):
-        service = get_service_instance()
+        service = get_service()
         return PartnerWallet.objects.using('shavida_wallets').filter(service_id=service.id)
 
     def get(self, request, *args, **kwargs):
@@ -9,7 +9,6 @@ from ikwen.billing.models import InvoicingConfig, Invoice, Payment
 from import_export.admin import ExportMixin
 from ikwen.accesscontrol.backends import ARCH_EMAIL
 from ikwen.accesscontrol.models import Member
-from ikwen.core.utils import get_service_instance
 
 from ikwen_shavida.sales.models import RetailPrepayment, Prepayment, VODPrepayment
 from ikwen_shavida.shavida.models import OperatorProfile, Customer
@@ -26,8 +25,6 @@ if getattr(settings, 'IS_IKWEN', False):
     ]
     _readonly_fields = ()
 else:
-    service = get_service_instance()
-    config = service.config
     _readonly_fields = ('is_certified',)
     _fieldsets = [
         (_('Company'), {'fields': ('company_name', 'short_description', 'slogan', 'description',)}),
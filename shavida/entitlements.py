@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshot of what a member is entitled to, shown in the chrome of every
+customer page: their latest retail and VOD prepayments, whether they can
+access adult content and whether they have a content update pending.
+
+The snapshot is kept in cache and rebuilt by build_entitlements() in the
+code paths that change those: bundle payments, prepayment saves in the
+admin, orders, content updates, expiry of retail prepayments and the adult
+content authorization. debit_vod_balance() only
+sets the balance left after the debit. Pages thus render without querying
+prepayments. Access control (streaming, orders) still reads the database.
+"""
+from django.core.cache import cache
+
+from ikwen_shavida.reporting.metering import get_vod_balance
+
+__author__ = "Kom Sihon"
+
+ENTITLEMENTS_KEY_PREFIX = 'entitlements:'
+ENTITLEMENTS_TIMEOUT = 24 * 3600
+
+
+class Entitlements(object):
+    """
+    Prepayments held here are shared by all the users of the snapshot and must not be modified.
+    """
+
+    def __init__(self, last_prepayment, last_vod_prepayment, can_access_adult_content, has_pending_update):
+        self.last_prepayment = last_prepayment
+        self.last_vod_prepayment = last_vod_prepayment
+        self.can_access_adult_content = can_access_adult_content
+        self.has_pending_update = has_pending_update
+
+
+def _get_key(member):
+    return ENTITLEMENTS_KEY_PREFIX + member.id
+
+
+def build_entitlements(member):
+    """
+    Reads the entitlements of member from the database and caches them.
+    """
+    customer = member.customer
+    last_vod_prepayment = customer.get_last_vod_prepayment()
+    if last_vod_prepayment:
+        last_vod_prepayment.balance = get_vod_balance(member, last_vod_prepayment)
+    entitlements = Entitlements(customer.get_last_retail_prepayment(), last_vod_prepayment,
+                                customer.get_can_access_adult_content(), customer.get_has_pending_update())
+    cache.set(_get_key(member), entitlements, ENTITLEMENTS_TIMEOUT)
+    return entitlements
+
+
+def get_entitlements(member):
+    entitlements = cache.get(_get_key(member))
+    if entitlements is None:
+        entitlements = build_entitlements(member)
+    return entitlements
+
+
+def set_vod_balance(member, balance):
+    """
+    Sets balance, as left to member after a debit, on the latest VOD prepayment of their snapshot.
+    """
+    entitlements = cache.get(_get_key(member))
+    if entitlements is None or entitlements.last_vod_prepayment is None:
+        return
+    entitlements.last_vod_prepayment.balance = balance
+    cache.set(_get_key(member), entitlements, ENTITLEMENTS_TIMEOUT)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the MongoDB indexes needed by the hot queries of the catalog,
+and of the shapes of those queries so that their plans can be audited.
+Used by the management command ensure_catalog_indexes.
+"""
+from bson import ObjectId
+from datetime import datetime
+
+from django.db import connections
+from pymongo import ASCENDING, DESCENDING
+
+from ikwen_shavida.movies.models import Movie, Series, SeriesEpisode
+from ikwen_shavida.reporting.models import StreamLogEntry
+from ikwen_shavida.sales.models import VODPrepayment, UnitPrepayment, RetailPrepayment, ContentUpdate, Prepayment
+
+__author__ = "Kom Sihon"
+
+# Stages of a query plan that mean the query does not run on an index.
+FORBIDDEN_STAGES = ('COLLSCAN', 'SORT')
+
+
+def _category_filter(category_id):
+    return {'categories': {'$elemMatch': {'id': category_id}}, 'visible': True}
+
+
+# List of tuples (model, keys). keys is given as expected by pymongo create_index()
+INDEXES = [
+    # Category.get_movies_queryset(), get_media()
+    (Movie, [('categories.id', ASCENDING), ('visible', ASCENDING), ('_id', DESCENDING)]),
+    # get_recommended_for_category()
+    (Movie, [('categories.id', ASCENDING), ('visible', ASCENDING), ('release', DESCENDING),
+             ('fake_clicks', DESCENDING), ('fake_orders', DESCENDING), ('_id', DESCENDING)]),
+    # collect_movies()
+    (Movie, [('categories.id', ASCENDING), ('visible', ASCENDING), ('orders', DESCENDING),
+             ('release', DESCENDING), ('_id', DESCENDING)]),
+    # Home recent releases
+    (Movie, [('visible', ASCENDING), ('release', DESCENDING), ('_id', DESCENDING)]),
+    # PartnerDashboard
+    (Movie, [('owner_fk_list', ASCENDING), ('_id', DESCENDING)]),
+    # sample_media()
+    (Movie, [('visible', ASCENDING), ('rand', ASCENDING)]),
+    (Movie, [('categories.id', ASCENDING), ('visible', ASCENDING), ('rand', ASCENDING)]),
+
+    # Category.get_series_queryset(), get_media()
+    (Series, [('categories.id', ASCENDING), ('visible', ASCENDING), ('_id', DESCENDING)]),
+    # get_recommended_for_category()
+    (Series, [('categories.id', ASCENDING), ('visible', ASCENDING), ('release', DESCENDING),
+              ('season', DESCENDING), ('_id', DESCENDING)]),
+    # PartnerDashboard
+    (Series, [('owner_fk_list', ASCENDING), ('_id', DESCENDING)]),
+    # sample_media()
+    (Series, [('visible', ASCENDING), ('rand', ASCENDING)]),
+    (Series, [('categories.id', ASCENDING), ('visible', ASCENDING), ('rand', ASCENDING)]),
+
+    # Series.episodes, refresh of Series episodes aggregates
+    (SeriesEpisode, [('series_id', ASCENDING), ('_id', ASCENDING)]),
+    # collect_series()
+    (SeriesEpisode, [('orders', DESCENDING)]),
+
+    # reduce_stream_log_entries(), get_watched()
+    (StreamLogEntry, [('member_id', ASCENDING), ('status', ASCENDING), ('_id', ASCENDING)]),
+    # update_co_watches()
+    (StreamLogEntry, [('status', ASCENDING), ('_id', ASCENDING)]),
+    # get_co_watched_recommended()
+    (StreamLogEntry, [('member_id', ASCENDING), ('_id', DESCENDING)]),
+
+    # get_unit_prepayment()
+    (UnitPrepayment, [('member_id', ASCENDING), ('status', ASCENDING), ('media_id', ASCENDING), ('expiry', ASCENDING)]),
+    # Customer.get_last_vod_prepayment()
+    (VODPrepayment, [('member_id', ASCENDING), ('status', ASCENDING), ('_id', DESCENDING)]),
+    (VODPrepayment, [('member_id', ASCENDING), ('_id', DESCENDING)]),
+    # Customer.get_last_retail_prepayment()
+    (RetailPrepayment, [('member_id', ASCENDING), ('_id', DESCENDING)]),
+
+    # Customer.get_last_update(), Customer.get_pending_updates_count(), check_auto_selection_status
+    (ContentUpdate, [('member_id', ASCENDING), ('_id', DESCENDING)]),
+    (ContentUpdate, [('member_id', ASCENDING), ('status', ASCENDING)]),
+]
+
+
+# List of tuples (name, model, filter, sort) reproducing the queries issued
+# by the code. Values are arbitrary: only the shape matters for the plan.
+_sample_id = ObjectId()
+QUERY_SHAPES = [
+    ('Category.get_movies_queryset', Movie, _category_filter(_sample_id), [('_id', DESCENDING)]),
+    ('Category.get_series_queryset', Series, _category_filter(_sample_id), [('_id', DESCENDING)]),
+    ('get_recommended_for_category (movies)', Movie, _category_filter(_sample_id),
+     [('release', DESCENDING), ('fake_clicks', DESCENDING), ('fake_orders', DESCENDING), ('_id', DESCENDING)]),
+    ('get_recommended_for_category (series)', Series, _category_filter(_sample_id),
+     [('release', DESCENDING), ('season', DESCENDING), ('_id', DESCENDING)]),
+    ('collect_movies', Movie, dict(_category_filter(_sample_id), _id={'$nin': [ObjectId()]}),
+     [('orders', DESCENDING), ('release', DESCENDING), ('_id', DESCENDING)]),
+    ('sample_media', Movie, {'visible': True, 'rand': {'$gte': 0.5}}, [('rand', ASCENDING)]),
+    ('sample_media (category)', Series, dict(_category_filter(_sample_id), rand={'$gte': 0.5}), [('rand', ASCENDING)]),
+    ('Home recent releases', Movie, {'visible': True}, [('release', DESCENDING), ('_id', DESCENDING)]),
+    ('Series.episodes', SeriesEpisode, {'series_id': _sample_id}, [('_id', ASCENDING)]),
+    ('reduce_stream_log_entries', StreamLogEntry, {'member_id': _sample_id, 'status': StreamLogEntry.SINGLE},
+     [('_id', ASCENDING)]),
+    ('update_co_watches', StreamLogEntry, {'status': StreamLogEntry.REDUCED, '_id': {'$gt': _sample_id}},
+     [('_id', ASCENDING)]),
+    ('get_co_watched_recommended', StreamLogEntry, {'member_id': _sample_id}, [('_id', DESCENDING)]),
+    ('get_unit_prepayment', UnitPrepayment,
+     {'member_id': _sample_id, 'status': Prepayment.CONFIRMED, 'media_id': str(_sample_id),
+      'expiry': {'$gte': datetime.now()}}, None),
+    ('Customer.get_last_vod_prepayment', VODPrepayment, {'member_id': _sample_id, 'status': Prepayment.CONFIRMED},
+     [('_id', DESCENDING)]),
+    ('Customer.get_last_update', ContentUpdate, {'member_id': _sample_id}, [('_id', DESCENDING)]),
+    ('check_auto_selection_status', ContentUpdate, {'member_id': _sample_id, 'status': ContentUpdate.RUNNING}, None),
+]
+
+
+def get_mongo_db(using='default'):
+    from pymongo import MongoClient
+    db_settings = connections[using].settings_dict
+    host = db_settings.get('HOST') or None
+    port = int(db_settings['PORT']) if db_settings.get('PORT') else None
+    client = MongoClient(host, port)
+    return client[db_settings['NAME']]
+
+
+def ensure_indexes(db):
+    """
+    Creates all the indexes declared in INDEXES. Existing ones are left untouched.
+    :return: list of tuples (collection_name, index_name)
+    """
+    created = []
+    for model, keys in INDEXES:
+        collection_name = model._meta.db_table
+        index_name = db[collection_name].create_index(keys, background=True)
+        created.append((collection_name, index_name))
+    return created
+
+
+def _find_stages(plan, stages):
+    """
+    Walks a query plan tree as returned by MongoDB 3+ explain() and collects its stages.
+    """
+    if not plan:
+        return stages
+    stages.append(plan.get('stage'))
+    _find_stages(plan.get('inputStage'), stages)
+    for child in plan.get('inputStages', []):
+        _find_stages(child, stages)
+    return stages
+
+
+def get_plan_issues(explanation):
+    """
+    Gives the forbidden stages found in the output of explain().
+    Output of MongoDB 2.x (cursor and scanAndOrder) is also supported.
+    """
+    query_planner = explanation.get('queryPlanner')
+    if query_planner:
+        stages = _find_stages(query_planner.get('winningPlan'), [])
+        return [stage for stage in stages if stage in FORBIDDEN_STAGES]
+    issues = []
+    if explanation.get('cursor', '').startswith('BasicCursor'):
+        issues.append('COLLSCAN')
+    if explanation.get('scanAndOrder'):
+        issues.append('SORT')
+    return issues
+
+
+def audit_query_plans(db):
+    """
+    Runs explain() on every query of QUERY_SHAPES.
+    :return: list of tuples (name, issues) of the queries that do not run on an index
+    """
+    failures = []
+    for name, model, query, sort in QUERY_SHAPES:
+        cursor = db[model._meta.db_table].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        issues = get_plan_issues(cursor.explain())
+        if issues:
+            failures.append((name, issues))
+    return failures
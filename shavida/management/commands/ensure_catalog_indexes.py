@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ikwen_shavida.shavida.indexes import get_mongo_db, ensure_indexes, audit_query_plans
+
+__author__ = "Kom Sihon"
+
+
+class Command(BaseCommand):
+    help = "Creates the indexes needed by the catalog queries, then checks that none of those " \
+           "queries runs a collection scan or an in-memory sort."
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database', default='default',
+                    help="Database on which to work. Defaults to 'default'."),
+        make_option('--audit-only', action='store_true', dest='audit_only', default=False,
+                    help="Do not create indexes, only audit the query plans."),
+    )
+
+    def handle(self, *args, **options):
+        db = get_mongo_db(options.get('database'))
+        if not options.get('audit_only'):
+            for collection_name, index_name in ensure_indexes(db):
+                self.stdout.write("%s: %s" % (collection_name, index_name))
+        failures = audit_query_plans(db)
+        if failures:
+            details = '\n'.join(["  %s: %s" % (name, ', '.join(issues)) for name, issues in failures])
+            raise CommandError("%d queries do not run on an index:\n%s" % (len(failures), details))
+        self.stdout.write("All query plans use indexes.")
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Request-scoped cache of the objects looked up over and over while serving
+a request: the current Service, its OperatorProfile and the umbrella Service.
+Code running outside a request (scripts, threads, crons) gets them directly.
+"""
+import logging
+import threading
+
+from ikwen.accesscontrol.backends import UMBRELLA
+from ikwen.core.utils import get_service_instance
+
+__author__ = "Kom Sihon"
+
+logger = logging.getLogger('ikwen')
+
+_local = threading.local()
+
+
+def _get(key, getter):
+    store = getattr(_local, 'store', None)
+    if store is None:
+        return getter()
+    if key in store:
+        _local.saved += 1
+        return store[key]
+    value = getter()
+    store[key] = value
+    return value
+
+
+def get_service(using='default'):
+    """
+    Gets the Service of the current website (or umbrella one) once per request.
+    """
+    return _get(('service', using), lambda: get_service_instance(using))
+
+
+def get_config(using='default'):
+    """
+    Gets the OperatorProfile of the current website (or umbrella one) once per request.
+    """
+    return _get(('config', using), lambda: get_service(using).config)
+
+
+def get_umbrella_service():
+    return get_service(UMBRELLA)
+
+
+def invalidate_request_cache():
+    """
+    Forgets the objects cached for the current request, so that they are looked up again.
+    """
+    store = getattr(_local, 'store', None)
+    if store is not None:
+        store.clear()
+
+
+class RequestCacheMiddleware(object):
+    """
+    Enables the request-scoped cache and logs the number of lookups it saved.
+    """
+    def process_request(self, request):
+        _local.store = {}
+        _local.saved = 0
+
+    def process_response(self, request, response):
+        if getattr(_local, 'store', None) is not None:
+            logger.debug("%s - %d service/config lookups saved" % (request.path, _local.saved))
+            response['X-Lookups-Saved'] = str(_local.saved)
+        _local.store = None
+        return response
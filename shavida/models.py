@@ -9,6 +9,7 @@ from ikwen.core.models import AbstractConfig, AbstractWatchModel, Service, Model
 from ikwen.core.utils import to_dict, add_database_to_settings
 from ikwen.theming.models import Theme
 from ikwen_shavida.sales.models import ContentUpdate, SalesConfig, RetailPrepayment, VODPrepayment
+from ikwen_shavida.shavida.middleware import invalidate_request_cache
 
 
 class Customer(AbstractWatchModel):
@@ -63,7 +64,7 @@ class Customer(AbstractWatchModel):
     ordered_recently.short_description = 'Ordered recently?'
 
     def get_last_retail_prepayment(self):
-        prepayments = RetailPrepayment.objects.filter(member=self.member).order_by('-id')
+        prepayments = list(RetailPrepayment.objects.filter(member=self.member).order_by('-id')[:1])
         return prepayments[0] if len(prepayments) > 0 else None
 
     def get_last_vod_prepayment(self, status=None):
@@ -71,6 +72,7 @@ class Customer(AbstractWatchModel):
             vod_prepayments = VODPrepayment.objects.filter(member=self.member, status=status).order_by('-id')
         else:
             vod_prepayments = VODPrepayment.objects.filter(member=self.member).order_by('-id')
+        vod_prepayments = list(vod_prepayments[:1])
         return vod_prepayments[0] if len(vod_prepayments) > 0 else None
 
     def get_has_pending_update(self):
@@ -151,6 +153,7 @@ class OperatorProfile(AbstractConfig):
             except OperatorProfile.DoesNotExist:
                 pass
         super(OperatorProfile, self).save(using=using, *args, **kwargs)
+        invalidate_request_cache()
 
 
 class PartnerWallet(Model):
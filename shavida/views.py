@@ -2,6 +2,7 @@
 import json
 import random
 import string
+from copy import copy
 from datetime import datetime
 
 import requests
@@ -29,8 +30,10 @@ from ikwen.theming.models import Template, Theme
 
 from ikwen_shavida.sales.models import SalesConfig, VODPrepayment, Prepayment
 from ikwen_shavida.shavida.cloud_setup import DeploymentForm, deploy
+from ikwen_shavida.shavida.entitlements import build_entitlements, get_entitlements
 from ikwen_shavida.shavida.models import Customer
 from ikwen_shavida.movies.models import Category, Series
+from ikwen_shavida.movies.warmer import warm_recommendations_async
 
 
 class BaseView(TemplateView):
@@ -45,8 +48,9 @@ class BaseView(TemplateView):
         context['sign_in_url'] = reverse('ikwen:sign_in')
         context['bundles_url'] = reverse('movies:bundles')
         if self.request.user.is_authenticated():
-            last_vod_prepayment = self.request.user.customer.get_last_vod_prepayment()
+            last_vod_prepayment = get_entitlements(self.request.user).last_vod_prepayment
             if last_vod_prepayment:
+                last_vod_prepayment = copy(last_vod_prepayment)
                 last_vod_prepayment.balance /= 1000.0
             context['last_vod_prepayment'] = last_vod_prepayment
         return context
@@ -62,8 +66,14 @@ def offer_welcome_bundle(request, *args, **kwargs):
 
 @login_required
 def set_additional_session_info(request, *args, **kwargs):
-    request.user.can_access_adult_content = request.user.customer.get_can_access_adult_content()
-    request.user.has_pending_update = request.user.customer.get_has_pending_update()
+    entitlements = build_entitlements(request.user)
+    request.user.can_access_adult_content = entitlements.can_access_adult_content
+    request.user.has_pending_update = entitlements.has_pending_update
+
+
+@login_required
+def warm_recommendations(request, *args, **kwargs):
+    warm_recommendations_async(request.user)
 
 
 @login_required
@@ -91,6 +101,7 @@ def authorize_adult(request, *args, **kwargs):
     member = request.user
     member.customer.adult_authorized = True
     member.customer.save()
+    build_entitlements(member)
     return HttpResponse(
         json.dumps({'success': True}),
         content_type='application/json'
@@ -507,6 +507,45 @@
         return $tplMovie
     }
 
+    /**
+     * Player telemetry: events (play, heartbeat, progress, error) are queued and
+     * sent by batches to c.telemetryEndpoint every c.TELEMETRY_INTERVAL milliseconds,
+     * then with navigator.sendBeacon() when the page is left. c.onTelemetryResponse,
+     * if set, gets the response of the server to each batch sent on interval.
+     * The interval is five times the progress tick of the player (one minute), so
+     * that a viewer makes one request every five minutes instead of one a minute.
+     * Heartbeats are sent on their own to debit_vod_balance and are not delayed.
+     */
+    c.TELEMETRY_INTERVAL = 300000;
+    var telemetryEvents = [], telemetryTimerId;
+    c.trackPlayerEvent = function(event) {
+        if (!c.telemetryEndpoint) return;
+        telemetryEvents.push(event);
+        if (!telemetryTimerId) telemetryTimerId = setInterval(c.flushPlayerEvents, c.TELEMETRY_INTERVAL);
+    };
+
+    c.flushPlayerEvents = function() {
+        if (telemetryEvents.length === 0) return;
+        var events = telemetryEvents;
+        telemetryEvents = [];
+        $.post(c.telemetryEndpoint, {csrfmiddlewaretoken: c.csrfToken, events: JSON.stringify(events)}, function(data) {
+            if (c.onTelemetryResponse) c.onTelemetryResponse(data)
+        }, 'json')
+    };
+
+    $(window).on('pagehide', function() {
+        if (telemetryEvents.length === 0) return;
+        if (!navigator.sendBeacon) {
+            c.flushPlayerEvents();
+            return
+        }
+        var data = new FormData();
+        data.append('csrfmiddlewaretoken', c.csrfToken);
+        data.append('events', JSON.stringify(telemetryEvents));
+        telemetryEvents = [];
+        navigator.sendBeacon(c.telemetryEndpoint, data)
+    });
+
     var autoCheckerId;
     c.startAutoSelectionStatusChecker = function(endpoint, notice) {
         if (!localStorage.getItem('autoSelectionIsRunning')) return;